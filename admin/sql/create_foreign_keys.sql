@@ -10,6 +10,16 @@ ALTER TABLE lowlevel_json
   FOREIGN KEY (version)
   REFERENCES version (id);
 
+ALTER TABLE lowlevel_features
+  ADD CONSTRAINT lowlevel_features_fk_lowlevel
+  FOREIGN KEY (id)
+  REFERENCES lowlevel (id);
+
+ALTER TABLE highlevel_lease
+  ADD CONSTRAINT highlevel_lease_fk_lowlevel
+  FOREIGN KEY (id)
+  REFERENCES lowlevel (id);
+
 ALTER TABLE highlevel
   ADD CONSTRAINT highlevel_fk_lowlevel
   FOREIGN KEY (id)
@@ -5,7 +5,7 @@ CREATE INDEX gid_type_ndx_lowlevel ON lowlevel (gid_type);
 CREATE INDEX build_sha1_ndx_lowlevel ON lowlevel (build_sha1);
 CREATE INDEX submitted_ndx_lowlevel ON lowlevel (submitted);
 CREATE INDEX lossless_ndx_lowlevel ON lowlevel (lossless);
-CREATE INDEX gid_submission_offset_ndx_lowlevel ON lowlevel (gid, submission_offset);
+CREATE UNIQUE INDEX gid_submission_offset_ndx_lowlevel ON lowlevel (gid, submission_offset);
 
 CREATE UNIQUE INDEX data_sha256_ndx_lowlevel_json ON lowlevel_json (data_sha256);
 
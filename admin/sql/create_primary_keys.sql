@@ -2,6 +2,8 @@ BEGIN;
 
 ALTER TABLE lowlevel ADD CONSTRAINT lowlevel_pkey PRIMARY KEY (id);
 ALTER TABLE lowlevel_json ADD CONSTRAINT lowlevel_json_pkey PRIMARY KEY (id);
+ALTER TABLE lowlevel_features ADD CONSTRAINT lowlevel_features_pkey PRIMARY KEY (id);
+ALTER TABLE highlevel_lease ADD CONSTRAINT highlevel_lease_pkey PRIMARY KEY (id);
 ALTER TABLE highlevel ADD CONSTRAINT highlevel_pkey PRIMARY KEY (id);
 ALTER TABLE highlevel_meta ADD CONSTRAINT highlevel_meta_pkey PRIMARY KEY (id);
 ALTER TABLE highlevel_model ADD CONSTRAINT highlevel_model_pkey PRIMARY KEY (id);
@@ -17,6 +17,38 @@ CREATE TABLE lowlevel_json (
   version     INTEGER  NOT NULL-- FK to version.id
 );
 
+CREATE TABLE lowlevel_features (
+  id                                        INTEGER, -- PK, FK to lowlevel.id
+  lowlevel_average_loudness                 NUMERIC,
+  lowlevel_dynamic_complexity               NUMERIC,
+  metadata_audio_properties_replay_gain     NUMERIC,
+  metadata_tags                             JSONB,
+  metadata_version                          JSONB,
+  metadata_audio_properties                 JSONB,
+  rhythm_beats_count                        NUMERIC,
+  rhythm_beats_loudness_mean                NUMERIC,
+  rhythm_bpm                                NUMERIC,
+  rhythm_bpm_histogram_first_peak_bpm_mean  NUMERIC,
+  rhythm_bpm_histogram_second_peak_bpm_mean NUMERIC,
+  rhythm_danceability                       NUMERIC,
+  rhythm_onset_rate                         NUMERIC,
+  tonal_chords_key                          TEXT,
+  tonal_chords_scale                        TEXT,
+  tonal_chords_changes_rate                 NUMERIC,
+  tonal_key_key                             TEXT,
+  tonal_key_scale                           TEXT,
+  tonal_key_strength                        NUMERIC,
+  tonal_tuning_frequency                    NUMERIC,
+  tonal_tuning_equal_tempered_deviation     NUMERIC
+);
+
+-- Submissions which a high-level extractor is processing (see db.data.claim_unprocessed_highlevel_documents)
+CREATE TABLE highlevel_lease (
+  id      INTEGER, -- PK, FK to lowlevel.id
+  worker  TEXT                     NOT NULL,
+  expires TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
 CREATE TABLE highlevel (
   id         INTEGER, -- FK to lowlevel.id
   mbid       UUID    NOT NULL,
@@ -183,7 +215,11 @@ CREATE TABLE similarity.similarity_metrics (
 CREATE TABLE similarity.similarity_stats (
   metric TEXT,
   means DOUBLE PRECISION[],
-  stddevs DOUBLE PRECISION[]
+  stddevs DOUBLE PRECISION[],
+  -- State of running stats computed over the whole lowlevel table
+  num_items INTEGER,
+  m2 DOUBLE PRECISION[],
+  max_id INTEGER -- lowlevel.id of the last submission included in the stats
 );
 
 CREATE TABLE similarity.eval_params (
@@ -2,6 +2,8 @@ BEGIN;
 
 ALTER TABLE lowlevel DROP CONSTRAINT IF EXISTS lowlevel_pkey;
 ALTER TABLE lowlevel_json DROP CONSTRAINT IF EXISTS lowlevel_json_pkey;
+ALTER TABLE lowlevel_features DROP CONSTRAINT IF EXISTS lowlevel_features_pkey;
+ALTER TABLE highlevel_lease DROP CONSTRAINT IF EXISTS highlevel_lease_pkey;
 ALTER TABLE highlevel DROP CONSTRAINT IF EXISTS highlevel_pkey;
 ALTER TABLE highlevel_meta DROP CONSTRAINT IF EXISTS highlevel_meta_pkey;
 ALTER TABLE highlevel_model DROP CONSTRAINT IF EXISTS highlevel_model_pkey;
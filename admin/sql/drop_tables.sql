@@ -2,9 +2,11 @@ BEGIN;
 
 DROP TABLE IF EXISTS highlevel_model        CASCADE;
 DROP TABLE IF EXISTS highlevel_meta         CASCADE;
+DROP TABLE IF EXISTS highlevel_lease        CASCADE;
 DROP TABLE IF EXISTS highlevel              CASCADE;
 DROP TABLE IF EXISTS model                  CASCADE;
 DROP TABLE IF EXISTS lowlevel_json          CASCADE;
+DROP TABLE IF EXISTS lowlevel_features      CASCADE;
 DROP TABLE IF EXISTS lowlevel               CASCADE;
 DROP TABLE IF EXISTS version                CASCADE;
 DROP TABLE IF EXISTS statistics             CASCADE;
@@ -0,0 +1,18 @@
+BEGIN;
+
+-- Submissions which a high-level extractor is processing, so that many extractors
+-- can run at the same time without processing the same submissions
+CREATE TABLE highlevel_lease (
+  id      INTEGER, -- PK, FK to lowlevel.id
+  worker  TEXT                     NOT NULL,
+  expires TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+ALTER TABLE highlevel_lease ADD CONSTRAINT highlevel_lease_pkey PRIMARY KEY (id);
+
+ALTER TABLE highlevel_lease
+  ADD CONSTRAINT highlevel_lease_fk_lowlevel
+  FOREIGN KEY (id)
+  REFERENCES lowlevel (id);
+
+COMMIT;
@@ -0,0 +1,37 @@
+BEGIN;
+
+-- Features of each low-level submission which can be selected individually in the API.
+-- Fill this table for existing submissions with `./develop.sh manage backfill_lowlevel_features`
+CREATE TABLE lowlevel_features (
+  id                                        INTEGER, -- PK, FK to lowlevel.id
+  lowlevel_average_loudness                 NUMERIC,
+  lowlevel_dynamic_complexity               NUMERIC,
+  metadata_audio_properties_replay_gain     NUMERIC,
+  metadata_tags                             JSONB,
+  metadata_version                          JSONB,
+  metadata_audio_properties                 JSONB,
+  rhythm_beats_count                        NUMERIC,
+  rhythm_beats_loudness_mean                NUMERIC,
+  rhythm_bpm                                NUMERIC,
+  rhythm_bpm_histogram_first_peak_bpm_mean  NUMERIC,
+  rhythm_bpm_histogram_second_peak_bpm_mean NUMERIC,
+  rhythm_danceability                       NUMERIC,
+  rhythm_onset_rate                         NUMERIC,
+  tonal_chords_key                          TEXT,
+  tonal_chords_scale                        TEXT,
+  tonal_chords_changes_rate                 NUMERIC,
+  tonal_key_key                             TEXT,
+  tonal_key_scale                           TEXT,
+  tonal_key_strength                        NUMERIC,
+  tonal_tuning_frequency                    NUMERIC,
+  tonal_tuning_equal_tempered_deviation     NUMERIC
+);
+
+ALTER TABLE lowlevel_features ADD CONSTRAINT lowlevel_features_pkey PRIMARY KEY (id);
+
+ALTER TABLE lowlevel_features
+  ADD CONSTRAINT lowlevel_features_fk_lowlevel
+  FOREIGN KEY (id)
+  REFERENCES lowlevel (id);
+
+COMMIT;
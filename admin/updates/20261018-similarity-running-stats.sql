@@ -0,0 +1,8 @@
+BEGIN;
+
+-- State of running stats computed over the whole lowlevel table
+ALTER TABLE similarity.similarity_stats ADD COLUMN num_items INTEGER;
+ALTER TABLE similarity.similarity_stats ADD COLUMN m2 DOUBLE PRECISION[];
+ALTER TABLE similarity.similarity_stats ADD COLUMN max_id INTEGER;
+
+COMMIT;
@@ -0,0 +1,9 @@
+BEGIN;
+
+-- Concurrent submissions of the same mbid can no longer get the same offset.
+-- If this fails, find the duplicated offsets with
+--   SELECT gid, submission_offset FROM lowlevel GROUP BY gid, submission_offset HAVING count(*) > 1;
+DROP INDEX gid_submission_offset_ndx_lowlevel;
+CREATE UNIQUE INDEX gid_submission_offset_ndx_lowlevel ON lowlevel (gid, submission_offset);
+
+COMMIT;
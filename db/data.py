@@ -3,6 +3,7 @@ import json
 import logging
 import os
 import time
+import uuid
 from collections import defaultdict
 from hashlib import sha256
 
@@ -10,7 +11,12 @@ import sqlalchemy.exc
 from sqlalchemy import text
 
 import db
+import db.document_cache
 import db.exceptions
+import db.lowlevel_features
+from utils import canonical_json
+from utils.container_utils import LRUCache, remove_duplicates
+from utils.list_utils import chunks
 
 _whitelist_file = os.path.join(os.path.dirname(__file__), "tagwhitelist.json")
 _whitelist_tags = set(json.load(open(_whitelist_file)))
@@ -38,11 +44,176 @@ STATUS_SHOW = 'show'
 VERSION_TYPE_LOWLEVEL = 'lowlevel'
 VERSION_TYPE_HIGHLEVEL = 'highlevel'
 
+# Number of recordings looked up in the document cache at a time by iter_many_low_level_json
+LOWLEVEL_STREAM_BATCH_SIZE = 5
+# Number of recordings read at a time by iter_many_high_level
+HIGHLEVEL_STREAM_BATCH_SIZE = 100
+
+# Join of the lowlevel table (as ll) with a list of recordings, which are passed
+# as arrays of gids and offsets (see _recordings_params) so that the query text
+# is the same for any number of recordings
+RECORDINGS_JOIN = """
+              JOIN unnest(CAST(:gids AS uuid[]), CAST(:offsets AS integer[])) AS recording (gid, submission_offset)
+                ON ll.gid = recording.gid
+               AND ll.submission_offset = recording.submission_offset
+"""
+
 MODEL_STATUSES = [STATUS_HIDDEN, STATUS_EVALUATION, STATUS_SHOW]
 
+# Number of times write_low_level tries to save a submission whose offset was
+# taken by a concurrent submission of the same mbid
+LOWLEVEL_WRITE_ATTEMPTS = 5
+
+# Save a low-level submission (see write_low_level) unless a document with the
+# same data_sha256 exists. Returns the lowlevel.id of the submission, or no
+# rows if it already exists. Rows inserted by one part of the statement aren't
+# visible to the others, so the features are read from the submitted document
+# rather than from lowlevel_json.
+WRITE_LOWLEVEL_QUERY = text("""
+    WITH document AS (
+        SELECT CAST(:data AS jsonb) AS data
+    ), ll AS (
+        INSERT INTO lowlevel (gid, build_sha1, lossless, gid_type, submission_offset)
+             SELECT CAST(:mbid AS uuid), :build_sha1, :lossless, CAST(:gid_type AS gid_type),
+                    COALESCE(MAX(submission_offset) + 1, 0)
+               FROM lowlevel
+              WHERE gid = :mbid
+             HAVING NOT EXISTS (SELECT 1 FROM lowlevel_json WHERE data_sha256 = :data_sha256)
+          RETURNING id
+    ), llj AS (
+        INSERT INTO lowlevel_json (id, data, data_sha256, version)
+             SELECT ll.id, document.data, :data_sha256, :version
+               FROM ll, document
+    ), llf AS (%s)
+    SELECT id
+      FROM ll
+""" % db.lowlevel_features.get_insert_sql("(SELECT ll.id, document.data FROM ll, document) llj", "TRUE"))
+
+# Save many low-level submissions (see write_many_low_level) in the order of
+# their position, skipping those which have the data_sha256 of an existing
+# document. Submissions of the same gid get consecutive offsets. Returns the
+# position of each submission which was saved.
+WRITE_MANY_LOWLEVEL_QUERY = text("""
+    WITH document AS (
+        SELECT document.*,
+               COALESCE((SELECT MAX(submission_offset) FROM lowlevel WHERE gid = document.gid), -1)
+               + row_number() OVER (PARTITION BY document.gid ORDER BY document.position) AS submission_offset
+          FROM unnest(CAST(:gids AS uuid[]), CAST(:build_sha1s AS text[]), CAST(:lossless AS boolean[]),
+                      CAST(:gid_types AS gid_type[]), CAST(:datas AS jsonb[]), CAST(:data_sha256s AS char(64)[]),
+                      CAST(:versions AS integer[]), CAST(:positions AS integer[]))
+               AS document (gid, build_sha1, lossless, gid_type, data, data_sha256, version, position)
+         WHERE NOT EXISTS (SELECT 1 FROM lowlevel_json WHERE data_sha256 = document.data_sha256)
+    ), ll AS (
+        INSERT INTO lowlevel (gid, build_sha1, lossless, gid_type, submission_offset)
+             SELECT gid, build_sha1, lossless, gid_type, submission_offset
+               FROM document
+           ORDER BY position
+          RETURNING id, gid, submission_offset
+    ), saved AS (
+        SELECT ll.id, document.data, document.data_sha256, document.version, document.position
+          FROM ll
+          JOIN document
+         USING (gid, submission_offset)
+    ), llj AS (
+        INSERT INTO lowlevel_json (id, data, data_sha256, version)
+             SELECT id, data, data_sha256, version
+               FROM saved
+    ), llf AS (%s)
+    SELECT position
+      FROM saved
+""" % db.lowlevel_features.get_insert_sql("saved llj", "TRUE"))
+
+# Save the highlevel documents of many submissions (see write_many_high_level).
+# highlevel_meta is only written for submissions whose highlevel row is new.
+WRITE_MANY_HIGHLEVEL_QUERY = text("""
+    WITH hl AS (
+        INSERT INTO highlevel (id, mbid, build_sha1)
+             SELECT id, mbid, :build_sha1
+               FROM unnest(CAST(:ids AS integer[]), CAST(:mbids AS uuid[])) AS document (id, mbid)
+        ON CONFLICT (id) DO NOTHING
+          RETURNING id
+    ), hlm AS (
+        INSERT INTO highlevel_meta (id, data, data_sha256)
+             SELECT meta.id, meta.data, meta.data_sha256
+               FROM unnest(CAST(:meta_ids AS integer[]), CAST(:meta_datas AS jsonb[]),
+                           CAST(:meta_sha256s AS char(64)[])) AS meta (id, data, data_sha256)
+               JOIN hl
+                 ON hl.id = meta.id
+    )
+    INSERT INTO highlevel_model (highlevel, data, data_sha256, model, version)
+         SELECT *
+           FROM unnest(CAST(:model_highlevels AS integer[]), CAST(:model_datas AS jsonb[]),
+                       CAST(:model_sha256s AS char(64)[]), CAST(:model_ids AS integer[]),
+                       CAST(:model_versions AS integer[]))
+    ON CONFLICT (data_sha256, highlevel, model) DO NOTHING
+""")
+
+# Reserve the oldest submissions without highlevel data which aren't reserved by
+# another extractor (see claim_unprocessed_highlevel_documents). Submissions whose
+# lowlevel row is being claimed by another transaction are skipped, and a lease is
+# only replaced if it has expired when it's written, so concurrent claims never
+# return the same submission.
+CLAIM_HIGHLEVEL_QUERY = text("""
+    WITH candidate AS (
+        SELECT ll.id
+          FROM lowlevel AS ll
+     LEFT JOIN highlevel AS hl
+            ON hl.id = ll.id
+     LEFT JOIN highlevel_lease AS lease
+            ON lease.id = ll.id
+         WHERE hl.id IS NULL
+           AND (lease.id IS NULL OR lease.expires < now())
+           AND ll.id > :id_from
+      ORDER BY ll.id
+         LIMIT :limit
+           FOR NO KEY UPDATE OF ll SKIP LOCKED
+    ), claimed AS (
+        INSERT INTO highlevel_lease (id, worker, expires)
+             SELECT id, :worker, now() + make_interval(secs => :lease_duration)
+               FROM candidate
+        ON CONFLICT (id) DO UPDATE
+                SET worker = EXCLUDED.worker
+                  , expires = EXCLUDED.expires
+              WHERE highlevel_lease.expires < now()
+          RETURNING id
+    )
+    SELECT ll.id
+         , ll.gid::text
+         , llj.data::text
+      FROM claimed
+      JOIN lowlevel AS ll
+        ON ll.id = claimed.id
+      JOIN lowlevel_json AS llj
+        ON llj.id = claimed.id
+  ORDER BY ll.id
+""")
+
+# Number of seconds that a high-level extractor reserves the submissions it claims for
+HIGHLEVEL_LEASE_DURATION = 60 * 60
+
+SUBMISSION_STATUS_SAVED = "saved"
+SUBMISSION_STATUS_DUPLICATE = "duplicate"
+SUBMISSION_STATUS_INVALID = "invalid"
+
+# Number of version and model ids remembered by each process. Rows of these
+# tables are never changed or deleted, so an id never has to be forgotten.
+ID_CACHE_SIZE = 1000
+# (data_sha256, type) -> version.id
+_version_ids = LRUCache(ID_CACHE_SIZE)
+# (model, model_version) -> model.id
+_model_ids = LRUCache(ID_CACHE_SIZE)
+
 
 # TODO: Util methods should not be in the database package
 
+def _recordings_params(recordings):
+    """Get the parameters of RECORDINGS_JOIN for a list of (mbid, offset) tuples.
+    Duplicate recordings are removed, so that each row is only joined once."""
+    recordings = remove_duplicates([(str(mbid), int(offset)) for mbid, offset in recordings])
+    return {"gids": [mbid for mbid, _ in recordings],
+            "offsets": [offset for _, offset in recordings]}
+
+
 def _has_key(dictionary, key):
     """Checks if muti-level dictionary contains in item referenced by a
     specified key.
@@ -143,6 +314,62 @@ def submit_low_level_data(mbid, data, gid_type):
         gid_type: the ID type [musicbrainzid(mbid) or messybrainzid(msid)]
     """
     mbid = str(mbid)
+    data = _prepare_low_level_data(mbid, data)
+
+    # The data looks good, lets see about saving it
+    write_low_level(mbid, data, gid_type)
+
+
+def submit_many_low_level_data(submissions, gid_type):
+    """Submit many low-level documents, saving all of the valid ones together.
+
+    Args:
+        submissions: a list of (mbid, data) tuples.
+        gid_type: the ID type of all of the mbids.
+    Returns:
+        a list with a (status, message) tuple for each submission, in the same
+        order. status is one of SUBMISSION_STATUS_SAVED, SUBMISSION_STATUS_DUPLICATE
+        or SUBMISSION_STATUS_INVALID, and message is the reason why a submission
+        is invalid, or None.
+    """
+    statuses = [None] * len(submissions)
+    valid = []
+    for i, (mbid, data) in enumerate(submissions):
+        mbid = str(mbid)
+        try:
+            valid.append((i, mbid, _prepare_low_level_data(mbid, data)))
+        except db.exceptions.BadDataException as e:
+            statuses[i] = (SUBMISSION_STATUS_INVALID, str(e))
+
+    try:
+        saved = write_many_low_level([(mbid, data, gid_type) for _, mbid, data in valid])
+    except db.exceptions.BadDataException:
+        # Find out which documents can't be saved
+        saved = []
+        for i, mbid, data in valid:
+            try:
+                saved.append(write_low_level(mbid, data, gid_type))
+            except db.exceptions.BadDataException as e:
+                saved.append(e)
+
+    for (i, _, _), result in zip(valid, saved):
+        if isinstance(result, db.exceptions.BadDataException):
+            statuses[i] = (SUBMISSION_STATUS_INVALID, str(result))
+        elif result:
+            statuses[i] = (SUBMISSION_STATUS_SAVED, None)
+        else:
+            statuses[i] = (SUBMISSION_STATUS_DUPLICATE, None)
+    return statuses
+
+
+def _prepare_low_level_data(mbid, data):
+    """Clean a low-level document and check that it can be submitted for an mbid.
+
+    Returns:
+        the cleaned document.
+    Raises:
+        BadDataException if keys are missing or the document is for another recording.
+    """
     data = clean_metadata(data)
 
     try:
@@ -174,22 +401,45 @@ def submit_low_level_data(mbid, data, gid_type):
             "the submitted data does not match the MBID that is "
             "part of this resource URL."
         )
+    return data
 
-    # The data looks good, lets see about saving it
-    write_low_level(mbid, data, gid_type)
+
+def clear_id_caches():
+    """Forget the version and model ids remembered by insert_version
+    and _get_model_id, e.g. after the database has been recreated."""
+    _version_ids.clear()
+    _model_ids.clear()
 
 
 def insert_version(connection, data, version_type):
-    # TODO: Memoise sha -> id
-    norm_data = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    norm_data = canonical_json.dumps(data)
     sha = sha256(norm_data).hexdigest()
+    key = (sha, version_type)
+    version_id = _version_ids.get(key)
+    if version_id is not None:
+        return version_id
+
+    # If two submissions inserted the same version at the same time there
+    # are several rows for it. All processes use the first one from then on.
     query = text("""
             SELECT id
               FROM version
              WHERE data_sha256=:data_sha256
-               AND type=:version_type""")
-    result = connection.execute(query, {"data_sha256": sha, "version_type": version_type})
-    row = result.fetchone()
+               AND type=:version_type
+          ORDER BY id
+             LIMIT 1""")
+    params = {"data_sha256": sha, "version_type": version_type}
+    # Only an id which is read outside of the transaction of `connection` is
+    # remembered, because a row that this transaction added is only valid if
+    # it is committed
+    with db.engine.connect() as committed_connection:
+        row = committed_connection.execute(query, params).fetchone()
+    if row:
+        _version_ids.set(key, row[0])
+        return row[0]
+
+    # This transaction may have added the version already
+    row = connection.execute(query, params).fetchone()
     if row:
         return row[0]
 
@@ -204,62 +454,117 @@ def insert_version(connection, data, version_type):
 
 
 def write_low_level(mbid, data, is_mbid):
-    def _get_by_data_sha256(connection, data_sha256):
-        query = text("""
-            SELECT id
-              FROM lowlevel_json
-             WHERE data_sha256 = :data_sha256
-        """)
-        result = connection.execute(query, {"data_sha256": data_sha256})
-        return result.fetchone()
+    """Save a low-level submission, unless the same document has already
+    been submitted.
 
-    def _insert_lowlevel(connection, mbid, build_sha1, is_lossless_submit, gid_type, submission_offset):
-        """ Insert metadata into the lowlevel table and return its id """
-        query = text("""
-            INSERT INTO lowlevel (gid, build_sha1, lossless, gid_type, submission_offset)
-                 VALUES (:mbid, :build_sha1, :lossless, :gid_type, :submission_offset)
-              RETURNING id
-        """)
-        result = connection.execute(query, {"mbid": mbid,
-                                            "build_sha1": build_sha1,
-                                            "lossless": is_lossless_submit,
-                                            "gid_type": gid_type,
-                                            "submission_offset": submission_offset})
-        return result.fetchone()[0]
-
-    def _insert_lowlevel_json(connection, ll_id, data_json, data_sha256, version_id):
-        """ Insert the contents of the data file, with references to
-            the version and metadata"""
-        query = text("""
-          INSERT INTO lowlevel_json (id, data, data_sha256, version)
-               VALUES (:id, :data, :data_sha256, :version)
-        """)
-        connection.execute(query, {"id": ll_id,
-                                   "data": data_json,
-                                   "data_sha256": data_sha256,
-                                   "version": version_id})
+    The submission is saved with a single statement which allocates the next
+    submission offset of the mbid and inserts the lowlevel, lowlevel_json and
+    lowlevel_features rows. If a concurrent submission of the same mbid
+    takes the same offset, the unique index on (gid, submission_offset)
+    rejects one of them, which is then retried with a new offset.
 
+    Returns:
+        True if the submission was saved, False if it already exists.
+    """
     is_lossless_submit = data['metadata']['audio_properties']['lossless']
     version = data['metadata']['version']
     build_sha1 = version['essentia_build_sha']
-    data_json = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    data_json = canonical_json.dumps(data)
     data_sha256 = sha256(data_json.encode("utf-8")).hexdigest()
-    with db.engine.begin() as connection:
-        # See if we already have this data
-        existing = _get_by_data_sha256(connection, data_sha256)
-        if existing:
-            logging.info("Already have %s" % data_sha256)
-            return
-
+    params = {"mbid": mbid,
+              "build_sha1": build_sha1,
+              "lossless": is_lossless_submit,
+              "gid_type": is_mbid,
+              "data": data_json,
+              "data_sha256": data_sha256}
+
+    for attempt in range(LOWLEVEL_WRITE_ATTEMPTS):
         try:
-            submission_offset = get_next_submission_offset(connection, mbid)
-            ll_id = _insert_lowlevel(connection, mbid, build_sha1, is_lossless_submit, is_mbid, submission_offset)
-            version_id = insert_version(connection, version, VERSION_TYPE_LOWLEVEL)
-            _insert_lowlevel_json(connection, ll_id, data_json, data_sha256, version_id)
-            logging.info("Saved %s" % mbid)
+            with db.engine.begin() as connection:
+                params["version"] = insert_version(connection, version, VERSION_TYPE_LOWLEVEL)
+                row = connection.execute(WRITE_LOWLEVEL_QUERY, params).fetchone()
         except sqlalchemy.exc.DataError as e:
             raise db.exceptions.BadDataException(
                 "data is badly formed")
+        except sqlalchemy.exc.IntegrityError as e:
+            constraint = e.orig.diag.constraint_name
+            if constraint == "data_sha256_ndx_lowlevel_json":
+                # The same data was submitted at the same time
+                row = None
+            elif constraint == "gid_submission_offset_ndx_lowlevel" and attempt + 1 < LOWLEVEL_WRITE_ATTEMPTS:
+                continue
+            else:
+                raise
+
+        if row:
+            logging.info("Saved %s" % mbid)
+            return True
+        else:
+            logging.info("Already have %s" % data_sha256)
+            return False
+
+
+def write_many_low_level(submissions):
+    """Save many low-level submissions with a single statement, skipping
+    those which have already been submitted. Like write_low_level, this is
+    retried if a concurrent submission takes an offset or saves one of the
+    documents.
+
+    Args:
+        submissions: a list of (mbid, data, gid_type) tuples.
+    Returns:
+        a list which is True for each submission which was saved and False
+        for each one that already exists, in the same order as `submissions`.
+    Raises:
+        BadDataException if any of the documents can't be stored.
+    """
+    if not submissions:
+        return []
+
+    params = {"gids": [], "build_sha1s": [], "lossless": [], "gid_types": [], "datas": [], "data_sha256s": [],
+              "positions": []}
+    # canonical JSON of a version -> the version
+    versions = {}
+    # the key in `versions` of the version of each document
+    version_keys = []
+    # The first of several submissions of the same document is saved
+    seen_sha256s = set()
+    for position, (mbid, data, gid_type) in enumerate(submissions, 1):
+        data_json = canonical_json.dumps(data)
+        data_sha256 = sha256(data_json.encode("utf-8")).hexdigest()
+        if data_sha256 in seen_sha256s:
+            continue
+        seen_sha256s.add(data_sha256)
+        params["positions"].append(position)
+        params["gids"].append(mbid)
+        params["build_sha1s"].append(data['metadata']['version']['essentia_build_sha'])
+        params["lossless"].append(bool(data['metadata']['audio_properties']['lossless']))
+        params["gid_types"].append(gid_type)
+        params["datas"].append(data_json)
+        params["data_sha256s"].append(data_sha256)
+        version = data['metadata']['version']
+        version_key = canonical_json.dumps(version)
+        versions[version_key] = version
+        version_keys.append(version_key)
+
+    for attempt in range(LOWLEVEL_WRITE_ATTEMPTS):
+        try:
+            with db.engine.begin() as connection:
+                version_ids = {key: insert_version(connection, version, VERSION_TYPE_LOWLEVEL)
+                               for key, version in versions.items()}
+                params["versions"] = [version_ids[key] for key in version_keys]
+                result = connection.execute(WRITE_MANY_LOWLEVEL_QUERY, params)
+                saved_positions = {row["position"] for row in result}
+            break
+        except sqlalchemy.exc.DataError:
+            raise db.exceptions.BadDataException("data is badly formed")
+        except sqlalchemy.exc.IntegrityError as e:
+            if e.orig.diag.constraint_name not in ("data_sha256_ndx_lowlevel_json", "gid_submission_offset_ndx_lowlevel") \
+                    or attempt + 1 == LOWLEVEL_WRITE_ATTEMPTS:
+                raise
+
+    logging.info("Saved %s of %s submissions" % (len(saved_positions), len(submissions)))
+    return [position in saved_positions for position in range(1, len(submissions) + 1)]
 
 
 def get_next_submission_offset(connection, mbid):
@@ -310,6 +615,8 @@ def set_model_status(model_name, model_version, model_status):
                            {"model_name": model_name,
                             "model_version": model_version,
                             "model_status": model_status})
+    # The models included in high-level documents have changed
+    db.document_cache.invalidate(db.document_cache.HIGHLEVEL_CACHE_NAMESPACE)
 
 
 def get_active_models():
@@ -324,64 +631,30 @@ def get_active_models():
 
 
 def _get_model_id(model_name, version):
+    key = (model_name, version)
+    model_id = _model_ids.get(key)
+    if model_id is not None:
+        return model_id
+
     with db.engine.begin() as connection:
         query = text(
             """SELECT id
                  FROM model
                 WHERE model = :model_name
-                  AND model_version = :model_version""")
+                  AND model_version = :model_version
+             ORDER BY id
+                LIMIT 1""")
         result = connection.execute(query,
                                     {"model_name": model_name,
                                      "model_version": version})
         row = result.fetchone()
         if row:
+            _model_ids.set(key, row[0])
             return row[0]
         else:
             return None
 
 
-def write_high_level_item(connection, model_name, model_version, ll_id, version_id, data):
-    item_norm_data = json.dumps(data, sort_keys=True, separators=(',', ':'))
-    item_sha = sha256(item_norm_data).hexdigest()
-
-    model_id = _get_model_id(model_name, model_version)
-    if model_id is None:
-        model_id = add_model(model_name, model_version)
-
-    item_q = text(
-        """INSERT INTO highlevel_model (highlevel, data, data_sha256, model, version)
-                VALUES (:highlevel, :data, :data_sha256, :model, :version)""")
-
-    connection.execute(item_q,
-                       {"highlevel": ll_id, "data": item_norm_data,
-                        "data_sha256": item_sha, "model": model_id,
-                        "version": version_id})
-
-
-def write_high_level_meta(connection, ll_id, mbid, build_sha1, json_meta):
-    check_query = text(
-        """SELECT id
-             FROM highlevel
-            WHERE id = :id""")
-    result = connection.execute(check_query, {"id": ll_id})
-    if result.rowcount:
-        # If this already exists, we don't need to add it
-        # (new model for existing highlevel)
-        return
-    hl_query = text(
-        """INSERT INTO highlevel (id, mbid, build_sha1)
-                VALUES (:id, :mbid, :build_sha1)""")
-    connection.execute(hl_query, {"id": ll_id, "mbid": mbid, "build_sha1": build_sha1})
-
-    if json_meta:
-        meta_norm_data = json.dumps(json_meta, sort_keys=True, separators=(',', ':'))
-        sha = sha256(meta_norm_data).hexdigest()
-        hl_meta = text(
-            """INSERT INTO highlevel_meta (id, data, data_sha256)
-                    VALUES (:id, :data, :data_sha256)""")
-        connection.execute(hl_meta, {"id": ll_id, "data": meta_norm_data, "data_sha256": sha})
-
-
 def write_high_level(mbid, ll_id, data, build_sha1):
     """Write highlevel data to the database.
 
@@ -393,20 +666,105 @@ def write_high_level(mbid, ll_id, data, build_sha1):
 
     If `data` is an empty dictionary, a highlevel table entry is still recorded
     so that this submission is no longer processed by the highlevel runner
+
+    Any cached high-level document for this submission is removed from the cache.
     """
-    with db.engine.begin() as connection:
-        json_meta = data.get("metadata", {})
-        json_high = data.get("highlevel", {})
+    write_many_high_level([(ll_id, mbid, data)], build_sha1)
+
+
+def _get_or_add_model_id(model_name, model_version):
+    model_id = _get_model_id(model_name, model_version)
+    if model_id is None:
+        add_model(model_name, model_version)
+        # Another process may have added the same model at the same time,
+        # so use the id which all of them will use
+        model_id = _get_model_id(model_name, model_version)
+    return model_id
+
+
+def write_many_high_level(documents, build_sha1):
+    """Write the highlevel data of many submissions to the database in one
+    transaction, in the same way as :py:func:`write_high_level`.
+
+    The highlevel and highlevel_meta rows of a submission are only written if it
+    doesn't have them yet (i.e. when adding new models). A model which a submission
+    already has the same data for is skipped.
+
+    Args:
+        documents: a list of (ll_id, mbid, data) tuples, where ll_id is the
+          lowlevel.id of a submission and data is its highlevel document.
+        build_sha1: the sha1 of the highlevel extractor which computed the documents.
+    Raises:
+        BadDataException if any of the documents can't be stored. None of the
+        documents are stored then.
+    """
+    params = {"ids": [], "mbids": [],
+              "meta_ids": [], "meta_datas": [], "meta_sha256s": [],
+              "model_highlevels": [], "model_datas": [], "model_sha256s": [], "model_ids": []}
+    # canonical JSON of a version -> the version
+    versions = {}
+    # the key in `versions` of the version of each highlevel_model row
+    model_version_keys = []
+    seen_ids = set()
+    for ll_id, mbid, data in documents:
+        if ll_id in seen_ids:
+            continue
+        seen_ids.add(ll_id)
+        params["ids"].append(ll_id)
+        params["mbids"].append(mbid)
 
-        write_high_level_meta(connection, ll_id, mbid, build_sha1, json_meta)
+        try:
+            json_meta = data.get("metadata", {})
+            json_high = data.get("highlevel", {})
+            if json_meta:
+                meta_norm_data = canonical_json.dumps(json_meta)
+                params["meta_ids"].append(ll_id)
+                params["meta_datas"].append(meta_norm_data)
+                params["meta_sha256s"].append(sha256(meta_norm_data).hexdigest())
+
+            if json_meta and json_high:
+                hl_version = json_meta["version"]["highlevel"]
+                version_key = canonical_json.dumps(hl_version)
+                versions[version_key] = hl_version
+                model_version = hl_version["models_essentia_git_sha"]
+                for model_name, item in json_high.items():
+                    item_norm_data = canonical_json.dumps(item)
+                    params["model_highlevels"].append(ll_id)
+                    params["model_datas"].append(item_norm_data)
+                    params["model_sha256s"].append(sha256(item_norm_data).hexdigest())
+                    params["model_ids"].append(_get_or_add_model_id(model_name, model_version))
+                    model_version_keys.append(version_key)
+        except (AttributeError, KeyError, TypeError):
+            raise db.exceptions.BadDataException(
+                "highlevel data of lowlevel id %s is badly formed" % ll_id)
 
-        if json_meta and json_high:
-            hl_version = json_meta["version"]["highlevel"]
-            version_id = insert_version(connection, hl_version, VERSION_TYPE_HIGHLEVEL)
-            model_version = hl_version["models_essentia_git_sha"]
+    if not params["ids"]:
+        return
 
-            for model_name, data in json_high.items():
-                write_high_level_item(connection, model_name, model_version, ll_id, version_id, data)
+    try:
+        with db.engine.begin() as connection:
+            version_ids = {key: insert_version(connection, hl_version, VERSION_TYPE_HIGHLEVEL)
+                           for key, hl_version in versions.items()}
+            params["model_versions"] = [version_ids[key] for key in model_version_keys]
+
+            params["build_sha1"] = build_sha1
+            connection.execute(WRITE_MANY_HIGHLEVEL_QUERY, params)
+            # The submissions don't have to be reserved for an extractor any more
+            connection.execute(text("DELETE FROM highlevel_lease WHERE id = ANY(:ids)"), {"ids": params["ids"]})
+
+            query = text("""
+                SELECT gid::text
+                     , submission_offset
+                  FROM lowlevel
+                 WHERE id = ANY(:ids)
+            """)
+            recordings = [tuple(row) for row in connection.execute(query, {"ids": params["ids"]})]
+    except sqlalchemy.exc.DataError:
+        raise db.exceptions.BadDataException("data is badly formed")
+
+    # Remove the documents from the cache once the new models are committed
+    db.document_cache.delete_many(db.document_cache.HIGHLEVEL_CACHE_NAMESPACE, recordings,
+                                  attributes_list=[(0,), (1,)])
 
 
 def load_low_level(mbid, offset=0):
@@ -418,12 +776,21 @@ def load_low_level(mbid, offset=0):
         mbid (str): MBID to load
         offset (int): submission offset for this MBID, starting from 0
 
+    Raises:
+        NoDataFoundException: if this mbid doesn't exist or the offset is too high"""
+    return json.loads(load_low_level_json(mbid, offset))
+
+
+def load_low_level_json(mbid, offset=0):
+    """Load lowlevel data with the given mbid as serialized JSON,
+    in the same way as `load_low_level`.
+
     Raises:
         NoDataFoundException: if this mbid doesn't exist or the offset is too high"""
 
     # in case it's a uuid
     mbid = str(mbid).lower()
-    result = load_many_low_level([(mbid, offset)])
+    result = load_many_low_level_json([(mbid, offset)])
     if not result:
         raise db.exceptions.NoDataFoundException
 
@@ -448,25 +815,107 @@ def load_many_low_level(recordings):
         }
 
     """
-    with db.engine.connect() as connection:
-        query = text("""
-            SELECT ll.gid::text,
-                   ll.submission_offset::text,
-                   llj.data
-              FROM lowlevel ll
-              JOIN lowlevel_json llj
-                ON ll.id = llj.id
-             WHERE (ll.gid, ll.submission_offset) 
-                IN :recordings
-        """)
+    return {mbid: {offset: json.loads(document) for offset, document in documents.items()}
+            for mbid, documents in load_many_low_level_json(recordings).items()}
 
-        result = connection.execute(query, {'recordings': tuple(recordings)})
 
-        recordings_info = defaultdict(dict)
-        for row in result:
-            recordings_info[row['gid']][row['submission_offset']] = row['data']
+def load_many_low_level_json(recordings):
+    """Collect low-level data for multiple recordings as serialized JSON,
+    without parsing it. The returned data has the same form as
+    `load_many_low_level`, but each lowlevel_data is a JSON string.
 
-        return dict(recordings_info)
+    Documents are read from the document cache if they are in it, and
+    documents which are loaded from the database are added to the cache.
+    """
+    recordings_info = defaultdict(dict)
+    for mbid, offset, document in iter_many_low_level_json(recordings, batch_size=max(len(recordings), 1)):
+        recordings_info[mbid][str(offset)] = document
+    return dict(recordings_info)
+
+
+def iter_many_low_level_json(recordings, batch_size=LOWLEVEL_STREAM_BATCH_SIZE):
+    """Generate the low-level data of multiple recordings as serialized JSON,
+    one recording at a time.
+
+    Recordings are generated in order of (mbid, offset), so that all offsets of
+    an mbid are generated together. Recordings which aren't in the database are
+    skipped. The recordings which are in the document cache are found first,
+    and the others are read from the database with a single server-side
+    cursor, so that only one document which isn't in the cache is held in
+    memory at a time.
+
+    Args:
+        recordings: A list of tuples (mbid, offset).
+        batch_size: the number of recordings to look up in the document cache
+          at a time. Documents of a batch which are in the cache are held in
+          memory until they are generated, and documents of a batch which are
+          read from the database are added to the cache together.
+
+    Returns:
+        a generator of (mbid, offset, lowlevel_data) tuples, where lowlevel_data
+        is a JSON string. mbids are normalised (lower-case, with hyphens).
+    """
+    namespace = db.document_cache.LOWLEVEL_CACHE_NAMESPACE
+    # mbids are compared with the rows from the database, which are normalised
+    recordings = sorted(set((str(uuid.UUID(str(mbid))), int(offset)) for mbid, offset in recordings))
+    if not recordings:
+        return
+    batches = list(chunks(recordings, batch_size))
+    cached = set()
+    # The cached documents of the first batch are kept, so that they aren't read twice
+    first_batch_documents = {}
+    for i, batch in enumerate(batches):
+        documents = db.document_cache.get_many(namespace, batch)
+        cached.update(documents)
+        if i == 0:
+            first_batch_documents = documents
+
+    with db.engine.connect() as connection:
+        rows = _iter_low_level_json_from_db(connection, [recording for recording in recordings
+                                                         if recording not in cached])
+        row = next(rows, None)
+        for i, batch in enumerate(batches):
+            if i == 0:
+                documents = first_batch_documents
+            else:
+                documents = db.document_cache.get_many(namespace, [recording for recording in batch
+                                                                   if recording in cached])
+            # Documents which were removed from the cache since it was checked
+            evicted = [recording for recording in batch if recording in cached and recording not in documents]
+            to_cache = {(mbid, offset): document
+                        for mbid, offset, document in _iter_low_level_json_from_db(connection, evicted)}
+            documents.update(to_cache)
+            for recording in batch:
+                if recording in documents:
+                    yield recording[0], recording[1], documents.pop(recording)
+                elif row is not None and row[:2] == recording:
+                    to_cache[recording] = row[2]
+                    yield row
+                    row = next(rows, None)
+            db.document_cache.set_many(namespace, to_cache)
+
+
+def _iter_low_level_json_from_db(connection, recordings):
+    """Generate the (mbid, offset, lowlevel_data) of recordings which are in
+    the database, ordered by (mbid, offset), reading one row at a time."""
+    if not recordings:
+        return
+    # gid is ordered by its bytes, which is the same as the order of its
+    # normalised (lower-case) string form
+    query = text("""
+        SELECT ll.gid::text,
+               ll.submission_offset,
+               llj.data::text AS data
+          FROM lowlevel ll
+          %s
+          JOIN lowlevel_json llj
+            ON ll.id = llj.id
+      ORDER BY ll.gid, ll.submission_offset
+    """ % RECORDINGS_JOIN)
+    result = connection.execution_options(stream_results=True, max_row_buffer=1)\
+                       .execute(query, _recordings_params(recordings))
+    for row in result:
+        yield row['gid'], row['submission_offset'], row['data']
 
 
 def map_highlevel_class_names(highlevel, mapping):
@@ -514,6 +963,9 @@ def load_high_level(mbid, offset=0, map_classes=False):
 def load_many_high_level(recordings, map_classes=False):
     """Collect high-level data for multiple recordings.
 
+    Documents are read from the document cache if they are in it, and
+    documents which are loaded from the database are added to the cache.
+
     Args:
         recordings: A list of tuples (mbid, offset).
         map_classes (bool): if True, map class names to human readable values in the returned data
@@ -527,6 +979,51 @@ def load_many_high_level(recordings, map_classes=False):
         }
 
     """
+    recordings_info = defaultdict(dict)
+    cached = db.document_cache.get_many(db.document_cache.HIGHLEVEL_CACHE_NAMESPACE, recordings, int(map_classes))
+    for (mbid, offset), document in cached.items():
+        recordings_info[mbid][str(offset)] = json.loads(document)
+    recordings = [recording for recording in recordings if recording not in cached]
+    if not recordings:
+        return dict(recordings_info)
+
+    to_cache = {}
+    for mbid, documents in _load_many_high_level_from_db(recordings, map_classes).items():
+        recordings_info[mbid].update(documents)
+        for offset, document in documents.items():
+            to_cache[(mbid, int(offset))] = json.dumps(document)
+    db.document_cache.set_many(db.document_cache.HIGHLEVEL_CACHE_NAMESPACE, to_cache, int(map_classes))
+    return dict(recordings_info)
+
+
+def iter_many_high_level(recordings, map_classes=False, batch_size=HIGHLEVEL_STREAM_BATCH_SIZE):
+    """Generate the high-level data of multiple recordings, reading them in
+    batches with `load_many_high_level`.
+
+    Recordings are generated in order of (mbid, offset), so that all offsets of
+    an mbid are generated together. Recordings which aren't in the database are
+    skipped.
+
+    Args:
+        recordings: A list of tuples (mbid, offset).
+        map_classes (bool): if True, map class names to human readable values in the returned data
+        batch_size: the number of recordings to read at a time.
+
+    Returns:
+        a generator of (mbid, offset, highlevel_data) tuples.
+    """
+    recordings = sorted(set((str(mbid), int(offset)) for mbid, offset in recordings))
+    for batch in chunks(recordings, batch_size):
+        documents = load_many_high_level(batch, map_classes)
+        for mbid, offset in batch:
+            document = documents.get(mbid, {}).get(str(offset))
+            if document is not None:
+                yield mbid, offset, document
+
+
+def _load_many_high_level_from_db(recordings, map_classes):
+    """Load high-level data for multiple recordings from the database,
+    in the same form as `load_many_high_level`."""
     with db.engine.connect() as connection:
         # Metadata
         meta_query = text("""
@@ -539,11 +1036,10 @@ def load_many_high_level(recordings, map_classes=False):
                 ON hl.id = hlm.id
               JOIN lowlevel ll
                 ON ll.id = hl.id
-             WHERE (ll.gid, ll.submission_offset)
-                IN :recordings
-        """)
+              %s
+        """ % RECORDINGS_JOIN)
 
-        meta_result = connection.execute(meta_query, {'recordings': tuple(recordings)})
+        meta_result = connection.execute(meta_query, _recordings_params(recordings))
         # Return empty dictionary if no metadata is found
         if not meta_result.rowcount:
             return {}
@@ -572,11 +1068,11 @@ def load_many_high_level(recordings, map_classes=False):
                 ON version.id = hlmo.version
               JOIN lowlevel ll
                 ON ll.id = hlmo.highlevel
-             WHERE hlmo.highlevel IN :hlids
+             WHERE hlmo.highlevel = ANY(:hlids)
                AND m.status = 'show'
         """)
 
-        model_result = connection.execute(model_query, {'hlids': tuple(hlids)})
+        model_result = connection.execute(model_query, {'hlids': hlids})
         for row in model_result.fetchall():
             model = row['model']
             data = row['data']
@@ -602,8 +1098,8 @@ def load_many_individual_features(recordings, features):
         individual features, a list of tuples of the form:
             [(<feature_path>, <alias>, <default_type>), ...]
 
-            <feature_path> is a string holding the path to a feature:
-            "llj.data->feature_name"
+            <feature_path> is an expression which selects a feature from
+            the lowlevel_features table: "to_jsonb(llf.lowlevel_feature_name)"
 
             <alias> is a string alias for a feature:
             "lowlevel.feature_name"
@@ -638,8 +1134,8 @@ def build_feature_string(features):
         individual features, a list of tuples of the form:
             [(<feature_path>, <alias>, <default_type>), ...]
 
-            <feature_path> is a string holding the path to a feature:
-            "llj.data->feature_name"
+            <feature_path> is an expression which selects a feature from
+            the lowlevel_features table: "to_jsonb(llf.lowlevel_feature_name)"
 
             <alias> is a string alias for a feature:
             "lowlevel.feature_name"
@@ -656,15 +1152,17 @@ def build_feature_string(features):
 
 def bulk_get_recording_features(recordings, feature_string):
     """Get individual features for many recordings from the
-    lowlevel_json table.
+    lowlevel_features table. lowlevel_json is only read for submissions
+    which don't have a lowlevel_features row yet (see
+    :py:func:`db.lowlevel_features.get_feature_path`).
 
     Args:
         recordings: a list of tuples of the form (MBID, offset)
 
         feature_string: a string of the features that should
         be collected, with their aliases.
-            e.g. "data->'lowlevel'->'mfccs' AS mfccs,
-                  data->'lowlevel'->'gfccs' AS gfccs"
+            e.g. "to_jsonb(llf.rhythm_bpm) AS \"rhythm.bpm\",
+                  to_jsonb(llf.metadata_tags) AS \"metadata.tags\""
 
     Returns: result handle from sqlalchemy query, containing
     rows of (ll.id, ll.submission_offset, feature_1, ..., feature_n)
@@ -675,12 +1173,14 @@ def bulk_get_recording_features(recordings, feature_string):
                  , ll.submission_offset::text
                  , %(features)s
               FROM lowlevel ll
-              JOIN lowlevel_json llj
-                ON ll.id = llj.id
-             WHERE (ll.gid, ll.submission_offset)
-                IN :recordings
-        """ % {'features': feature_string})
-        result = connection.execute(query, {'recordings': tuple(recordings)})
+              %(recordings_join)s
+         LEFT JOIN lowlevel_features llf
+                ON ll.id = llf.id
+         LEFT JOIN lowlevel_json llj
+                ON llf.id IS NULL
+               AND ll.id = llj.id
+        """ % {'features': feature_string, 'recordings_join': RECORDINGS_JOIN})
+        result = connection.execute(query, _recordings_params(recordings))
         return result.fetchall()
 
 
@@ -704,8 +1204,8 @@ def parse_features_row(row, features):
         features: a list of tuples of the form:
         (<feature_path>, <alias>, <default_type>)
 
-            <feature_path> is a string holding the path to a feature:
-            "llj.data->feature_name"
+            <feature_path> is an expression which selects a feature from
+            the lowlevel_features table: "to_jsonb(llf.lowlevel_feature_name)"
 
             <alias> is a string alias for a feature:
             "lowlevel.feature_name"
@@ -852,23 +1352,23 @@ def get_ids_by_mbids(mbids):
         in the same order that they were provided.
         If an (mbid, submission_offset) pair doesn't exist in the database, None is used
         as an ID"""
+    mbid_to_id = {}
     with db.engine.connect() as connection:
         query = text("""
-            SELECT id
-                 , gid::text
-                 , submission_offset
-              FROM lowlevel
-             WHERE (gid, submission_offset) in :mbid_offsets 
-        """)
-        result = connection.execute(query, {"mbid_offsets": tuple(mbids)})
-        mbid_to_id = {}
+            SELECT ll.id
+                 , ll.gid::text
+                 , ll.submission_offset
+              FROM lowlevel ll
+              %s
+        """ % RECORDINGS_JOIN)
+        result = connection.execute(query, _recordings_params(mbids))
         for row in result.fetchall():
             mbid_to_id[(row['gid'], row['submission_offset'])] = row['id']
-        result = []
-        for mbid, offset in mbids:
-            data = (str(mbid) .lower(), offset)
-            result.append(mbid_to_id.get(data))
-        return result
+    result = []
+    for mbid, offset in mbids:
+        data = (str(mbid) .lower(), offset)
+        result.append(mbid_to_id.get(data))
+    return result
 
 
 def count_all_lowlevel():
@@ -902,10 +1402,10 @@ def count_many_lowlevel(mbids):
             """SELECT gid
                     , COUNT(*)
                  FROM lowlevel
-                WHERE gid IN :mbids
+                WHERE gid = ANY(CAST(:mbids AS uuid[]))
              GROUP BY gid""")
         return {str(mbid): {"count": int(count)} for mbid, count
-                in connection.execute(query, {"mbids": tuple(mbids)})}
+                in connection.execute(query, {"mbids": [str(mbid) for mbid in mbids]})}
 
 
 def get_unprocessed_highlevel_documents_for_model(highlevel_model, within=None):
@@ -939,38 +1439,34 @@ def get_unprocessed_highlevel_documents_for_model(highlevel_model, within=None):
         return docs
 
 
-def get_unprocessed_highlevel_documents(limit=100, id_from=0):
-    """Fetch up to 100 low-level documents which have no associated high level data.
+def claim_unprocessed_highlevel_documents(worker, limit=100, id_from=0, lease_duration=HIGHLEVEL_LEASE_DURATION):
+    """Fetch low-level documents which have no associated high level data, and
+    reserve them so that other extractors running at the same time don't fetch them.
 
-    Arguments:
+    Each document is reserved with a lease in the highlevel_lease table, which is
+    removed when its highlevel data is written (see :py:func:`write_many_high_level`).
+    If an extractor stops before it writes the data (e.g. because it crashed), the
+    documents can be claimed again once their leases expire.
+
+    Args:
+        worker: a name of the extractor which claims the documents, for monitoring
         limit: Retrieve up to this many low-level documents
-        id_from: Select only low-level documents whose id is greater than this value
+        id_from: Select only low-level documents whose id is greater than this value.
+          Every submission with a lower id has to be checked for high level data
+          otherwise, so callers should pass the highest id they have claimed and
+          only start from 0 again to find leases which may have expired
+        lease_duration: the number of seconds to reserve the documents for. It
+          must be longer than it takes to compute and write their highlevel data
 
     Returns:
-        a list of tuples (rowid, mbid, lowlevel-json as text)
-
+        a list of tuples (rowid, mbid, lowlevel-json as text), ordered by rowid
     """
-    with db.engine.connect() as connection:
-        query = text(
-            """SELECT ll.id
-                    , ll.gid::text
-                    , llj.data::text
-                 FROM lowlevel AS ll
-                 JOIN lowlevel_json AS llj
-                   ON llj.id = ll.id
-                WHERE ll.id IN (
-                        SELECT ll.id
-                          FROM lowlevel AS ll
-                     LEFT JOIN highlevel AS hl
-                            ON ll.id = hl.id
-                         WHERE hl.mbid IS NULL
-                           AND ll.id > :id_from
-                      ORDER BY ll.id
-                         LIMIT :limit
-                )""")
-        result = connection.execute(query, {"id_from": id_from, "limit": limit})
-        docs = result.fetchall()
-        return docs
+    with db.engine.begin() as connection:
+        result = connection.execute(CLAIM_HIGHLEVEL_QUERY, {"worker": worker,
+                                                            "limit": limit,
+                                                            "id_from": id_from,
+                                                            "lease_duration": lease_duration})
+        return result.fetchall()
 
 
 def get_summary_data(mbid, offset=0):
@@ -0,0 +1,76 @@
+"""Read-through cache of low-level and high-level documents.
+
+Documents are stored in the cache as serialized JSON, keyed on the
+(mbid, offset) of their submission. Low-level documents can't change once
+they have been submitted. High-level documents are removed from the cache
+when new models are written for a submission, and the high-level namespace
+is invalidated when the models that are shown change. Changes made to the
+model table by hand, such as the class mappings in admin/sql/create_models.sql,
+are only seen once the cache is cleared with `manage.py clear_cache`.
+"""
+from brainzutils import cache
+
+DOCUMENT_CACHE_TIMEOUT = 60 * 60 * 24  # 1 day
+
+LOWLEVEL_CACHE_NAMESPACE = "lowlevel"
+HIGHLEVEL_CACHE_NAMESPACE = "highlevel"
+
+
+def _get_key(mbid, offset, *attributes):
+    return ":".join([str(mbid), str(offset)] + [str(attribute) for attribute in attributes])
+
+
+def get_many(namespace, recordings, *attributes):
+    """Get the cached documents for a list of recordings.
+
+    Args:
+        namespace: the cache namespace of the documents.
+        recordings: a list of (mbid, offset) tuples.
+        attributes: additional parts of the key of each document, which
+        identify different versions of the same document.
+
+    Returns:
+        a dictionary {(mbid, offset): serialized JSON} of the recordings
+        which are in the cache. Documents are decoded to unicode strings.
+    """
+    if not recordings:
+        return {}
+    keys = {_get_key(mbid, offset, *attributes): (mbid, offset) for mbid, offset in recordings}
+    documents = cache.get_many(list(keys), namespace=namespace, decode=False)
+    return {keys[key]: document.decode("utf-8") for key, document in documents.items() if document is not None}
+
+
+def set_many(namespace, documents, *attributes):
+    """Add documents to the cache.
+
+    Args:
+        namespace: the cache namespace of the documents.
+        documents: a dictionary {(mbid, offset): serialized JSON}.
+        attributes: additional parts of the key of each document.
+    """
+    if not documents:
+        return
+    cache.set_many({_get_key(mbid, offset, *attributes): document
+                    for (mbid, offset), document in documents.items()},
+                   time=DOCUMENT_CACHE_TIMEOUT, namespace=namespace, encode=False)
+
+
+def delete_many(namespace, recordings, attributes_list=((),)):
+    """Remove documents from the cache.
+
+    Args:
+        namespace: the cache namespace of the documents.
+        recordings: a list of (mbid, offset) tuples.
+        attributes_list: a list of the additional key parts of each
+        version of the documents which should be removed.
+    """
+    keys = [_get_key(mbid, offset, *attributes)
+            for mbid, offset in recordings
+            for attributes in attributes_list]
+    if keys:
+        cache.delete_many(keys, namespace=namespace)
+
+
+def invalidate(namespace):
+    """Remove all documents in a namespace from the cache."""
+    cache.invalidate_namespace(namespace)
@@ -0,0 +1,121 @@
+"""Features of low-level documents which can be selected individually.
+
+Each of these features is copied from lowlevel_json.data into a typed column
+of the lowlevel_features table when a document is submitted (see
+db.data.write_low_level), so that they can
+be read without reading (and decompressing) the whole document. Submissions
+which were made before the table was added are copied with `backfill`. Until
+then, their features are extracted from lowlevel_json when they are read.
+"""
+from sqlalchemy import text
+
+import db
+
+# Number of lowlevel ids to read at a time when backfilling the table
+BACKFILL_BATCH_SIZE = 10000
+
+FEATURE_TYPE_NUMBER = "number"
+FEATURE_TYPE_STRING = "string"
+FEATURE_TYPE_OBJECT = "object"
+
+# (alias, type) of each feature in the lowlevel_features table. The alias is the
+# path of the feature in the low-level document, and its column is the alias
+# with dots replaced by underscores (see get_column).
+FEATURES = [
+    ("lowlevel.average_loudness", FEATURE_TYPE_NUMBER),
+    ("lowlevel.dynamic_complexity", FEATURE_TYPE_NUMBER),
+    ("metadata.audio_properties.replay_gain", FEATURE_TYPE_NUMBER),
+    ("metadata.tags", FEATURE_TYPE_OBJECT),
+    ("metadata.version", FEATURE_TYPE_OBJECT),
+    ("metadata.audio_properties", FEATURE_TYPE_OBJECT),
+    ("rhythm.beats_count", FEATURE_TYPE_NUMBER),
+    ("rhythm.beats_loudness.mean", FEATURE_TYPE_NUMBER),
+    ("rhythm.bpm", FEATURE_TYPE_NUMBER),
+    ("rhythm.bpm_histogram_first_peak_bpm.mean", FEATURE_TYPE_NUMBER),
+    ("rhythm.bpm_histogram_second_peak_bpm.mean", FEATURE_TYPE_NUMBER),
+    ("rhythm.danceability", FEATURE_TYPE_NUMBER),
+    ("rhythm.onset_rate", FEATURE_TYPE_NUMBER),
+    ("tonal.chords_key", FEATURE_TYPE_STRING),
+    ("tonal.chords_scale", FEATURE_TYPE_STRING),
+    ("tonal.chords_changes_rate", FEATURE_TYPE_NUMBER),
+    ("tonal.key_key", FEATURE_TYPE_STRING),
+    ("tonal.key_scale", FEATURE_TYPE_STRING),
+    ("tonal.key_strength", FEATURE_TYPE_NUMBER),
+    ("tonal.tuning_frequency", FEATURE_TYPE_NUMBER),
+    ("tonal.tuning_equal_tempered_deviation", FEATURE_TYPE_NUMBER),
+]
+
+
+_FEATURE_TYPES = dict(FEATURES)
+
+
+def get_column(alias):
+    """Get the column of the lowlevel_features table for a feature."""
+    return alias.replace(".", "_")
+
+
+def get_feature_path(alias):
+    """Get an expression which selects a feature as JSON from the
+    lowlevel_features table (as llf), for use as the <feature_path>
+    of :py:func:`db.data.load_many_individual_features`. If a submission
+    has no lowlevel_features row yet, the feature is extracted from
+    lowlevel_json.data (as llj) instead."""
+    return "to_jsonb(CASE WHEN llf.id IS NULL THEN %s ELSE llf.%s END)" % (
+        _get_extract_expression(alias, _FEATURE_TYPES[alias]), get_column(alias))
+
+
+def _get_extract_expression(alias, feature_type):
+    """Get an expression which extracts a feature from lowlevel_json.data
+    (as llj) with the type of its column. Values of a different type are NULL."""
+    path = "'{%s}'" % ",".join(alias.split("."))
+    if feature_type == FEATURE_TYPE_NUMBER:
+        return "CASE WHEN jsonb_typeof(llj.data #> %s) = 'number' THEN (llj.data #>> %s)::numeric END" % (path, path)
+    elif feature_type == FEATURE_TYPE_STRING:
+        return "CASE WHEN jsonb_typeof(llj.data #> %s) = 'string' THEN llj.data #>> %s END" % (path, path)
+    return "llj.data #> %s" % path
+
+
+def get_insert_sql(source, condition):
+    """Get an INSERT statement which copies the features of the documents in
+    `source` which match a condition into the lowlevel_features table.
+
+    Args:
+        source: a FROM item with the columns id and data (the lowlevel.id
+          and the low-level document of submissions), aliased as llj.
+        condition: an SQL condition on the rows of `source`.
+    """
+    return """
+        INSERT INTO lowlevel_features (id, %(columns)s)
+             SELECT llj.id, %(expressions)s
+               FROM %(source)s
+              WHERE %(condition)s
+        ON CONFLICT (id) DO NOTHING
+    """ % {"columns": ", ".join(get_column(alias) for alias, _ in FEATURES),
+           "expressions": ", ".join(_get_extract_expression(alias, feature_type) for alias, feature_type in FEATURES),
+           "source": source,
+           "condition": condition}
+
+
+def _get_insert_query(condition):
+    """Get a query which copies the features of the lowlevel_json rows
+    which match a condition into the lowlevel_features table."""
+    return text(get_insert_sql("lowlevel_json llj", condition))
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """Copy the features of all submissions which aren't in the
+    lowlevel_features table yet, committing after each batch of ids.
+
+    Returns:
+        the number of submissions which were added.
+    """
+    with db.engine.connect() as connection:
+        max_id = connection.execute("SELECT MAX(id) FROM lowlevel_json").fetchone()[0] or 0
+
+    query = _get_insert_query("llj.id > :min_id AND llj.id <= :max_id")
+    num_added = 0
+    for min_id in range(0, max_id, batch_size):
+        with db.engine.begin() as connection:
+            result = connection.execute(query, {"min_id": min_id, "max_id": min_id + batch_size})
+            num_added += result.rowcount
+    return num_added
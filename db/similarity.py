@@ -4,14 +4,22 @@ from flask import current_app
 import db
 from db.data import count_all_lowlevel
 import db.exceptions
+import similarity.id_map
 import similarity.metrics
 import similarity.utils
 from utils.list_utils import chunks
+import io
 import json
+import multiprocessing
+import threading
 
 from sqlalchemy import text
 from collections import defaultdict
 
+# Number of batches per worker process which add_metrics fetches ahead of writing
+ADD_METRICS_QUEUE_FACTOR = 2
+
+
 def get_all_metrics():
     """Get name, category, and description for each of the metrics
     in the similarity.similarity_metrics table.
@@ -69,9 +77,68 @@ def get_similarity_ids():
         return [r['id'] for r in result.fetchall()]
 
 
+def get_similarity_recordings(max_id):
+    """Gets the (MBID, offset) of every recording in the similarity table
+    up to an id.
+
+    Args:
+        max_id (int): get only recordings with an id less than or equal
+        to this, so that rows which are added to the table while the
+        recordings are read can be left out.
+
+    Returns: a generator of (id, gid, submission_offset) tuples for each
+    id in the similarity table, in ascending order of id."""
+    with db.engine.connect() as connection:
+        query = text("""
+            SELECT ll.id
+                 , ll.gid::text
+                 , ll.submission_offset
+              FROM lowlevel ll
+              JOIN similarity.similarity s
+                ON ll.id = s.id
+             WHERE ll.id <= :max_id
+          ORDER BY ll.id
+        """)
+        result = connection.execution_options(stream_results=True).execute(query, {"max_id": max_id})
+        for row in result:
+            yield row['id'], row['gid'], row['submission_offset']
+
+
+def get_similarity_delta(metric_name, min_id, limit):
+    """Gets vectors for a metric for the recordings which were added to the
+    similarity table after a given id, along with their (MBID, offset).
+
+    Args:
+        metric_name (str): name of the metric to get vectors for.
+        min_id (int): get only rows with an id greater than this.
+        limit (int): the maximum number of rows to get.
+
+    Returns: a list of (id, vector, gid, submission_offset) tuples in
+    ascending order of id.
+    """
+    if metric_name not in similarity.metrics.BASE_METRICS:
+        raise db.exceptions.NoDataFoundException("No existing metric named \"{}\"".format(metric_name))
+    with db.engine.connect() as connection:
+        query = text("""
+            SELECT s.id
+                 , s.{metric}
+                 , ll.gid::text
+                 , ll.submission_offset
+              FROM similarity.similarity s
+              JOIN lowlevel ll
+                ON ll.id = s.id
+             WHERE s.id > :min_id
+          ORDER BY s.id
+             LIMIT :limit
+        """.format(metric=metric_name))
+        result = connection.execute(query, {"min_id": min_id, "limit": limit})
+        return [(row["id"], row[metric_name], row["gid"], row["submission_offset"]) for row in result.fetchall()]
+
+
 def add_index(index, num_ids, ids, batch_size):
     """Incrementally adds all items to an index, then builds
-    and saves the index. *Note*: index must already be initialized.
+    and saves the index along with a map of its ids to (MBID, offset).
+    *Note*: index must already be initialized.
 
     Args:
         indices: an initialized Annoy index.
@@ -84,12 +151,18 @@ def add_index(index, num_ids, ids, batch_size):
 
         batch_size (int): the size of each batch of recording
         vectors being added in each increment.
+
+    Raises:
+        NoDataFoundException: if ``ids`` is empty.
     """
+    if not ids:
+        raise db.exceptions.NoDataFoundException("There are no recordings to add to the index.")
     num_added = 0
 
-    # Fill empty rows in the database with placeholders
-    # of the form [0, ..., 0]
-    index = similarity.index_utils.add_empty_rows(index, ids)
+    # Ids which are missing from the similarity table are left out of the
+    # index unless they should be filled with placeholders
+    if current_app.config.get('SIMILARITY_FILL_EMPTY_ROWS', False):
+        index = similarity.index_utils.add_empty_rows(index, ids)
 
     with db.engine.connect() as connection:
         batch_query = text("""
@@ -110,12 +183,102 @@ def add_index(index, num_ids, ids, batch_size):
             num_added += len(sub_ids)
             current_app.logger.info("Items added: {}/{} ({:.3f}%)".format(num_added, num_ids, float(num_added) / num_ids * 100))
 
-        current_app.logger.info("Finished adding items. Building index...")
+        current_app.logger.info("Finished adding items. Building id map...")
+        max_id = ids[-1]
+        index.id_map = similarity.id_map.RecordingIdMap.from_recordings(get_similarity_recordings(max_id), max_id)
+        current_app.logger.info("Building index...")
         index.build()
         current_app.logger.info("Saving index {}...".format(index.metric_name))
         index.save()
 
 
+def add_indices(indices, num_ids, ids, batch_size, processes=1):
+    """Adds all items to many indices while reading the similarity table
+    only once, then builds and saves the indices in parallel.
+
+    Each row of the similarity table is added to every index, so all of the
+    indices must fit in memory at the same time. The indices are built in
+    `processes` worker processes, which are forked from this process and so
+    share the items that have been added without copying them.
+
+    Args:
+        indices (list): a list of initialized Annoy indices.
+
+        num_ids (int): total number of ids in the similarity.similarity
+        table.
+
+        ids (list): list of similarity.similarity.ids which should be
+        added to the indices.
+
+        batch_size (int): the size of each batch of recording
+        vectors being added in each increment.
+
+        processes (int): the number of indices to build at the same time.
+
+    Raises:
+        NoDataFoundException: if ``ids`` is empty.
+    """
+    global _indices_to_build
+    if not ids:
+        raise db.exceptions.NoDataFoundException("There are no recordings to add to the indices.")
+    num_added = 0
+    metric_names = [index.metric_name for index in indices]
+
+    if current_app.config.get('SIMILARITY_FILL_EMPTY_ROWS', False):
+        for index in indices:
+            similarity.index_utils.add_empty_rows(index, ids)
+
+    with db.engine.connect() as connection:
+        batch_query = text("""
+            SELECT id
+                 , {}
+              FROM similarity.similarity
+             WHERE id IN :ids
+          ORDER BY id
+        """.format(", ".join(metric_names)))
+
+        current_app.logger.info("Items added: {}/{} ({:.3f}%)".format(num_added, num_ids, float(num_added) / num_ids * 100))
+        for sub_ids in chunks(ids, batch_size):
+            batch_result = connection.execute(batch_query, {"ids": tuple(sub_ids)})
+            for row in batch_result:
+                for index in indices:
+                    index.add_recording_with_vector(row["id"], row[index.metric_name])
+
+            num_added += len(sub_ids)
+            current_app.logger.info("Items added: {}/{} ({:.3f}%)".format(num_added, num_ids, float(num_added) / num_ids * 100))
+
+    current_app.logger.info("Finished adding items. Building id map...")
+    max_id = ids[-1]
+    id_map = similarity.id_map.RecordingIdMap.from_recordings(get_similarity_recordings(max_id), max_id)
+    for index in indices:
+        index.id_map = id_map
+
+    current_app.logger.info("Building {} indices with {} processes...".format(len(indices), processes))
+    n_jobs = current_app.config['SIMILARITY_BUILD_NUM_JOBS']
+    location = current_app.config['SIMILARITY_INDEX_DIR']
+    # Worker processes get the indices from this module when they are forked
+    _indices_to_build = indices
+    pool = multiprocessing.Pool(processes=processes, maxtasksperchild=1)
+    try:
+        pool.map(_build_and_save_index, [(i, n_jobs, location) for i in range(len(indices))], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _indices_to_build = []
+    current_app.logger.info("Saved indices: {}".format(", ".join(metric_names)))
+
+
+# Indices being built by add_indices, which are inherited by its worker processes
+_indices_to_build = []
+
+
+def _build_and_save_index(args):
+    position, n_jobs, location = args
+    index = _indices_to_build[position]
+    index.build(n_jobs=n_jobs)
+    index.save(location=location)
+
+
 def get_metric_info(metric):
     """Gets the description and category for a given
     metric.
@@ -143,17 +306,49 @@ def get_metric_info(metric):
         return result.fetchone()
 
 
-def add_metrics(batch_size=None):
+def add_metrics(batch_size=None, use_copy=False, unlogged=False, processes=1):
+    """Computes the base metrics for each recording in the lowlevel table
+    which isn't yet in the similarity table, and inserts them.
+
+    Args:
+        batch_size (int): the number of recordings to process at a time.
+
+        use_copy (bool): insert rows with COPY rather than with INSERT
+        statements, see `copy_similarity_bulk`.
+
+        unlogged (bool): make the similarity table unlogged while rows
+        are added, and logged again afterwards. This makes inserts much
+        faster, but if the database crashes while rows are being added
+        then the similarity table will be empty when it restarts.
+
+        processes (int): the number of processes to fetch and transform
+        batches with. If greater than 1, batches are fetched and transformed
+        in parallel while they are written by this process.
+    """
     batch_size = batch_size or PROCESS_BATCH_SIZE
     lowlevel_count = count_all_lowlevel()
+    insert_rows = copy_similarity_bulk if use_copy else insert_similarity_bulk
 
-    with db.engine.connect() as connection:
-        metrics = similarity.utils.init_metrics()
+    metrics = similarity.utils.init_metrics()
+    # Collect and assign stats to metrics that require normalization
+    for metric in metrics:
+        db.similarity_stats.assign_stats(metric)
+
+    if unlogged:
+        set_similarity_logged(False)
+    try:
+        if processes > 1:
+            _add_metrics_parallel(metrics, batch_size, lowlevel_count, insert_rows, processes)
+        else:
+            _add_metrics(metrics, batch_size, lowlevel_count, insert_rows)
+    finally:
+        if unlogged:
+            current_app.logger.info("Making similarity table logged...")
+            set_similarity_logged(True)
 
-        # Collect and assign stats to metrics that require normalization
-        for metric in metrics:
-            db.similarity_stats.assign_stats(metric)
 
+def _add_metrics(metrics, batch_size, lowlevel_count, insert_rows):
+    with db.engine.connect() as connection:
         sim_count = count_similarity()
         current_app.logger.info("Processed {} / {} ({:.3f}%)".format(sim_count,
                                                                      lowlevel_count,
@@ -165,15 +360,12 @@ def add_metrics(batch_size=None):
                 result = get_batch_data(connection, max_id, batch_size)
                 if not result:
                     break
-                added_rows = 0
-                all_rows = []
-                for row in result:
-                    data = bulk_transform_data_to_similarity(row, metrics=metrics)
-                    all_rows.append(data)
-                    added_rows += 1
-                    max_id = max(max_id, row["id"])
+                rows = result.fetchall()
+                all_rows = transform_batch_to_similarity(rows, metrics=metrics)
+                added_rows = len(rows)
+                max_id = max(max_id, max(row["id"] for row in rows))
 
-                insert_similarity_bulk(connection, all_rows)
+                insert_rows(connection, all_rows)
 
             sim_count += added_rows
             current_app.logger.info("Processed {} / {} ({:.3f}%)".format(sim_count,
@@ -181,30 +373,84 @@ def add_metrics(batch_size=None):
                                                                          float(sim_count) / lowlevel_count * 100))
 
 
-def get_batch_data(connection, max_id, batch_size):
-    """Performs a query to collect highlevel models and lowlevel
-    data for a batch of `batch_size` recordings.
+def _add_metrics_parallel(metrics, batch_size, lowlevel_count, insert_rows, processes):
+    """Fetches and transforms ranges of `batch_size` lowlevel ids in a pool of
+    worker processes, and writes the results in this process as they arrive.
 
-    Args:
-        connection: a connection to the database.
-        max_id: get only items with an id greater than this
-        batch_size: the number of recordings (rows) that should
-        be collected in the query.
+    Batches are written in id order, each in its own transaction, so the
+    highest id in the similarity table is a checkpoint which an interrupted
+    run resumes from. At most ADD_METRICS_QUEUE_FACTOR batches per process
+    are fetched ahead of the writer.
+    """
+    global _metrics_to_add
+    sim_count = count_similarity()
+    current_app.logger.info("Processed {} / {} ({:.3f}%)".format(sim_count,
+                                                                 lowlevel_count,
+                                                                 float(sim_count) / lowlevel_count * 100))
+
+    start_id = get_max_similarity_id()
+    end_id = get_max_lowlevel_id()
+    id_ranges = [(min_id, min(min_id + batch_size, end_id)) for min_id in range(start_id, end_id, batch_size)]
+
+    pending = threading.Semaphore(processes * ADD_METRICS_QUEUE_FACTOR)
+    stopped = threading.Event()
+
+    def queued_id_ranges():
+        # Called by the pool's task handler thread, which blocks here
+        # until the writer has caught up.
+        for id_range in id_ranges:
+            pending.acquire()
+            if stopped.is_set():
+                return
+            yield id_range
+
+    # Worker processes get the metrics from this module when they are forked
+    _metrics_to_add = metrics
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        with db.engine.connect() as connection:
+            for all_rows in pool.imap(_get_similarity_rows, queued_id_ranges()):
+                if all_rows:
+                    with connection.begin():
+                        insert_rows(connection, all_rows)
+                pending.release()
+
+                sim_count += len(all_rows)
+                current_app.logger.info("Processed {} / {} ({:.3f}%)".format(sim_count,
+                                                                             lowlevel_count,
+                                                                             float(sim_count) / lowlevel_count * 100))
+    except BaseException:
+        # Let the task handler stop waiting for the writer before terminating the pool
+        stopped.set()
+        pending.release()
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        _metrics_to_add = []
 
-    Returns:
-        If no rows are returned by the query, i.e. there are no
-        available submissions, then None is returned.
 
-        Otherwise, the result object of the query is returned.
-    """
-    batch_query = text("""
+# Metrics used by _add_metrics_parallel, which are inherited by its worker processes
+_metrics_to_add = []
+
+
+def _get_similarity_rows(id_range):
+    min_id, max_id = id_range
+    with db.engine.connect() as connection:
+        rows = get_batch_data_in_range(connection, min_id, max_id)
+    return transform_batch_to_similarity(rows, metrics=_metrics_to_add)
+
+
+_BATCH_DATA_QUERY = """
     SELECT llj.id
      , jsonb_build_object('mfcc', llj.data->'lowlevel'->'mfcc'->'mean',
                           'gfcc', llj.data->'lowlevel'->'gfcc'->'mean',
                           'bpm', llj.data->'rhythm'->'bpm',
                           'onset_rate', llj.data->'rhythm'->'onset_rate',
-                          'key', jsonb_build_object('key_key', llj.data#>'{tonal,key_key}',
-                                                    'key_scale', llj.data#>'{tonal,key_scale}')
+                          'key', jsonb_build_object('key_key', llj.data#>'{{tonal,key_key}}',
+                                                    'key_scale', llj.data#>'{{tonal,key_scale}}')
                 ) as ll_data
       , COALESCE(jsonb_object_agg(model.model, hlm.data)
          FILTER (
@@ -214,11 +460,30 @@ def get_batch_data(connection, max_id, batch_size):
           LEFT JOIN highlevel_model AS hlm on hlm.highlevel = llj.id
           LEFT JOIN model
             ON model.id = hlm.model
-         WHERE llj.id IN (
-               SELECT id
-               FROM lowlevel where id > :max_id order by id limit :batch_size)
+         WHERE {condition}
       GROUP BY (llj.id)
-      """)
+"""
+
+
+def get_batch_data(connection, max_id, batch_size):
+    """Performs a query to collect highlevel models and lowlevel
+    data for a batch of `batch_size` recordings.
+
+    Args:
+        connection: a connection to the database.
+        max_id: get only items with an id greater than this
+        batch_size: the number of recordings (rows) that should
+        be collected in the query.
+
+    Returns:
+        If no rows are returned by the query, i.e. there are no
+        available submissions, then None is returned.
+
+        Otherwise, the result object of the query is returned.
+    """
+    batch_query = text(_BATCH_DATA_QUERY.format(condition="""llj.id IN (
+               SELECT id
+               FROM lowlevel where id > :max_id order by id limit :batch_size)"""))
 
     result = connection.execute(batch_query, {"max_id": max_id, "batch_size": batch_size})
     if not result.rowcount:
@@ -226,6 +491,24 @@ def get_batch_data(connection, max_id, batch_size):
     return result
 
 
+def get_batch_data_in_range(connection, min_id, max_id):
+    """Collect highlevel models and lowlevel data for the
+    recordings in a range of ids, in the same form as `get_batch_data`.
+
+    Args:
+        connection: a connection to the database.
+        min_id: get only items with an id greater than this.
+        max_id: get only items with an id less than or equal to this.
+
+    Returns:
+        a list of rows, which is empty if there are no submissions
+        in the range.
+    """
+    batch_query = text(_BATCH_DATA_QUERY.format(condition="llj.id > :min_id AND llj.id <= :max_id"))
+    result = connection.execute(batch_query, {"min_id": min_id, "max_id": max_id})
+    return result.fetchall()
+
+
 def insert_similarity(connection, id, vectors, metric_names):
     """Inserts a row of similarity vectors for a given lowlevel.id into
     the similarity table.
@@ -276,6 +559,66 @@ def insert_similarity_bulk(connection, data):
     connection.execute(query, data)
 
 
+def copy_similarity_bulk(connection, data):
+    """Inserts rows of similarity vectors into the similarity table using
+    COPY FROM STDIN in text format, which is much faster than INSERT
+    for large batches.
+
+        Args:
+            connection: a connection to the database.
+            data (list): a list of items to add, each item a mapping of
+            {metric names: vectors} for each metric to add
+    """
+    if not data:
+        return
+
+    metric_names = list(data[0].keys())
+    lines = []
+    for row in data:
+        values = []
+        for name in metric_names:
+            value = row[name]
+            if name == "id":
+                values.append(str(int(value)))
+            else:
+                # repr gives the shortest string which converts back to the same float
+                values.append("{" + ",".join(repr(float(v)) for v in value) + "}")
+        lines.append("\t".join(values))
+    f = io.BytesIO(("\n".join(lines) + "\n").encode("utf-8"))
+
+    # Use the connection's cursor so that rows are copied in its transaction
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert("COPY similarity.similarity ({}) FROM STDIN".format(", ".join(metric_names)), f)
+    finally:
+        cursor.close()
+
+
+def set_similarity_logged(logged):
+    """Makes the similarity table logged or unlogged. Writes to an unlogged
+    table are not written to the WAL, but the table is emptied if the
+    database crashes, and it is not replicated.
+
+    Args:
+        logged (bool): True to make the table logged, False to make it unlogged.
+    """
+    with db.engine.begin() as connection:
+        connection.execute(text("""
+            ALTER TABLE similarity.similarity SET {}
+        """.format("LOGGED" if logged else "UNLOGGED")))
+
+
+def get_max_lowlevel_id():
+    # Get the highest id in the lowlevel table
+    with db.engine.connect() as connection:
+        query = text("""
+            SELECT coalesce(max(id), 0)
+              FROM lowlevel
+        """)
+        result = connection.execute(query)
+        return result.fetchone()[0]
+
+
 def count_similarity():
     # Get total number of submissions in similarity table
     with db.engine.connect() as connection:
@@ -377,6 +720,37 @@ def bulk_transform_data_to_similarity(row, metrics):
     return results
 
 
+def transform_batch_to_similarity(rows, metrics):
+    """Converts lowlevel and highlevel data for a batch of recordings
+    and transforms it according to each metric, returning data to be
+    inserted into the similarity table.
+
+    Each metric transforms the data of all recordings in the batch
+    at once, see ``similarity.metrics.BaseMetric.transform_batch``.
+
+    Args:
+        rows: rows generated from get_batch_data, including id, ll_data, and hl_data
+
+        metrics (list): a list of initialized metric classes, for which similarity
+        vectors should be computed.
+
+    Returns:
+        A list with a mapping of {metric names: vectors} and the id of each row.
+    """
+    results = [{'id': row['id']} for row in rows]
+    for metric in metrics:
+        if hasattr(metric, 'get_feature_data'):
+            batch = [metric.get_feature_data(row['ll_data']) for row in rows]
+        else:
+            # High level metrics use models for transformation.
+            batch = [row['hl_data'] for row in rows]
+
+        vectors = metric.transform_batch(batch).tolist()
+        for result, vector in zip(results, vectors):
+            result[metric.name] = vector
+    return results
+
+
 def submit_similarity_by_mbid(mbid, offset):
     """Computes similarity metrics for a single recording specified
     by (mbid, offset) combination, then inserts the metrics as a new
@@ -1,12 +1,19 @@
 from __future__ import absolute_import
 
+import multiprocessing
+
 import db
+import db.exceptions
+import db.similarity
 import similarity.utils
+from similarity.running_stats import RunningStats
 
 from sqlalchemy import text
 import numpy as np
 
 NORMALIZATION_SAMPLE_SIZE = 10000
+# Number of lowlevel ids to read at a time when computing stats over the whole table
+STATS_BATCH_SIZE = 10000
 
 """
 Normalized metrics for determining similarity require
@@ -23,6 +30,12 @@ init command.
 We use a random sample, defaulting at 10000 items, to
 approximate these statistics for the entire lowlevel
 table before inserting them in similarity.similarity_stats.
+
+Alternatively, stats can be computed over the whole lowlevel
+table with `compute_stats_streaming`, which keeps a running
+mean and variance so that it uses constant memory. The state
+of the running stats is saved with them, so that they can be
+updated with new submissions using `update_stats`.
 """
 
 
@@ -59,6 +72,166 @@ def compute_stats(sample_size, force=False):
     insert_similarity_stats(metric_names, means, stddevs)
 
 
+def _get_stats_metrics():
+    """Get the names and feature paths of the metrics which require stats."""
+    metric_names = []
+    features = []
+    for metric in similarity.utils.init_metrics():
+        if hasattr(metric, 'means') and hasattr(metric, 'stddevs'):
+            metric_names.append(metric.name)
+            features.append(metric.path)
+    return metric_names, features
+
+
+def compute_stats_streaming(batch_size=STATS_BATCH_SIZE, processes=1):
+    """Compute mean and stddev for each of the features required by
+    similarity metrics over every submission in the lowlevel table,
+    replacing any existing stats.
+
+    Args:
+        batch_size: the number of lowlevel ids to read at a time.
+        processes: the number of ranges of ids to read at the same time.
+    """
+    metric_names, features = _get_stats_metrics()
+    stats = [RunningStats() for _ in features]
+    max_id = _update_running_stats(stats, features, 0, batch_size, processes)
+    if not stats[0].count:
+        raise db.exceptions.NoDataFoundException('Statistics cannot be calculated without lowlevel submissions.')
+    save_running_stats(metric_names, stats, max_id)
+
+
+def update_stats(batch_size=STATS_BATCH_SIZE, processes=1):
+    """Update stats which were computed by `compute_stats_streaming`
+    with the submissions which have been added since.
+
+    *NOTE*: Rows which are already in the similarity table are not
+    normalized again with the updated stats.
+
+    Args:
+        batch_size: the number of lowlevel ids to read at a time.
+        processes: the number of ranges of ids to read at the same time.
+    """
+    metric_names, features = _get_stats_metrics()
+    stats, min_id = get_running_stats(metric_names)
+    max_id = _update_running_stats(stats, features, min_id, batch_size, processes)
+    save_running_stats(metric_names, stats, max_id)
+
+
+def _update_running_stats(stats, features, min_id, batch_size, processes):
+    """Add the features of submissions with an id greater than `min_id`
+    to running stats, reading ranges of ids in `processes` processes.
+
+    Returns:
+        The highest lowlevel id which has been added to the stats.
+    """
+    max_id = db.similarity.get_max_lowlevel_id()
+    id_ranges = [(start_id, min(start_id + batch_size, max_id), features)
+                 for start_id in range(min_id, max_id, batch_size)]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            range_stats = pool.imap_unordered(_get_stats_in_range, id_ranges)
+            for partial_stats in range_stats:
+                for feature_stats, partial in zip(stats, partial_stats):
+                    feature_stats.merge(partial)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for id_range in id_ranges:
+            for feature_stats, partial in zip(stats, _get_stats_in_range(id_range)):
+                feature_stats.merge(partial)
+    return max(min_id, max_id)
+
+
+def _get_stats_in_range(id_range):
+    """Compute stats for each feature over a range of lowlevel ids.
+
+    Args:
+        id_range: a tuple (min_id, max_id, features), to read
+        ids greater than min_id and up to and including max_id.
+
+    Returns:
+        A RunningStats for each feature.
+    """
+    min_id, max_id, features = id_range
+    with db.engine.connect() as connection:
+        query = text("""
+            SELECT %(features)s
+              FROM lowlevel_json
+             WHERE id > :min_id
+               AND id <= :max_id
+        """ % {"features": ', '.join(features)})
+        rows = connection.execute(query, {"min_id": min_id, "max_id": max_id}).fetchall()
+
+    stats = []
+    for i in range(len(features)):
+        vectors = [row[i] for row in rows if row[i]]
+        stats.append(RunningStats().update(vectors))
+    return stats
+
+
+def get_running_stats(metric_names):
+    """Get the state of the running stats which were saved for
+    each metric by `compute_stats_streaming`.
+
+    Returns:
+        A tuple (<stats>, <max_id>), where <stats> is a RunningStats for
+        each metric and <max_id> is the highest lowlevel id which has been
+        added to them.
+
+    Raises:
+        NoDataFoundException: if running stats have not been saved for a metric.
+    """
+    with db.engine.connect() as connection:
+        query = text("""
+            SELECT metric, num_items, means, m2, max_id
+              FROM similarity.similarity_stats
+             WHERE metric IN :metrics
+               AND num_items IS NOT NULL
+        """)
+        result = connection.execute(query, {"metrics": tuple(metric_names)})
+        rows = {row["metric"]: row for row in result.fetchall()}
+
+    stats = []
+    max_ids = []
+    for name in metric_names:
+        if name not in rows:
+            raise db.exceptions.NoDataFoundException("Running stats have not been calculated for metric {}".format(name))
+        row = rows[name]
+        stats.append(RunningStats(row["num_items"], row["means"], row["m2"]))
+        max_ids.append(row["max_id"])
+    return stats, min(max_ids)
+
+
+def save_running_stats(metric_names, stats, max_id):
+    """Insert or replace the mean and stddev of each metric, along with
+    the state of the running stats which they were computed from.
+
+    Args:
+        metric_names: a list of metric names.
+        stats: a RunningStats for each metric.
+        max_id: the highest lowlevel id which has been added to the stats.
+    """
+    with db.engine.begin() as connection:
+        query = text("""
+            INSERT INTO similarity.similarity_stats (metric, means, stddevs, num_items, m2, max_id)
+                 VALUES (:metric, :means, :stddevs, :num_items, :m2, :max_id)
+            ON CONFLICT (metric)
+              DO UPDATE SET means = EXCLUDED.means
+                          , stddevs = EXCLUDED.stddevs
+                          , num_items = EXCLUDED.num_items
+                          , m2 = EXCLUDED.m2
+                          , max_id = EXCLUDED.max_id
+        """)
+        connection.execute(query, [{"metric": name,
+                                    "means": feature_stats.mean.tolist(),
+                                    "stddevs": feature_stats.stddev.tolist(),
+                                    "num_items": feature_stats.count,
+                                    "m2": feature_stats.m2.tolist(),
+                                    "max_id": max_id} for name, feature_stats in zip(metric_names, stats)])
+
+
 def get_random_sample_lowlevel(sample_size, features):
     """Collects a random sample for select lowlevel features.
 
@@ -0,0 +1,80 @@
+from __future__ import print_function
+
+import os
+import unittest
+
+from sqlalchemy import text
+
+import db
+import db.data
+from webserver.testing import AcousticbrainzTestCase
+
+# Number of submissions in the lowlevel table while benchmarking
+NUM_SUBMISSIONS = 20000
+# Numbers of (gid, submission_offset) pairs to look up
+BENCHMARK_SIZES = [1, 25, 1000, 10000]
+
+IN_LIST_QUERY = """
+    SELECT ll.id
+      FROM lowlevel ll
+     WHERE (ll.gid, ll.submission_offset)
+        IN :recordings
+"""
+
+UNNEST_QUERY = """
+    SELECT ll.id
+      FROM lowlevel ll
+      %s
+""" % db.data.RECORDINGS_JOIN
+
+
+class BulkQueryBenchmarkTestCase(AcousticbrainzTestCase):
+    """Compares looking up many recordings with a row-value IN list and with
+    a join on unnest of arrays of gids and offsets (db.data.RECORDINGS_JOIN).
+
+    The benchmark is only run if the environment variable AB_RUN_BENCHMARKS is set.
+    """
+
+    def setUp(self):
+        super(BulkQueryBenchmarkTestCase, self).setUp()
+        with db.engine.begin() as connection:
+            # Two submissions of each of NUM_SUBMISSIONS / 2 mbids
+            connection.execute(text("""
+                INSERT INTO lowlevel (gid, build_sha1, gid_type, submission_offset)
+                     SELECT md5((i / 2)::text)::uuid, 'sha1', 'mbid', i % 2
+                       FROM generate_series(0, :num_submissions - 1) AS i
+            """), {"num_submissions": NUM_SUBMISSIONS})
+            connection.execute("ANALYZE lowlevel")
+            result = connection.execute(text("""
+                SELECT gid::text, submission_offset
+                  FROM lowlevel
+              ORDER BY random()
+            """))
+            self.recordings = [(row["gid"], row["submission_offset"]) for row in result]
+
+    def _explain(self, query, params):
+        """Get the planning and execution time of a query in milliseconds."""
+        with db.engine.connect() as connection:
+            result = connection.execute(text("EXPLAIN (ANALYZE, FORMAT JSON) " + query), params)
+            plan = result.fetchone()[0][0]
+            return plan["Planning Time"], plan["Execution Time"]
+
+    def test_same_results(self):
+        recordings = self.recordings[:25] + [("ffcc4249-28bb-4c91-9195-a60b21d4fb94", 0)]
+        with db.engine.connect() as connection:
+            in_list_ids = {row["id"] for row in
+                           connection.execute(text(IN_LIST_QUERY), {"recordings": tuple(recordings)})}
+            unnest_ids = {row["id"] for row in
+                          connection.execute(text(UNNEST_QUERY), db.data._recordings_params(recordings))}
+        self.assertEqual(25, len(unnest_ids))
+        self.assertEqual(in_list_ids, unnest_ids)
+
+    @unittest.skipUnless(os.environ.get("AB_RUN_BENCHMARKS"), "AB_RUN_BENCHMARKS is not set")
+    def test_benchmark(self):
+        print("\n{:>6}  {:>22}  {:>22}".format("keys", "IN list plan/exec ms", "unnest plan/exec ms"))
+        for size in BENCHMARK_SIZES:
+            recordings = self.recordings[:size]
+            in_list = self._explain(IN_LIST_QUERY, {"recordings": tuple(recordings)})
+            unnest = self._explain(UNNEST_QUERY, db.data._recordings_params(recordings))
+            print("{:>6}  {:>10.2f} /{:>10.2f}  {:>10.2f} /{:>10.2f}".format(size, in_list[0], in_list[1],
+                                                                            unnest[0], unnest[1]))
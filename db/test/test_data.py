@@ -6,6 +6,7 @@ import mock
 import sqlalchemy
 
 import db.data
+import db.document_cache
 import db.exceptions
 from webserver.testing import AcousticbrainzTestCase, DB_TEST_DATA_PATH, gid_types
 import similarity.metrics
@@ -108,6 +109,79 @@ class DataDBTestCase(AcousticbrainzTestCase):
         db.data.write_low_level(self.test_mbid, one, gid_types.GID_TYPE_MBID)
         self.assertEqual(one, db.data.load_low_level(self.test_mbid))
 
+    def test_write_low_level_duplicate(self):
+        """Submitting the same data twice saves it once"""
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        self.assertEqual(1, db.data.count_lowlevel(self.test_mbid))
+
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        self.assertEqual(2, db.data.count_lowlevel(self.test_mbid))
+        self.assertEqual(self.test_lowlevel_data_two, db.data.load_low_level(self.test_mbid, offset=1))
+
+    @mock.patch("db.data.insert_version")
+    @mock.patch("db.engine")
+    def test_write_low_level_offset_taken(self, engine, insert_version):
+        """A submission is retried if a concurrent submission took its offset"""
+        def integrity_error(constraint_name):
+            orig = mock.Mock()
+            orig.diag.constraint_name = constraint_name
+            return sqlalchemy.exc.IntegrityError("INSERT", {}, orig)
+
+        connection = engine.begin.return_value.__enter__.return_value
+        connection.execute.side_effect = [integrity_error("gid_submission_offset_ndx_lowlevel"),
+                                          mock.Mock(**{"fetchone.return_value": (1,)})]
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        self.assertEqual(2, connection.execute.call_count)
+
+        # The same data was saved by a concurrent submission
+        connection.execute.reset_mock()
+        connection.execute.side_effect = [integrity_error("data_sha256_ndx_lowlevel_json")]
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        self.assertEqual(1, connection.execute.call_count)
+
+        # Other constraints and too many retries are errors
+        connection.execute.side_effect = [integrity_error("lowlevel_json_fkey_version")]
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        connection.execute.side_effect = [integrity_error("gid_submission_offset_ndx_lowlevel")
+                                          for _ in range(db.data.LOWLEVEL_WRITE_ATTEMPTS)]
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+
+    def test_write_many_low_level(self):
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        second_data = copy.deepcopy(self.test_lowlevel_data)
+        second_data["metadata"]["tags"]["album"] = ["Another album"]
+
+        saved = db.data.write_many_low_level([
+            (self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID),
+            (self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID),
+            (self.test_mbid, second_data, gid_types.GID_TYPE_MBID),
+            (self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID),
+        ])
+        self.assertEqual([False, True, True, False], saved)
+        self.assertEqual(second_data, db.data.load_low_level(self.test_mbid, offset=1))
+        self.assertEqual(self.test_lowlevel_data_two, db.data.load_low_level(self.test_mbid_two, offset=0))
+        with db.engine.connect() as connection:
+            result = connection.execute("SELECT COUNT(*) FROM lowlevel_features")
+            self.assertEqual(3, result.fetchone()[0])
+
+        self.assertEqual([], db.data.write_many_low_level([]))
+
+    def test_submit_many_low_level_data_invalid(self):
+        """Documents which can't be stored don't stop the others from being saved"""
+        invalid = {"data": u"\uc544\uc774\uc720 (IU)\udc93",
+                   "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        with mock.patch("db.data._prepare_low_level_data", side_effect=lambda mbid, data: data):
+            statuses = db.data.submit_many_low_level_data([(self.test_mbid, invalid),
+                                                           (self.test_mbid_two, self.test_lowlevel_data_two)],
+                                                          gid_types.GID_TYPE_MBID)
+        self.assertEqual([(db.data.SUBMISSION_STATUS_INVALID, "data is badly formed"),
+                          (db.data.SUBMISSION_STATUS_SAVED, None)], statuses)
+        self.assertEqual(0, db.data.count_lowlevel(self.test_mbid))
+        self.assertEqual(1, db.data.count_lowlevel(self.test_mbid_two))
+
     def test_write_lowlevel_invalid_data(self):
         """Trying to submit data with invalid utf8 sequences raises an error"""
         one = {"data": u"\uc544\uc774\uc720 (IU)\udc93",
@@ -214,6 +288,98 @@ class DataDBTestCase(AcousticbrainzTestCase):
 
         self.assertEqual(ll_expected, db.data.load_many_low_level(list(recordings)))
 
+    def test_load_many_low_level_cache(self):
+        """Documents are loaded from the cache once they have been loaded from the database"""
+        one = {"data": "one",
+               "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        db.data.write_low_level(self.test_mbid, one, gid_types.GID_TYPE_MBID)
+        self.assertEqual({self.test_mbid: {'0': one}}, db.data.load_many_low_level([(self.test_mbid, 0)]))
+
+        with db.engine.begin() as connection:
+            connection.execute("""UPDATE lowlevel_json SET data = '{"data": "changed"}'""")
+        self.assertEqual({self.test_mbid: {'0': one}}, db.data.load_many_low_level([(self.test_mbid, 0)]))
+
+        # Cached and uncached documents for the same mbid are combined
+        two = {"data": "two",
+               "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        db.data.write_low_level(self.test_mbid, two, gid_types.GID_TYPE_MBID)
+        self.assertEqual({self.test_mbid: {'0': one, '1': two}},
+                         db.data.load_many_low_level([(self.test_mbid, 0), (self.test_mbid, 1)]))
+
+    def test_iter_many_low_level_json(self):
+        """Documents are generated in order of (mbid, offset), combining cached and uncached documents"""
+        one = {"data": "one",
+               "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        two = {"data": "two",
+               "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        three = {"data": "three",
+                 "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        db.data.write_low_level(self.test_mbid, one, gid_types.GID_TYPE_MBID)
+        db.data.write_low_level(self.test_mbid, two, gid_types.GID_TYPE_MBID)
+        db.data.write_low_level(self.test_mbid_two, three, gid_types.GID_TYPE_MBID)
+
+        recordings = [(self.test_mbid_two, 0), (self.test_mbid, 1), (self.test_mbid, 0),
+                      ('ffcc4249-28bb-4c91-9195-a60b21d4fb94', 0)]
+        expected = sorted([(self.test_mbid, 0, one), (self.test_mbid, 1, two), (self.test_mbid_two, 0, three)])
+        for batch_size in [1, 2, 10]:
+            # Only the second submission is in the cache
+            db.document_cache.invalidate(db.document_cache.LOWLEVEL_CACHE_NAMESPACE)
+            db.data.load_many_low_level([(self.test_mbid, 1)])
+            documents = [(mbid, offset, json.loads(document)) for mbid, offset, document
+                         in db.data.iter_many_low_level_json(recordings, batch_size=batch_size)]
+            self.assertEqual(expected, documents)
+
+        # An upper-case mbid is generated in its normalised form, followed by the other recordings
+        recordings = [(self.test_mbid.upper(), 0), (self.test_mbid_two, 0)]
+        documents = [(mbid, offset, json.loads(document)) for mbid, offset, document
+                     in db.data.iter_many_low_level_json(recordings)]
+        self.assertEqual([(self.test_mbid, 0, one), (self.test_mbid_two, 0, three)], documents)
+
+    def test_iter_many_low_level_json_batches(self):
+        """Uncached documents are read with one connection and added to the cache once per batch.
+        A document which is removed from the cache while the documents are generated is read from the database"""
+        documents = [{"data": str(i),
+                      "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+                     for i in range(4)]
+        for document in documents:
+            db.data.write_low_level(self.test_mbid, document, gid_types.GID_TYPE_MBID)
+        db.data.load_many_low_level([(self.test_mbid, 0), (self.test_mbid, 3)])
+        recordings = [(self.test_mbid, offset) for offset in range(4)]
+
+        with mock.patch.object(db.engine, "connect", wraps=db.engine.connect) as connect, \
+                mock.patch("db.document_cache.set_many", wraps=db.document_cache.set_many) as set_many:
+            generated = db.data.iter_many_low_level_json(recordings, batch_size=2)
+            first = next(generated)
+            db.document_cache.delete_many(db.document_cache.LOWLEVEL_CACHE_NAMESPACE, [(self.test_mbid, 3)])
+            generated = [first] + list(generated)
+
+        self.assertEqual([(self.test_mbid, offset, documents[offset]) for offset in range(4)],
+                         [(mbid, offset, json.loads(document)) for mbid, offset, document in generated])
+        self.assertEqual(1, connect.call_count)
+        self.assertEqual([[(self.test_mbid, 1)], [(self.test_mbid, 2), (self.test_mbid, 3)]],
+                         [sorted(call[0][1]) for call in set_many.call_args_list])
+
+    def test_write_high_level_invalidates_cache(self):
+        """Writing new models for a submission removes its high-level document from the cache"""
+        ll = {"data": "one",
+              "metadata": {"audio_properties": {"lossless": True}, "version": {"essentia_build_sha": "x"}}}
+        ver = {"hlversion": "123", "models_essentia_git_sha": "v1"}
+        metadata = {"meta": "here", "version": {"highlevel": ver}}
+        db.data.add_model("model1", "v1", "show")
+        db.data.add_model("model2", "v1", "show")
+        db.data.write_low_level(self.test_mbid, ll, gid_types.GID_TYPE_MBID)
+        ll_id = self._get_ll_id_from_mbid(self.test_mbid)[0]
+
+        db.data.write_high_level(self.test_mbid, ll_id, {"highlevel": {"model1": {"x": "y"}}, "metadata": metadata}, "test")
+        self.assertEqual(["model1"], list(db.data.load_high_level(self.test_mbid)["highlevel"].keys()))
+
+        db.data.write_high_level(self.test_mbid, ll_id, {"highlevel": {"model2": {"a": "b"}}, "metadata": metadata}, "test")
+        self.assertEqual(["model1", "model2"], sorted(db.data.load_high_level(self.test_mbid)["highlevel"].keys()))
+
+        # Hiding a model invalidates all cached high-level documents
+        db.data.set_model_status("model2", "v1", db.data.STATUS_HIDDEN)
+        self.assertEqual(["model1"], list(db.data.load_high_level(self.test_mbid)["highlevel"].keys()))
+
     def test_write_load_high_level(self):
         """Writing and loading a dict returns the same data"""
         ll = {"data": "one",
@@ -239,6 +405,73 @@ class DataDBTestCase(AcousticbrainzTestCase):
 
         self.assertEqual(hl_expected, db.data.load_high_level(self.test_mbid))
 
+    def test_write_many_high_level(self):
+        ver = {"hlversion": "123", "models_essentia_git_sha": "v1"}
+        metadata = {"meta": "here", "version": {"highlevel": ver}}
+        db.data.add_model("model1", "v1", "show")
+        db.data.add_model("model2", "v1", "show")
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        db.data.write_low_level(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        ll_id1 = self._get_ll_id_from_mbid(self.test_mbid)[0]
+        ll_id2 = self._get_ll_id_from_mbid(self.test_mbid_two)[0]
+
+        db.data.write_high_level(self.test_mbid, ll_id1, {"highlevel": {"model1": {"x": "y"}}, "metadata": metadata},
+                                 "test")
+        # The document is cached until more models are written
+        db.data.load_high_level(self.test_mbid)
+
+        # model1 is already written for the first submission
+        db.data.write_many_high_level([
+            (ll_id1, self.test_mbid, {"highlevel": {"model1": {"x": "y"}, "model2": {"a": "b"}}, "metadata": metadata}),
+            (ll_id2, self.test_mbid_two, {"highlevel": {"model1": {"x": "z"}}, "metadata": metadata}),
+        ], "test")
+
+        hl1 = db.data.load_high_level(self.test_mbid)
+        self.assertEqual({"model1": {"x": "y", "version": ver}, "model2": {"a": "b", "version": ver}}, hl1["highlevel"])
+        hl2 = db.data.load_high_level(self.test_mbid_two)
+        self.assertEqual({"model1": {"x": "z", "version": ver}}, hl2["highlevel"])
+        self.assertEqual(metadata, hl2["metadata"])
+
+        with db.engine.connect() as connection:
+            self.assertEqual(2, connection.execute("SELECT COUNT(*) FROM highlevel").fetchone()[0])
+            self.assertEqual(2, connection.execute("SELECT COUNT(*) FROM highlevel_meta").fetchone()[0])
+            self.assertEqual(3, connection.execute("SELECT COUNT(*) FROM highlevel_model").fetchone()[0])
+            self.assertEqual(1, connection.execute("SELECT COUNT(*) FROM version WHERE type = 'highlevel'").fetchone()[0])
+
+        # A badly formed document can't be written
+        with self.assertRaises(db.exceptions.BadDataException):
+            db.data.write_many_high_level([
+                (ll_id1, self.test_mbid, {"highlevel": {"model3": {"x": "y"}}, "metadata": {"no": "version"}}),
+            ], "test")
+
+    def test_claim_unprocessed_highlevel_documents(self):
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        db.data.write_low_level(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        ll_id1 = self._get_ll_id_from_mbid(self.test_mbid)[0]
+        ll_id2 = self._get_ll_id_from_mbid(self.test_mbid_two)[0]
+
+        # Each worker gets different submissions
+        docs = db.data.claim_unprocessed_highlevel_documents("worker1", limit=1)
+        self.assertEqual([(ll_id1, self.test_mbid)], [(row[0], row[1]) for row in docs])
+        self.assertEqual(self.test_lowlevel_data, json.loads(docs[0][2]))
+        docs = db.data.claim_unprocessed_highlevel_documents("worker2")
+        self.assertEqual([ll_id2], [row[0] for row in docs])
+        self.assertEqual([], db.data.claim_unprocessed_highlevel_documents("worker3"))
+
+        # Saving the highlevel data of a submission removes its lease
+        db.data.write_many_high_level([(ll_id2, self.test_mbid_two, {})], "test")
+        with db.engine.begin() as connection:
+            result = connection.execute("SELECT id, worker FROM highlevel_lease")
+            self.assertEqual([(ll_id1, "worker1")], [tuple(row) for row in result])
+            # The first worker stops without saving its submission
+            connection.execute("UPDATE highlevel_lease SET expires = now() - interval '1 second'")
+
+        # Submissions with an expired lease are claimed again, if they are after id_from
+        self.assertEqual([], db.data.claim_unprocessed_highlevel_documents("worker3", id_from=ll_id1))
+        docs = db.data.claim_unprocessed_highlevel_documents("worker3")
+        self.assertEqual([ll_id1], [row[0] for row in docs])
+        self.assertEqual([], db.data.claim_unprocessed_highlevel_documents("worker1"))
+
     def test_write_high_level_no_data(self):
         # an empty highlevel block should write an entry to the `highlevel` table
 
@@ -718,6 +951,8 @@ class DataDBTestCase(AcousticbrainzTestCase):
             connection.execute(
                 sqlalchemy.text("""UPDATE model set class_mapping = '{"one": "Class One", "two": "Class Two"}'::jsonb""")
             )
+        # Documents cached with the old mapping are only removed when the cache is cleared
+        db.document_cache.invalidate(db.document_cache.HIGHLEVEL_CACHE_NAMESPACE)
 
         # Now with the mapping, the values in the expected values have been changed
         hl1_expected = copy.deepcopy(hl1)
@@ -747,13 +982,13 @@ class DataDBTestCase(AcousticbrainzTestCase):
                       (self.test_mbid, 2),
                       (self.test_mbid_two, 0)]
 
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'lowlevel'->'dynamic_complexity'", "lowlevel.dynamic_complexity", None),
-                    ("llj.data->'metadata'->'audio_properties'->'replay_gain'", "metadata.audio_properties.replay_gain", None),
-                    ("llj.data->'metadata'->'tags'", "metadata.tags", {}),
-                    ("llj.data->'rhythm'->'beats_loudness'->'mean'", "rhythm.beats_loudness.mean", None),
-                    ("llj.data->'rhythm'->'bpm_histogram_second_peak_bpm'->'mean'", "rhythm.bpm_histogram_second_peak_bpm.mean", None),
-                    ("llj.data->'tonal'->'key_key'", "tonal.key_key", None)]
+        features = [("to_jsonb(llf.lowlevel_average_loudness)", "lowlevel.average_loudness", None),
+                    ("to_jsonb(llf.lowlevel_dynamic_complexity)", "lowlevel.dynamic_complexity", None),
+                    ("to_jsonb(llf.metadata_audio_properties_replay_gain)", "metadata.audio_properties.replay_gain", None),
+                    ("to_jsonb(llf.metadata_tags)", "metadata.tags", {}),
+                    ("to_jsonb(llf.rhythm_beats_loudness_mean)", "rhythm.beats_loudness.mean", None),
+                    ("to_jsonb(llf.rhythm_bpm_histogram_second_peak_bpm_mean)", "rhythm.bpm_histogram_second_peak_bpm.mean", None),
+                    ("to_jsonb(llf.tonal_key_key)", "tonal.key_key", None)]
 
         expected = json.loads(open(os.path.join(DB_TEST_DATA_PATH, "lowlevel_select_features_response.json")).read())
         self.assertEqual(expected, db.data.load_many_individual_features(list(recordings), features))
@@ -766,13 +1001,13 @@ class DataDBTestCase(AcousticbrainzTestCase):
         recordings = [(self.test_mbid, 0),
                       (self.test_mbid_two, 0)]
 
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'lowlevel'->'dynamic_complexity'", "lowlevel.dynamic_complexity", None),
-                    ("llj.data->'metadata'->'audio_properties'->'replay_gain'", "metadata.audio_properties.replay_gain", None),
-                    ("llj.data->'metadata'->'tags'", "metadata.tags", {}),
-                    ("llj.data->'rhythm'->'beats_loudness'->'mean'", "rhythm.beats_loudness.mean", None),
-                    ("llj.data->'rhythm'->'bpm_histogram_second_peak_bpm'->'mean'", "rhythm.beats_loudness.mean", None),
-                    ("llj.data->'tonal'->'key_key'", "tonal.key_key", None)]
+        features = [("to_jsonb(llf.lowlevel_average_loudness)", "lowlevel.average_loudness", None),
+                    ("to_jsonb(llf.lowlevel_dynamic_complexity)", "lowlevel.dynamic_complexity", None),
+                    ("to_jsonb(llf.metadata_audio_properties_replay_gain)", "metadata.audio_properties.replay_gain", None),
+                    ("to_jsonb(llf.metadata_tags)", "metadata.tags", {}),
+                    ("to_jsonb(llf.rhythm_beats_loudness_mean)", "rhythm.beats_loudness.mean", None),
+                    ("to_jsonb(llf.rhythm_bpm_histogram_second_peak_bpm_mean)", "rhythm.beats_loudness.mean", None),
+                    ("to_jsonb(llf.tonal_key_key)", "tonal.key_key", None)]
 
         expected = {}
         self.assertEqual(expected, db.data.load_many_individual_features(list(recordings), features))
@@ -785,9 +1020,9 @@ class DataDBTestCase(AcousticbrainzTestCase):
 
         recordings = [(self.test_mbid, 0)]
 
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'metadata'->'audio_properties'->'replay_gain'", "metadata.audio_properties.replay_gain", None),
-                    ("llj.data->'metadata'->'tags'", "metadata.tags", {})]
+        features = [("to_jsonb(llf.lowlevel_average_loudness)", "lowlevel.average_loudness", None),
+                    ("to_jsonb(llf.metadata_audio_properties_replay_gain)", "metadata.audio_properties.replay_gain", None),
+                    ("to_jsonb(llf.metadata_tags)", "metadata.tags", {})]
 
         expected = {"0dad432b-16cc-4bf0-8961-fd31d124b01b": {"0": {"lowlevel": {"average_loudness": None},
                                                                    "metadata": {"audio_properties": {
@@ -804,15 +1039,15 @@ class DataDBTestCase(AcousticbrainzTestCase):
         features = []
         self.assertEqual("", db.data.build_feature_string(features))
 
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'lowlevel'->'dynamic_complexity'", "lowlevel.dynamic_complexity", None)]
-        expected_string = """llj.data->'lowlevel'->'average_loudness' AS \"lowlevel.average_loudness\", llj.data->'lowlevel'->'dynamic_complexity' AS \"lowlevel.dynamic_complexity\""""
+        features = [("to_jsonb(llf.lowlevel_average_loudness)", "lowlevel.average_loudness", None),
+                    ("to_jsonb(llf.lowlevel_dynamic_complexity)", "lowlevel.dynamic_complexity", None)]
+        expected_string = """to_jsonb(llf.lowlevel_average_loudness) AS \"lowlevel.average_loudness\", to_jsonb(llf.lowlevel_dynamic_complexity) AS \"lowlevel.dynamic_complexity\""""
         self.assertEqual(expected_string, db.data.build_feature_string(features))
 
     def test_bulk_get_feature_recordings(self):
         # If all (MBID, offsets) are not present, empty array is returned
-        feature_string = """llj.data->'lowlevel'->'average_loudness' AS \"lowlevel.average_loudness\",
-                            llj.data->'metadata'->'tags' AS \"metadata.tags\""""
+        feature_string = """to_jsonb(llf.lowlevel_average_loudness) AS \"lowlevel.average_loudness\",
+                            to_jsonb(llf.metadata_tags) AS \"metadata.tags\""""
         recordings = [(self.test_mbid, 0)]
         self.assertEqual([], db.data.bulk_get_recording_features(recordings, feature_string))
 
@@ -859,9 +1094,9 @@ class DataDBTestCase(AcousticbrainzTestCase):
                "submission_offset": 0,
                "lowlevel.average_loudness": 0.048737552017,
                "rhythm.bpm": None}
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'metadata'->'tags'", "metadata.tags", {}),
-                    ("llj.data->'rhythm'->'bpm'", "rhythm.bpm", None)]
+        features = [("to_jsonb(llf.lowlevel_average_loudness)", "lowlevel.average_loudness", None),
+                    ("to_jsonb(llf.metadata_tags)", "metadata.tags", {}),
+                    ("to_jsonb(llf.rhythm_bpm)", "rhythm.bpm", None)]
 
         # Row data is reconstructed to mirror lowlevel document structure
         expected_dict = {"lowlevel": {"average_loudness": 0.048737552017},
@@ -889,6 +1124,61 @@ class DataDBTestCase(AcousticbrainzTestCase):
         get_id = db.data._get_model_id("modelname", "v1")
         self.assertEqual(modelid, get_id)
 
+    def test_get_model_id_memoised(self):
+        modelid = db.data.add_model("modelname", "v1")
+        self.assertEqual(modelid, db.data._get_model_id("modelname", "v1"))
+        with mock.patch("db.engine") as engine:
+            self.assertEqual(modelid, db.data._get_model_id("modelname", "v1"))
+            engine.begin.assert_not_called()
+
+    def test_get_model_id_duplicate(self):
+        # Two processes added the same model at the same time
+        first_id = db.data.add_model("modelname", "v1")
+        db.data.add_model("modelname", "v1")
+        self.assertEqual(first_id, db.data._get_model_id("modelname", "v1"))
+
+    def test_insert_version_memoised(self):
+        version = {"essentia": "2.1-beta2", "extractor": "music 1.0"}
+        with db.engine.begin() as connection:
+            version_id = db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL)
+            # Not remembered until the transaction which inserted it is committed
+            self.assertEqual(version_id, db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL))
+        # The same data with another type is a different version
+        with db.engine.begin() as connection:
+            other_id = db.data.insert_version(connection, version, db.data.VERSION_TYPE_HIGHLEVEL)
+        self.assertNotEqual(version_id, other_id)
+
+        connection = mock.MagicMock()
+        self.assertEqual(version_id, db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL))
+        connection.execute.assert_not_called()
+
+    def test_insert_version_rollback(self):
+        version = {"essentia": "2.1-beta2", "extractor": "music 1.0"}
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL)
+        transaction.rollback()
+        connection.close()
+
+        with db.engine.begin() as connection:
+            version_id = db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL)
+            result = connection.execute("SELECT id FROM version")
+            self.assertEqual([version_id], [row["id"] for row in result])
+
+    def test_insert_version_twice_rollback(self):
+        # A version which a transaction added and then read again isn't
+        # remembered if the transaction is rolled back
+        version = self.test_lowlevel_data["metadata"]["version"]
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        first_id = db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL)
+        self.assertEqual(first_id, db.data.insert_version(connection, version, db.data.VERSION_TYPE_LOWLEVEL))
+        transaction.rollback()
+        connection.close()
+
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        self.assertEqual(self.test_lowlevel_data, db.data.load_low_level(self.test_mbid))
+
     def test_get_failed_highlevel_submissions(self):
         hl = {"highlevel": {"model1": {"x": "y"}, "model2": {"a": "b"}},
               "metadata": {}
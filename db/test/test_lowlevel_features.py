@@ -0,0 +1,65 @@
+import copy
+import json
+import os.path
+
+import db
+import db.data
+import db.lowlevel_features
+from webserver.testing import AcousticbrainzTestCase, DB_TEST_DATA_PATH, gid_types
+
+
+class LowlevelFeaturesDBTestCase(AcousticbrainzTestCase):
+
+    def setUp(self):
+        super(LowlevelFeaturesDBTestCase, self).setUp()
+        self.test_mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
+        self.test_lowlevel_data = json.load(open(os.path.join(DB_TEST_DATA_PATH, self.test_mbid + '.json')))
+
+    def _get_features(self):
+        with db.engine.connect() as connection:
+            result = connection.execute("SELECT * FROM lowlevel_features ORDER BY id")
+            return [dict(row) for row in result]
+
+    def test_features_written_with_submission(self):
+        data = copy.deepcopy(self.test_lowlevel_data)
+        # Features with an unexpected type are NULL
+        data["rhythm"]["bpm"] = "fast"
+        del data["tonal"]["key_key"]
+        db.data.write_low_level(self.test_mbid, data, gid_types.GID_TYPE_MBID)
+
+        features = self._get_features()
+        self.assertEqual(1, len(features))
+        self.assertEqual(float(data["lowlevel"]["average_loudness"]), float(features[0]["lowlevel_average_loudness"]))
+        self.assertEqual(data["tonal"]["key_scale"], features[0]["tonal_key_scale"])
+        self.assertEqual(data["metadata"]["tags"], features[0]["metadata_tags"])
+        self.assertEqual(data["metadata"]["version"], features[0]["metadata_version"])
+        self.assertIsNone(features[0]["rhythm_bpm"])
+        self.assertIsNone(features[0]["tonal_key_key"])
+
+    def test_backfill(self):
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        second_data = copy.deepcopy(self.test_lowlevel_data)
+        second_data["metadata"]["tags"]["album"] = ["Another album"]
+        db.data.write_low_level(self.test_mbid, second_data, gid_types.GID_TYPE_MBID)
+        expected = self._get_features()
+
+        with db.engine.begin() as connection:
+            connection.execute("DELETE FROM lowlevel_features WHERE id = %s", (expected[1]["id"],))
+        self.assertEqual(1, db.lowlevel_features.backfill(batch_size=1))
+        self.assertEqual(expected, self._get_features())
+
+        # Submissions which already have features are skipped
+        self.assertEqual(0, db.lowlevel_features.backfill())
+
+    def test_features_read_before_backfill(self):
+        db.data.write_low_level(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        features = [(db.lowlevel_features.get_feature_path(alias), alias, None)
+                    for alias in ["rhythm.bpm", "tonal.key_key", "metadata.tags"]]
+        expected = db.data.load_many_individual_features([(self.test_mbid, 0)], features)
+        self.assertEqual(self.test_lowlevel_data["rhythm"]["bpm"],
+                         expected[self.test_mbid]["0"]["rhythm"]["bpm"])
+
+        # Features of a submission which hasn't been backfilled are read from lowlevel_json
+        with db.engine.begin() as connection:
+            connection.execute("DELETE FROM lowlevel_features")
+        self.assertEqual(expected, db.data.load_many_individual_features([(self.test_mbid, 0)], features))
@@ -1,6 +1,8 @@
 import copy
 import json
 import os.path
+import shutil
+import tempfile
 import mock
 
 import db
@@ -11,6 +13,7 @@ import db.exceptions
 from webserver.testing import AcousticbrainzTestCase, DB_TEST_DATA_PATH, gid_types
 import db.test_data.similarity_metrics_data
 import similarity.utils
+from similarity.index_model import AnnoyModel
 
 from sqlalchemy import text
 
@@ -67,6 +70,90 @@ class SimilarityDBTestCase(AcousticbrainzTestCase):
 
             self.assertEqual(db.test_data.similarity_metrics_data.expected_similarity_rows, recs)
 
+    def _submit_similarity_test_data(self):
+        db.data.submit_low_level_data(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        id_1 = db.data.get_ids_by_mbids([(self.test_mbid, 0)])[0]
+        db.data.write_high_level(self.test_mbid, id_1, self.test_highlevel_data, "test")
+        db.data.submit_low_level_data(self.test_mbid_two, self.test_lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        self.show_highlevel_models()
+        db.similarity_stats.compute_stats(2)
+
+    def _get_similarity_rows(self):
+        with db.engine.connect() as connection:
+            result = connection.execute(text("""
+                SELECT *
+                  FROM similarity.similarity
+              ORDER BY id
+            """))
+            return [dict(row) for row in result]
+
+    def test_add_metrics_copy_unlogged(self):
+        # Rows inserted with COPY into an unlogged table are the same as with INSERT
+        self._submit_similarity_test_data()
+        db.similarity.add_metrics(2, use_copy=True, unlogged=True)
+        self.assertEqual(db.test_data.similarity_metrics_data.expected_similarity_rows, self._get_similarity_rows())
+
+        with db.engine.connect() as connection:
+            # The table is logged again once rows have been added
+            result = connection.execute(text("""
+                SELECT relpersistence
+                  FROM pg_class
+                 WHERE oid = 'similarity.similarity'::regclass
+            """))
+            self.assertEqual("p", result.fetchone()[0])
+
+    def test_add_metrics_parallel(self):
+        # Batches of one recording are fetched by worker processes and written in order
+        self._submit_similarity_test_data()
+        db.similarity.add_metrics(1, processes=2)
+        self.assertEqual(db.test_data.similarity_metrics_data.expected_similarity_rows, self._get_similarity_rows())
+
+    def test_get_similarity_recordings(self):
+        self._submit_similarity_test_data()
+        db.similarity.add_metrics(2)
+        ids = db.similarity.get_similarity_ids()
+        self.assertEqual([(ids[0], self.test_mbid, 0), (ids[1], self.test_mbid_two, 0)],
+                         list(db.similarity.get_similarity_recordings(ids[1])))
+        # Recordings which were added after the index's ids were read are left out
+        self.assertEqual([(ids[0], self.test_mbid, 0)], list(db.similarity.get_similarity_recordings(ids[0])))
+
+    def test_add_index_no_ids(self):
+        with self.assertRaises(db.exceptions.NoDataFoundException):
+            db.similarity.add_index(mock.Mock(), 0, [], 10)
+
+    def test_add_indices(self):
+        # Indices which are built in a single pass are the same as
+        # indices which are built one at a time
+        self._submit_similarity_test_data()
+        db.similarity.add_metrics(2)
+        num_ids = db.similarity.get_similarity_count()
+        ids = db.similarity.get_similarity_ids()
+        metrics = ["mfccs", "bpm"]
+        single_pass_dir = tempfile.mkdtemp()
+        separate_dir = tempfile.mkdtemp()
+        try:
+            self.app.config["SIMILARITY_INDEX_DIR"] = single_pass_dir
+            db.similarity.add_indices([AnnoyModel(metric) for metric in metrics], num_ids, ids, 1, processes=2)
+            self.app.config["SIMILARITY_INDEX_DIR"] = separate_dir
+            for metric in metrics:
+                db.similarity.add_index(AnnoyModel(metric), num_ids, ids, 1)
+
+            for metric in metrics:
+                self.app.config["SIMILARITY_INDEX_DIR"] = single_pass_dir
+                single_pass = AnnoyModel(metric, load_existing=True)
+                self.app.config["SIMILARITY_INDEX_DIR"] = separate_dir
+                separate = AnnoyModel(metric, load_existing=True)
+
+                self.assertEqual(separate.index.get_n_items(), single_pass.index.get_n_items())
+                for id in ids:
+                    self.assertEqual(separate.index.get_item_vector(id), single_pass.index.get_item_vector(id))
+                self.assertEqual(len(separate.id_map), len(single_pass.id_map))
+                self.assertEqual([(self.test_mbid, 0), (self.test_mbid_two, 0)],
+                                 single_pass.id_map.get_recordings(ids))
+        finally:
+            shutil.rmtree(single_pass_dir)
+            shutil.rmtree(separate_dir)
+
     def _convert_ll_to_bulk_format(self, lowlevel_data):
         return {"gfcc": lowlevel_data["lowlevel"]["gfcc"]["mean"],
                 "onset_rate": lowlevel_data["rhythm"]["onset_rate"],
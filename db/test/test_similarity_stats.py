@@ -1,6 +1,7 @@
 import os
 import json
 import mock
+import numpy as np
 
 import db
 from webserver.testing import AcousticbrainzTestCase, DB_TEST_DATA_PATH
@@ -70,3 +71,26 @@ class SimilarityStatsDatabaseTestCase(AcousticbrainzTestCase):
         metric = similarity.metrics.MfccsMetric()
         with self.assertRaises(db.exceptions.NoDataFoundException):
             db.similarity_stats.assign_stats(metric)
+
+    def test_compute_stats_streaming(self):
+        # Without any lowlevel submissions, stats cannot be calculated
+        with self.assertRaises(db.exceptions.NoDataFoundException):
+            db.similarity_stats.compute_stats_streaming()
+
+        mbid_two = "e8afe383-1478-497e-90b1-7885c7f37f6e"
+        lowlevel_data_two = json.load(open(os.path.join(DB_TEST_DATA_PATH, mbid_two + '.json')))
+        mfccs = [self.test_lowlevel_data["lowlevel"]["mfcc"]["mean"], lowlevel_data_two["lowlevel"]["mfcc"]["mean"]]
+
+        db.data.submit_low_level_data(self.test_mbid, self.test_lowlevel_data, gid_types.GID_TYPE_MBID)
+        db.similarity_stats.compute_stats_streaming(batch_size=1)
+        metric = similarity.metrics.MfccsMetric()
+        db.similarity_stats.assign_stats(metric)
+        np.testing.assert_allclose(mfccs[0], metric.means)
+        np.testing.assert_allclose([0.0] * len(mfccs[0]), metric.stddevs)
+
+        # Stats are updated with new submissions
+        db.data.submit_low_level_data(mbid_two, lowlevel_data_two, gid_types.GID_TYPE_MBID)
+        db.similarity_stats.update_stats(batch_size=1)
+        db.similarity_stats.assign_stats(metric)
+        np.testing.assert_allclose(np.mean(mfccs, axis=0), metric.means)
+        np.testing.assert_allclose(np.std(mfccs, axis=0), metric.stddevs)
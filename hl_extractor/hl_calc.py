@@ -3,19 +3,23 @@ import hashlib
 import json
 import logging
 import os
+import select
 import shutil
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 
-import concurrent.futures
 import yaml
 from flask import current_app
+from six.moves import queue
 
 import db
 import db.data
+import db.exceptions
 
 DEFAULT_NUM_THREADS = 2
 
@@ -31,6 +35,25 @@ DOCUMENTS_PER_QUERY = 100
 
 MAX_ITEMS_PER_PROCESS = 20
 
+# Number of sets of MAX_ITEMS_PER_PROCESS documents which are fetched ahead of
+# the extractor, per extractor thread
+QUEUED_SETS_PER_THREAD = 2
+
+# Maximum number of highlevel documents saved at a time
+SAVE_BATCH_SIZE = DOCUMENTS_PER_QUERY
+
+# Directory that the extractor reads and writes documents in. The default
+# temporary directory is used if it isn't set. A RAM-backed filesystem such as
+# /dev/shm avoids a round trip to disk for every document, but it must have
+# room for the documents of every set which is being processed
+DEFAULT_WORKING_DIR_ROOT = None
+
+# Argument which starts the extractor binary as a server, see ExtractorServer
+SERVER_MODE_ARGUMENT = "--server"
+
+# Number of seconds to wait for an extractor server to answer when it is started
+SERVER_START_TIMEOUT = 60
+
 
 class HighLevelExtractorError(Exception):
     """Indicates an error running the highlevel extractor"""
@@ -41,18 +64,153 @@ class HighLevelConfigurationError(Exception):
     before processing items"""
 
 
+class ExtractorServer(object):
+    """A long-lived high-level extractor process which keeps its models loaded
+    between jobs.
+
+    The process is started with ``<binary> --server <profile>``. It reads one job
+    per line from stdin: the path of a lowlevel file and the path to write its
+    highlevel results to, separated by a tab. After each job it writes a line to
+    stdout which starts with ``OK`` or with ``ERROR`` followed by a message.
+    An empty line is a job which does nothing, and is answered with ``OK``.
+    The process is (re)started when it is first needed and after it fails.
+    """
+
+    def __init__(self, binary, profile):
+        self.args = [binary, SERVER_MODE_ARGUMENT, profile]
+        self.process = None
+
+    def start(self):
+        fnull = open(os.devnull, 'w')
+        try:
+            self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=fnull, universal_newlines=True, close_fds=True)
+        except OSError as e:
+            raise HighLevelExtractorError("Cannot start the highlevel extractor server", e)
+        finally:
+            fnull.close()
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            self.process.kill()
+        self.process = None
+
+    def check(self, timeout=SERVER_START_TIMEOUT):
+        """Start the process and check that it can run as a server, by sending
+        it an empty job.
+
+        Raises:
+            HighLevelExtractorError: if the process can't be started, or doesn't
+             answer ``OK`` within ``timeout`` seconds
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+
+        status = ""
+        try:
+            self.process.stdin.write("\n")
+            self.process.stdin.flush()
+            ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+            if ready:
+                status = self.process.stdout.readline()
+        except (IOError, OSError):
+            pass
+        if not status.startswith("OK"):
+            # The process may be waiting for something else, so don't wait for it to exit
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+            raise HighLevelExtractorError("The highlevel extractor can't be run as a server: {}".format(
+                status.strip() or "it didn't answer"))
+
+    def extract(self, paths, logger=None):
+        """Compute the highlevel results of some lowlevel files.
+
+        Arguments:
+            paths: a list of (in_path, out_path) tuples. The output file of an
+             item which can't be processed isn't written
+
+        Raises:
+            HighLevelExtractorError: if the process can't be started or exits
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+
+        try:
+            for in_path, out_path in paths:
+                self.process.stdin.write("{}\t{}\n".format(in_path, out_path))
+                self.process.stdin.flush()
+                status = self.process.stdout.readline()
+                if not status:
+                    raise IOError("the server exited")
+                if not status.startswith("OK") and logger:
+                    logger.info("Extractor failed to process {}: {}".format(in_path, status.strip()))
+        except (IOError, OSError) as e:
+            self.stop()
+            raise HighLevelExtractorError("Error communicating with the highlevel extractor server", e)
+
+
+class ExtractorPool(object):
+    """A fixed number of ExtractorServers, each of which processes one
+    job at a time."""
+
+    def __init__(self, num_servers, binary, profile):
+        self._servers = queue.Queue()
+        for _ in range(num_servers):
+            self._servers.put(ExtractorServer(binary, profile))
+        self.num_servers = num_servers
+
+    def extract(self, paths, logger=None):
+        """Compute the highlevel results of some lowlevel files with the next
+        free server. See ExtractorServer.extract"""
+        server = self._servers.get()
+        try:
+            server.extract(paths, logger)
+        finally:
+            self._servers.put(server)
+
+    def check(self):
+        """Check that the extractor can be run as a server, see ExtractorServer.check
+
+        Raises:
+            HighLevelConfigurationError: if it can't
+        """
+        server = self._servers.get()
+        try:
+            server.check()
+        except HighLevelExtractorError as e:
+            raise HighLevelConfigurationError(u"{}".format(e))
+        finally:
+            self._servers.put(server)
+
+    def close(self):
+        """Stop all of the servers, waiting for jobs that are running."""
+        for _ in range(self.num_servers):
+            self._servers.get().stop()
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in xrange(0, len(l), n):
         yield l[i:i+n]
 
 
-def process_lowlevel_data(data, logger_name=None):
+def process_lowlevel_data(data, logger_name=None, pool=None, working_dir_root=None):
     """Process a set of lowlevel submissions with the highlevel binary.
 
     Arguments:
         data: list of up to ``MAX_ITEMS_PER_PROCESS`` (rowid, mbid, ll_data) tuples containing
          the lowlevel id of a submission, its MBID, and the actual data of the submission
+        logger_name: the name of a logger to log progress to
+        pool: an ExtractorPool to process the submissions with. If it isn't set,
+         a new extractor process is run for this set of submissions
+        working_dir_root: the directory to write lowlevel and highlevel files in, see
+         ``extract_lowlevel_data``
 
     Returns:
         a list of (rowid, mbid, hl_data) tuples containing the highlevel results for the associated
@@ -64,6 +222,26 @@ def process_lowlevel_data(data, logger_name=None):
         HighLevelExtractorError: If lowlevel files are unable to be written to a temporary directory or
          if there is an error running the extractor binary
     """
+    working_dir = extract_lowlevel_data(data, logger_name, pool, working_dir_root)
+    return read_highlevel_results(working_dir, data, logger_name)
+
+
+def extract_lowlevel_data(data, logger_name=None, pool=None, working_dir_root=None):
+    """Run the highlevel binary on a set of lowlevel submissions, leaving its
+    results in a working directory to be read by ``read_highlevel_results``.
+
+    Arguments are the same as ``process_lowlevel_data``. The working directory is
+    created in ``working_dir_root``, which can be on a RAM-backed filesystem
+    (e.g. /dev/shm) so that documents are never written to disk. If it isn't set,
+    the default temporary directory is used.
+
+    Returns:
+        the path of the working directory
+
+    Raises:
+        the same exceptions as ``process_lowlevel_data``. The working directory
+         is removed if there is an error
+    """
 
     if len(data) > MAX_ITEMS_PER_PROCESS:
         raise ValueError("'data' cannot contain more than {} items".format(MAX_ITEMS_PER_PROCESS))
@@ -74,61 +252,106 @@ def process_lowlevel_data(data, logger_name=None):
     if logger_name:
         logger = logging.getLogger(logger_name)
 
-    llids = ", ".join([str(llid) for llid, _, _ in data])
     if logger:
-        logger.info("Starting {}".format(llids))
+        logger.info("Starting {}".format(_format_llids(data)))
 
     try:
-        working_dir = tempfile.mkdtemp(prefix="hlcalc")
-    except IOError as e:
+        working_dir = tempfile.mkdtemp(prefix="hlcalc", dir=working_dir_root)
+    except (IOError, OSError) as e:
         raise HighLevelExtractorError("Unable to create temporary directory", e)
 
-    call_args = [HIGH_LEVEL_EXTRACTOR_BINARY]
-    results = []
+    paths = []
 
     for rowid, mbid, ll_data in data:
         in_path = os.path.join(working_dir, '{}-input.json'.format(rowid))
         out_path = os.path.join(working_dir, '{}-output.json'.format(rowid))
         try:
-            # Write this data to disk for the extractor to read. If there's an error writing a lowlevel
-            # item to disk, we won't add it to the arguments. When reading the result files after execution
-            # of the extractor a missing output file will raise an IOError, causing an empty result to be
-            # added
+            # Write this data to disk for the extractor to read. If an item can't be written (e.g. because
+            # the working directory is full), none of the set is processed so that it's tried again later
+            # rather than saved with empty results
             with open(in_path, 'w') as fp:
                 fp.write(ll_data.encode("utf-8"))
-            call_args.extend([in_path, out_path])
-        except IOError:
-            pass
-
-    if not call_args:
-        raise HighLevelExtractorError("Unable to write any lowlevel files to temporary directory")
+        except IOError as e:
+            shutil.rmtree(working_dir, ignore_errors=True)
+            raise HighLevelExtractorError("Unable to write lowlevel file to temporary directory", e)
+        paths.append((in_path, out_path))
 
-    fnull = open(os.devnull, 'w')
     try:
-        call_args.append(PROFILE_CONF)
-        subprocess.check_call(call_args, stdout=fnull, stderr=fnull)
+        if pool:
+            pool.extract(paths, logger)
+        else:
+            call_args = [HIGH_LEVEL_EXTRACTOR_BINARY]
+            for in_path, out_path in paths:
+                call_args.extend([in_path, out_path])
+            call_args.append(PROFILE_CONF)
+            fnull = open(os.devnull, 'w')
+            subprocess.check_call(call_args, stdout=fnull, stderr=fnull)
+    except (subprocess.CalledProcessError, OSError):
+        shutil.rmtree(working_dir, ignore_errors=True)
+        raise HighLevelExtractorError("Cannot call the highlevel extractor")
+    except HighLevelExtractorError:
+        shutil.rmtree(working_dir, ignore_errors=True)
+        raise
+
+    return working_dir
+
 
+def read_highlevel_results(working_dir, data, logger_name=None):
+    """Read the results of ``extract_lowlevel_data`` and remove its working directory.
+
+    Arguments:
+        working_dir: the working directory returned by ``extract_lowlevel_data``
+        data: the submissions that were passed to ``extract_lowlevel_data``
+        logger_name: the name of a logger to log progress to
+
+    Returns:
+        the same as ``process_lowlevel_data``. A submission which the extractor
+         couldn't process has an empty dictionary as its result
+
+    Raises:
+        HighLevelExtractorError: if a result is missing and the working directory
+         can't be written to, so the result may have been lost to a write error
+    """
+    results = []
+    try:
         for rowid, mbid, ll_data in data:
             out_file = '{}-output.json'.format(rowid)
             try:
                 with open(os.path.join(working_dir, out_file), "r") as fp:
                     hl_data = json.load(fp)
             except (IOError, ValueError):
+                _check_writable(working_dir, rowid, len(ll_data))
                 hl_data = {}
             results.append((rowid, mbid, hl_data))
-
-    except (subprocess.CalledProcessError, OSError):
-        raise HighLevelExtractorError("Cannot call the highlevel extractor")
     finally:
         # At this point we can remove the working directory,
         # regardless of if we failed or if we succeeded
         shutil.rmtree(working_dir, ignore_errors=True)
 
-    if logger:
-        logger.info("Finished {}".format(llids))
+    if logger_name:
+        logging.getLogger(logger_name).info("Finished {}".format(_format_llids(data)))
     return results
 
 
+def _check_writable(working_dir, rowid, size):
+    """Check that the result of a submission could have been written to the
+    working directory, by writing a file of the size of its lowlevel data
+    (which is larger than its highlevel result).
+
+    Raises:
+        HighLevelExtractorError: if the file can't be written
+    """
+    try:
+        with open(os.path.join(working_dir, '{}-check'.format(rowid)), 'w') as fp:
+            fp.write(" " * size)
+    except IOError as e:
+        raise HighLevelExtractorError("Unable to write to temporary directory", e)
+
+
+def _format_llids(data):
+    return ", ".join([str(llid) for llid, _, _ in data])
+
+
 def create_profile(in_file, out_file, sha1):
     """Prepare a profile file for use with essentia. Sanity check to make sure
     important values are present.
@@ -169,63 +392,199 @@ def get_build_sha1(binary):
     return hashlib.sha1(contents).hexdigest()
 
 
-def save_hl_documents(hl_data_list, build_sha1):
-    """Save a list of highlevel documents to the database.
+def save_hl_documents(hl_data_list, build_sha1, logger=None):
+    """Save a list of highlevel documents to the database in one transaction.
+
+    If one of the documents can't be saved, they are saved one at a time instead.
+    A document which still can't be saved is stored as empty, like the results of
+    a submission that the extractor failed to process, so that it isn't fetched again.
 
     Arguments:
         hl_data_list: a tuple of (ll-rowid, mbid, hl_data_json)
-        build_sha1: the sha1 of the hl extractor used"""
+        build_sha1: the sha1 of the hl extractor used
+        logger: the logger to log documents which can't be saved to"""
 
-    for rowid, mbid, hl_data in hl_data_list:
-        db.data.write_high_level(mbid, rowid, hl_data, build_sha1)
+    try:
+        db.data.write_many_high_level(hl_data_list, build_sha1)
+    except db.exceptions.BadDataException:
+        for rowid, mbid, hl_data in hl_data_list:
+            try:
+                db.data.write_many_high_level([(rowid, mbid, hl_data)], build_sha1)
+            except db.exceptions.BadDataException as e:
+                if logger:
+                    logger.error(u"Cannot save highlevel data of {}: {}".format(rowid, e))
+                db.data.write_many_high_level([(rowid, mbid, {})], build_sha1)
+
+
+def _extract_worker(work_queue, read_queue, logger, pool, working_dir_root):
+    """Run the extractor on each set of submissions in ``work_queue`` until it
+    gets None, and put the working directories of the results in ``read_queue``."""
+    while True:
+        data = work_queue.get()
+        if data is None:
+            return
+        try:
+            working_dir = extract_lowlevel_data(data, logger.name, pool, working_dir_root)
+        except HighLevelExtractorError as e:
+            logger.error(u"Error when calling extractor: {}".format(e))
+        except Exception as e:
+            traceback.print_exc()
+            logger.error(u"Unknown error when calling extractor: {}".format(e))
+        else:
+            read_queue.put((working_dir, data))
+
+
+def _read_worker(read_queue, save_queue, logger):
+    """Read the results in each working directory in ``read_queue`` until it
+    gets None, and put them in ``save_queue``."""
+    while True:
+        item = read_queue.get()
+        if item is None:
+            return
+        working_dir, data = item
+        try:
+            save_queue.put(read_highlevel_results(working_dir, data, logger.name))
+        except HighLevelExtractorError as e:
+            logger.error(u"Error when reading extractor results: {}".format(e))
+        except Exception as e:
+            traceback.print_exc()
+            logger.error(u"Unknown error when reading extractor results: {}".format(e))
+
+
+def _save_worker(save_queue, build_sha1, logger):
+    """Save the results in ``save_queue`` until it gets None. All of the results
+    which are waiting, up to SAVE_BATCH_SIZE documents, are saved together."""
+    finished = False
+    while not finished:
+        batch = save_queue.get()
+        if batch is None:
+            return
+        batch = list(batch)
+        while len(batch) < SAVE_BATCH_SIZE:
+            try:
+                hl_data_list = save_queue.get_nowait()
+            except queue.Empty:
+                break
+            if hl_data_list is None:
+                finished = True
+                break
+            batch.extend(hl_data_list)
 
+        try:
+            save_hl_documents(batch, build_sha1, logger)
+            logger.info("Saved {} documents".format(len(batch)))
+        except Exception as e:
+            traceback.print_exc()
+            logger.error(u"Unknown error when saving highlevel documents: {}".format(e))
 
-def main(num_threads=DEFAULT_NUM_THREADS):
-    current_app.logger.info("High-level extractor daemon starting with {} threads".format(num_threads))
-    if num_threads * MAX_ITEMS_PER_PROCESS > DOCUMENTS_PER_QUERY:
-        current_app.logger.warn("Number of threads ({}) * items per thread ({}) = {} is greater than number of "
-                                "documents selected from database ({}), this means that available resources "
-                                "will not be fully utillised".format(
-            num_threads, MAX_ITEMS_PER_PROCESS, (num_threads * MAX_ITEMS_PER_PROCESS), DOCUMENTS_PER_QUERY
-        ))
 
-    try:
-        build_sha1 = get_build_sha1(HIGH_LEVEL_EXTRACTOR_BINARY)
-        create_profile(PROFILE_CONF_TEMPLATE, PROFILE_CONF, build_sha1)
-    except HighLevelConfigurationError as e:
-        current_app.logger.error(u'{}'.format(e))
-        sys.exit(-1)
+def _start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
 
-    num_processed = 0
-    max_ll_id = 0
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-        while True:
-            docs = db.data.get_unprocessed_highlevel_documents(DOCUMENTS_PER_QUERY, max_ll_id)
-            current_app.logger.info("Got {} documents".format(len(docs)))
+def process_documents(build_sha1, logger, num_threads=DEFAULT_NUM_THREADS, pool=None, working_dir_root=None,
+                      keep_running=True):
+    """Compute and save highlevel results of lowlevel submissions which don't have them.
 
-            futures = []
+    The submissions go through a pipeline: this thread fetches them from the database
+    and puts them in a bounded queue in sets of ``MAX_ITEMS_PER_PROCESS``, from which
+    ``num_threads`` threads run the extractor. One thread reads the results and another
+    one saves them. Each stage works on the next submissions while the later stages
+    finish the previous ones, so the extractor threads are kept busy.
+
+    Submissions are claimed for this process for ``db.data.HIGHLEVEL_LEASE_DURATION``
+    seconds when they are fetched, so that any number of extractors can run at the same
+    time, on one or more machines, without processing the same submissions. Only
+    submissions after the last one that was claimed are looked at, except once every
+    lease duration, when the search starts from the first submission again to claim
+    those whose extractor stopped before saving them.
+
+    Arguments:
+        build_sha1: the sha1 of the highlevel extractor binary
+        logger: the logger to log progress to
+        num_threads, pool, working_dir_root: see ``main`` and ``process_lowlevel_data``
+        keep_running: if True, wait for new submissions when all of them have been fetched.
+         Otherwise, return once the submissions which have been fetched are saved
+    """
+    work_queue = queue.Queue(maxsize=num_threads * QUEUED_SETS_PER_THREAD)
+    read_queue = queue.Queue()
+    save_queue = queue.Queue()
+    extractors = [_start_thread(_extract_worker, work_queue, read_queue, logger, pool, working_dir_root)
+                  for _ in range(num_threads)]
+    reader = _start_thread(_read_worker, read_queue, save_queue, logger)
+    saver = _start_thread(_save_worker, save_queue, build_sha1, logger)
+
+    worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    max_ll_id = 0
+    rescan_time = time.time() + db.data.HIGHLEVEL_LEASE_DURATION
+    try:
+        while True:
+            if time.time() >= rescan_time:
+                # Leases of submissions before max_ll_id may have expired since they were claimed
+                max_ll_id = 0
+                rescan_time = time.time() + db.data.HIGHLEVEL_LEASE_DURATION
+            docs = db.data.claim_unprocessed_highlevel_documents(worker, DOCUMENTS_PER_QUERY, max_ll_id)
+            logger.info("Got {} documents".format(len(docs)))
+            if docs:
+                max_ll_id = max(max_ll_id, max([rowid for rowid, _, _ in docs]))
             for subdocs in chunks(docs, MAX_ITEMS_PER_PROCESS):
-                futures.append(executor.submit(process_lowlevel_data, subdocs, current_app.logger.name))
-
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    hl_data_list = future.result()
-                except HighLevelExtractorError as e:
-                    current_app.logger.error(u"Error when calling extractor: {}".format(e))
-                except Exception as e:
-                    traceback.print_exc()
-                    current_app.logger.error(u"Unknown error when calling extractor: {}".format(e))
-                else:
-                    num_processed += len(hl_data_list)
-                    this_max_ll_id = max([rowid for rowid, _, _ in hl_data_list])
-                    max_ll_id = max(max_ll_id, this_max_ll_id)
-                    save_hl_documents(hl_data_list, build_sha1)
+                work_queue.put(subdocs)
 
             # If we got less than the number of documents we asked for then we should wait
             # for a while for some more to appear
             if len(docs) < DOCUMENTS_PER_QUERY:
-                if num_processed > 0:
-                    current_app.logger.info("processed {} documents, none remain. Sleeping.".format(num_processed))
-                num_processed = 0
+                if not keep_running:
+                    break
+                logger.info("No documents remain. Sleeping.")
                 time.sleep(SLEEP_DURATION)
+    finally:
+        # Finish the work which is in each queue, then stop the thread that reads it
+        for _ in extractors:
+            work_queue.put(None)
+        for thread in extractors:
+            thread.join()
+        read_queue.put(None)
+        reader.join()
+        save_queue.put(None)
+        saver.join()
+
+
+def main(num_threads=DEFAULT_NUM_THREADS, server=False, working_dir_root=DEFAULT_WORKING_DIR_ROOT):
+    """Compute highlevel results of all lowlevel submissions which don't have them.
+
+    Arguments:
+        num_threads: the number of sets of submissions to process at the same time
+        server: keep one extractor process per thread running, with its models loaded,
+         instead of running a new process for each set of submissions
+        working_dir_root: the directory to write lowlevel and highlevel files in
+    """
+    current_app.logger.info("High-level extractor daemon starting with {} threads".format(num_threads))
+    if working_dir_root:
+        current_app.logger.info("Writing documents in {}".format(working_dir_root))
+
+    try:
+        build_sha1 = get_build_sha1(HIGH_LEVEL_EXTRACTOR_BINARY)
+        create_profile(PROFILE_CONF_TEMPLATE, PROFILE_CONF, build_sha1)
+    except HighLevelConfigurationError as e:
+        current_app.logger.error(u'{}'.format(e))
+        sys.exit(-1)
+
+    pool = None
+    if server:
+        current_app.logger.info("Running extractor servers")
+        pool = ExtractorPool(num_threads, HIGH_LEVEL_EXTRACTOR_BINARY, PROFILE_CONF)
+        try:
+            pool.check()
+        except HighLevelConfigurationError as e:
+            pool.close()
+            current_app.logger.error(u'{}'.format(e))
+            sys.exit(-1)
+
+    try:
+        process_documents(build_sha1, current_app.logger, num_threads, pool, working_dir_root)
+    finally:
+        if pool:
+            pool.close()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""A stand-in for the high-level extractor binary for tests.
+
+Usage:
+    stub_extractor.py <input> <output> [<input> <output> ...] <profile>
+    stub_extractor.py --server <profile>
+
+The output of each input is {"highlevel": {"stub": {"size": <number of keys in input>}},
+"pid": <process id>}. An input which isn't a JSON object fails.
+"""
+import json
+import os
+import sys
+
+
+def extract(in_path, out_path):
+    with open(in_path) as fp:
+        data = json.load(fp)
+    if not isinstance(data, dict):
+        raise ValueError("input is not a JSON object")
+    with open(out_path, "w") as fp:
+        json.dump({"highlevel": {"stub": {"size": len(data)}}, "pid": os.getpid()}, fp)
+
+
+def main(args):
+    if args[0] == "--server":
+        for line in iter(sys.stdin.readline, ""):
+            try:
+                if line.strip():
+                    in_path, out_path = line.rstrip("\n").split("\t")
+                    extract(in_path, out_path)
+                sys.stdout.write("OK\n")
+            except Exception as e:
+                sys.stdout.write("ERROR {}\n".format(e))
+            sys.stdout.flush()
+        return 0
+
+    paths = args[:-1]
+    for in_path, out_path in zip(paths[::2], paths[1::2]):
+        try:
+            extract(in_path, out_path)
+        except Exception:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
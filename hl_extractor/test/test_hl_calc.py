@@ -1,3 +1,5 @@
+import errno
+import logging
 import os
 import shutil
 import subprocess
@@ -7,8 +9,18 @@ import unittest
 import mock
 import yaml
 
+import db.exceptions
 from hl_extractor import hl_calc
 
+STUB_EXTRACTOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_extractor.py")
+
+
+def open_full(path, mode="r"):
+    """open() on a filesystem which has no space left"""
+    if "w" in mode:
+        raise IOError(errno.ENOSPC, "No space left on device", path)
+    return open(path, mode)
+
 
 class HlCalcTest(unittest.TestCase):
     maxDiff = None
@@ -48,23 +60,28 @@ class HlCalcTest(unittest.TestCase):
         # Some lowlevel files fail to write lowlevel to or read highleve from the temp directory
         mock_mkdtemp.return_value = "/tmp/hl"
         mock_open.side_effect = (mock_open.return_value,  # write lowlevel 1
-                                 IOError,  # write lowlevel 2
-                                 mock_open(os.devnull, 'w'),  # /dev/null for check_call
+                                 IOError)  # write lowlevel 2
+
+        # None of the items are processed if one of them can't be written, so that they are tried again later
+        with self.assertRaises(hl_calc.HighLevelExtractorError):
+            hl_calc.process_lowlevel_data([(1, 'mbid1', '{data}'), (2, 'mbid2', '{data2}')], None)
+        self.assertFalse(mock_check_call.called)
+        mock_rmtree.assert_called_with("/tmp/hl", ignore_errors=True)
+
+        mock_open.side_effect = (mock_open.return_value,  # write lowlevel 1
+                                 mock_open.return_value,  # write lowlevel 2
+                                 mock_open.return_value,  # /dev/null for check_call
                                  mock_open.return_value,  # read highlevel 1
-                                 IOError)  # read highlevel 2
+                                 IOError,  # read highlevel 2
+                                 mock_open.return_value)  # check that highlevel 2 could have been written
 
         results = hl_calc.process_lowlevel_data([(1, 'mbid1', '{data}'), (2, 'mbid2', '{data2}')], None)
 
+        # A highlevel file which the extractor didn't write is an empty result
         assert len(results) == 2
         assert results[0] == (1, 'mbid1', {"data": 1})
         assert results[1] == (2, 'mbid2', {})
 
-        # Even though 2 items were returned, the highlevel extractor was only called with 1 file because the second
-        # file failed to be written
-        mock_check_call.assert_called_with(
-            ['/usr/local/bin/essentia_streaming_extractor_music_svm', '/tmp/hl/1-input.json', '/tmp/hl/1-output.json',
-             '/code/hl_extractor/profile.conf'], stderr=mock.ANY, stdout=mock.ANY)
-
     @mock.patch("__builtin__.open", new_callable=mock.mock_open, read_data="{}")
     @mock.patch("tempfile.mkdtemp")
     @mock.patch("subprocess.check_call")
@@ -97,6 +114,145 @@ class HlCalcTest(unittest.TestCase):
             stdout=mock.ANY)
         mock_rmtree.assert_called_with("/tmp/hl", ignore_errors=True)
 
+    def test_process_lowlevel_data_stub(self):
+        with mock.patch("hl_extractor.hl_calc.HIGH_LEVEL_EXTRACTOR_BINARY", STUB_EXTRACTOR):
+            results = hl_calc.process_lowlevel_data([(1, 'mbid1', '{"a": 1, "b": 2}'), (2, 'mbid2', '[]')], None)
+
+        self.assertEqual(results[0][:2], (1, 'mbid1'))
+        self.assertEqual(results[0][2]["highlevel"], {"stub": {"size": 2}})
+        self.assertEqual(results[1], (2, 'mbid2', {}))
+
+    def test_process_lowlevel_data_pool(self):
+        pool = hl_calc.ExtractorPool(1, STUB_EXTRACTOR, "profile.conf")
+        try:
+            results = hl_calc.process_lowlevel_data([(1, 'mbid1', '{"a": 1}'), (2, 'mbid2', '[]')], None, pool)
+            self.assertEqual(results[0][2]["highlevel"], {"stub": {"size": 1}})
+            self.assertEqual(results[1], (2, 'mbid2', {}))
+            pid = results[0][2]["pid"]
+
+            # The same process handles the next job
+            results = hl_calc.process_lowlevel_data([(3, 'mbid3', '{}')], None, pool)
+            self.assertEqual(results[0][2], {"highlevel": {"stub": {"size": 0}}, "pid": pid})
+
+            # and is restarted if it exits
+            os.kill(pid, 9)
+            server = pool._servers.get()
+            server.process.wait()
+            pool._servers.put(server)
+            results = hl_calc.process_lowlevel_data([(3, 'mbid3', '{}')], None, pool)
+            self.assertNotEqual(pid, results[0][2]["pid"])
+        finally:
+            pool.close()
+
+    def test_extract_then_read(self):
+        root = tempfile.mkdtemp()
+        try:
+            data = [(1, 'mbid1', '{"a": 1}')]
+            with mock.patch("hl_extractor.hl_calc.HIGH_LEVEL_EXTRACTOR_BINARY", STUB_EXTRACTOR):
+                working_dir = hl_calc.extract_lowlevel_data(data, working_dir_root=root)
+            self.assertEqual(root, os.path.dirname(working_dir))
+            self.assertTrue(os.path.exists(os.path.join(working_dir, "1-output.json")))
+
+            results = hl_calc.read_highlevel_results(working_dir, data)
+            self.assertEqual(results[0][2]["highlevel"], {"stub": {"size": 1}})
+            self.assertEqual([], os.listdir(root))
+
+            # The working directory is removed if the extractor fails
+            with mock.patch("hl_extractor.hl_calc.HIGH_LEVEL_EXTRACTOR_BINARY", "/bin/false"):
+                with self.assertRaises(hl_calc.HighLevelExtractorError):
+                    hl_calc.extract_lowlevel_data(data, working_dir_root=root)
+            self.assertEqual([], os.listdir(root))
+        finally:
+            shutil.rmtree(root)
+
+    def test_write_errors(self):
+        root = tempfile.mkdtemp()
+        try:
+            data = [(1, 'mbid1', '{"a": 1}'), (2, 'mbid2', '[]')]
+            # The set isn't processed if an input can't be written
+            with mock.patch("hl_extractor.hl_calc.open", open_full, create=True):
+                with self.assertRaises(hl_calc.HighLevelExtractorError):
+                    hl_calc.extract_lowlevel_data(data, working_dir_root=root)
+            self.assertEqual([], os.listdir(root))
+
+            # A missing result is empty, unless it may not have been written because of a write error
+            with mock.patch("hl_extractor.hl_calc.HIGH_LEVEL_EXTRACTOR_BINARY", STUB_EXTRACTOR):
+                working_dir = hl_calc.extract_lowlevel_data(data, working_dir_root=root)
+            with mock.patch("hl_extractor.hl_calc.open", open_full, create=True):
+                with self.assertRaises(hl_calc.HighLevelExtractorError):
+                    hl_calc.read_highlevel_results(working_dir, data)
+            self.assertEqual([], os.listdir(root))
+        finally:
+            shutil.rmtree(root)
+
+    @mock.patch("hl_extractor.hl_calc.save_hl_documents")
+    @mock.patch("db.data.claim_unprocessed_highlevel_documents")
+    def test_process_documents(self, get_documents, save_documents):
+        get_documents.side_effect = [[(i, 'mbid%s' % i, '{"a": %s}' % i) for i in range(1, 6)],
+                                     [(i, 'mbid%s' % i, '[]') for i in range(6, 8)]]
+        saved = []
+        save_documents.side_effect = lambda hl_data_list, build_sha1, logger: saved.extend(hl_data_list)
+
+        with mock.patch("hl_extractor.hl_calc.HIGH_LEVEL_EXTRACTOR_BINARY", STUB_EXTRACTOR), \
+                mock.patch("hl_extractor.hl_calc.DOCUMENTS_PER_QUERY", 5), \
+                mock.patch("hl_extractor.hl_calc.MAX_ITEMS_PER_PROCESS", 2):
+            hl_calc.process_documents("sha1", logging.getLogger("test_hl_calc"), num_threads=2, keep_running=False)
+
+        self.assertEqual([(5, 0), (5, 5)], [call[0][1:] for call in get_documents.call_args_list])
+        self.assertEqual(list(range(1, 8)), sorted(rowid for rowid, _, _ in saved))
+        for rowid, mbid, hl_data in saved:
+            self.assertEqual('mbid%s' % rowid, mbid)
+            if rowid <= 5:
+                self.assertEqual({"stub": {"size": 1}}, hl_data["highlevel"])
+            else:
+                self.assertEqual({}, hl_data)
+        for call in save_documents.call_args_list:
+            self.assertEqual("sha1", call[0][1])
+
+    @mock.patch("db.data.write_many_high_level")
+    def test_save_hl_documents_bad_document(self, write_many_high_level):
+        docs = [(1, "mbid1", {"highlevel": {}}), (2, "mbid2", {"highlevel": "bad"}), (3, "mbid3", {})]
+
+        def write(documents, build_sha1):
+            if any(data.get("highlevel") == "bad" for _, _, data in documents):
+                raise db.exceptions.BadDataException("data is badly formed")
+        write_many_high_level.side_effect = write
+
+        logger = mock.Mock()
+        hl_calc.save_hl_documents(docs, "sha1", logger)
+        # The other documents of the batch are saved, and the bad one is saved as empty
+        write_many_high_level.assert_has_calls([mock.call(docs, "sha1"),
+                                                mock.call([docs[0]], "sha1"),
+                                                mock.call([docs[1]], "sha1"),
+                                                mock.call([(2, "mbid2", {})], "sha1"),
+                                                mock.call([docs[2]], "sha1")])
+        self.assertEqual(1, logger.error.call_count)
+
+    def test_extractor_server_errors(self):
+        server = hl_calc.ExtractorServer("/does/not/exist", "profile.conf")
+        with self.assertRaises(hl_calc.HighLevelExtractorError):
+            server.extract([("in.json", "out.json")])
+
+        # A process which exits without processing a job
+        server = hl_calc.ExtractorServer("/bin/true", "profile.conf")
+        with self.assertRaises(hl_calc.HighLevelExtractorError):
+            server.extract([("in.json", "out.json")])
+        self.assertIsNone(server.process)
+
+    def test_extractor_pool_check(self):
+        pool = hl_calc.ExtractorPool(2, STUB_EXTRACTOR, "profile.conf")
+        try:
+            pool.check()
+        finally:
+            pool.close()
+
+        # A binary which doesn't support server mode
+        for binary in ["/does/not/exist", "/bin/true"]:
+            pool = hl_calc.ExtractorPool(1, binary, "profile.conf")
+            with self.assertRaises(hl_calc.HighLevelConfigurationError):
+                pool.check()
+            pool.close()
+
     def test_create_profile(self):
         # TODO: Use `with tempfile.TemporaryDirectory` in Python 3
         dirname = tempfile.mkdtemp()
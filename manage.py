@@ -14,6 +14,7 @@ import db.data
 import db.dump
 import db.dump_manage
 import db.exceptions
+import db.lowlevel_features
 import db.submission_stats
 import db.user
 import webserver
@@ -93,6 +94,11 @@ def init_db(archive, force, skip_create_db=False):
     current_app.logger.info('Populating similarity_metrics table...')
     db.run_sql_script(os.path.join(ADMIN_SQL_DIR, 'populate_metrics_table.sql'))
 
+    if archive:
+        # lowlevel_features isn't included in dumps
+        current_app.logger.info('Copying low-level features...')
+        db.lowlevel_features.backfill()
+
     current_app.logger.info("Done!")
 
 
@@ -115,6 +121,10 @@ def import_data(archive, drop_constraints=False):
         db.run_sql_script(os.path.join(ADMIN_SQL_DIR, 'create_primary_keys.sql'))
         db.run_sql_script(os.path.join(ADMIN_SQL_DIR, 'create_foreign_keys.sql'))
 
+    # lowlevel_features isn't included in dumps
+    current_app.logger.info('Copying low-level features...')
+    db.lowlevel_features.backfill()
+
 
 @cli.command(name='import_dataset_data')
 @click.option("--drop-constraints", "-d", is_flag=True, help="Drop primary and foreign keys before importing.")
@@ -182,6 +192,17 @@ def remove_admin(username):
         sys.exit(1)
 
 
+@cli.command(name='backfill_lowlevel_features')
+@click.option("--batch-size", "-b", type=int, default=db.lowlevel_features.BACKFILL_BATCH_SIZE,
+              help="Number of lowlevel ids to read in each transaction.")
+def backfill_lowlevel_features(batch_size):
+    """Copy individual features of submissions which aren't in the
+    lowlevel_features table (e.g. after importing a dump) into it."""
+    current_app.logger.info('Copying low-level features...')
+    num_added = db.lowlevel_features.backfill(batch_size)
+    current_app.logger.info('Done! Added features of %s submissions.' % num_added)
+
+
 @cli.command(name='update_sequences')
 def update_sequences():
     current_app.logger.info('Updating database sequences...')
@@ -0,0 +1,119 @@
+import numpy as np
+
+import similarity.exceptions
+
+"""
+An Annoy index can't have items added to it once it has been built, so new
+submissions are only included in an index the next time that it is rebuilt.
+Until then, recordings which have been added to the similarity.similarity
+table since the index was built are kept in a small "delta" of vectors which
+is searched by brute force, and whose results are merged with those from the
+index when it is queried.
+"""
+
+# Distance types that a delta can compute, with the same definitions as Annoy
+DELTA_DISTANCE_TYPES = ["angular", "euclidean", "manhattan"]
+
+
+class IndexDelta(object):
+    def __init__(self, distance_type, ids, vectors, recordings):
+        """
+        Args:
+            distance_type: distance measure of the index that this delta
+            belongs to, one of DELTA_DISTANCE_TYPES.
+            ids: a list of lowlevel.ids of the recordings in the delta.
+            vectors: a list of metric vectors, one for each id.
+            recordings: a list of (MBID, offset) tuples, one for each id.
+        """
+        if distance_type not in DELTA_DISTANCE_TYPES:
+            raise similarity.exceptions.SimilarityException(
+                "Distance type {} is not supported for a delta.".format(distance_type))
+        self.distance_type = distance_type
+        self.ids = np.array(ids, dtype=np.int64)
+        if ids:
+            self.vectors = np.array(vectors, dtype=np.float32)
+        else:
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.recordings = dict(zip(ids, recordings))
+        self.positions = {id: position for position, id in enumerate(ids)}
+        if distance_type == "angular":
+            self.vectors = self._normalize(self.vectors)
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.sqrt(np.sum(vectors * vectors, axis=-1, keepdims=True))
+        # Zero vectors stay as zero vectors
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.positions
+
+    def get_vector(self, id):
+        """Get the vector for an id in the delta. For an angular
+        delta, the vector is normalized."""
+        return self.vectors[self.positions[id]].tolist()
+
+    def get_recordings(self, ids):
+        """Get (MBID, offset) for each of the given ids, (None, None) if
+        the id isn't in the delta."""
+        return [self.recordings.get(id, (None, None)) for id in ids]
+
+    def get_distances(self, vector):
+        """Compute the distance from a vector to every item in the delta."""
+        vector = np.array(vector, dtype=np.float32)
+        if self.distance_type == "angular":
+            # Annoy's angular distance is sqrt(2(1 - cos(u, v)))
+            cosine = np.dot(self.vectors, self._normalize(vector))
+            return np.sqrt(np.maximum(2 - 2 * cosine, 0))
+        elif self.distance_type == "euclidean":
+            return np.sqrt(np.sum((self.vectors - vector) ** 2, axis=1))
+        else:
+            return np.sum(np.abs(self.vectors - vector), axis=1)
+
+    def get_distance(self, vector_1, vector_2):
+        """Compute the distance between two vectors."""
+        vector_1 = np.array(vector_1, dtype=np.float32)
+        vector_2 = np.array(vector_2, dtype=np.float32)
+        if self.distance_type == "angular":
+            cosine = np.dot(self._normalize(vector_1), self._normalize(vector_2))
+            return float(np.sqrt(max(2 - 2 * cosine, 0)))
+        elif self.distance_type == "euclidean":
+            return float(np.sqrt(np.sum((vector_1 - vector_2) ** 2)))
+        else:
+            return float(np.sum(np.abs(vector_1 - vector_2)))
+
+    def get_nns_by_vector(self, vector, num_neighbours):
+        """Get the items in the delta which are closest to a vector.
+
+        Returns:
+            A tuple (<lowlevel.ids>, <distances>), ordered with the closest first.
+        """
+        if not len(self):
+            return [], []
+        distances = self.get_distances(vector)
+        num_neighbours = min(num_neighbours, len(distances))
+        closest = np.argpartition(distances, num_neighbours - 1)[:num_neighbours]
+        closest = closest[np.argsort(distances[closest], kind="mergesort")]
+        return self.ids[closest].tolist(), distances[closest].tolist()
+
+
+def merge_nns(nns, delta_nns, num_neighbours):
+    """Merge results from an index and from its delta into a single list
+    of the closest items.
+
+    Args:
+        nns: a tuple (<lowlevel.ids>, <distances>) from the index.
+        delta_nns: a tuple (<lowlevel.ids>, <distances>) from the delta.
+        num_neighbours: the number of items to return.
+
+    Returns:
+        A tuple (<lowlevel.ids>, <distances>), ordered with the closest first.
+    """
+    items = list(zip(*nns)) + list(zip(*delta_nns))
+    items.sort(key=lambda item: item[1])
+    items = items[:num_neighbours]
+    return [id for id, _ in items], [distance for _, distance in items]
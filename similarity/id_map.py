@@ -0,0 +1,102 @@
+import os
+import uuid
+
+import numpy as np
+
+"""
+Similarity indices return similar items as lowlevel.ids, which we need to
+convert to (MBID, offset) before returning them. Rather than looking these
+up in the database for every query, we save a table mapping each lowlevel.id
+in an index to its (MBID, offset) next to the index file. The table is an
+array indexed by lowlevel.id, where each item holds the 16 bytes of the MBID
+and the submission offset (-1 for ids which are not present).
+"""
+
+ID_MAP_DTYPE = np.dtype([('gid', 'V16'), ('offset', '<i4')])
+
+# Number of rows to convert to an array at a time when building a map
+BUILD_BATCH_SIZE = 100000
+
+
+def get_id_map_path(index_path):
+    """Get the path of the id map which is saved alongside an index file."""
+    return os.path.splitext(index_path)[0] + '.ids.npy'
+
+
+class RecordingIdMap(object):
+    def __init__(self, data):
+        """
+        Args:
+            data: a numpy array with ID_MAP_DTYPE, indexed by lowlevel.id.
+        """
+        self.data = data
+
+    @classmethod
+    def from_recordings(cls, recordings, max_id):
+        """Build a map from (id, mbid, offset) rows.
+
+        Args:
+            recordings: an iterable of (lowlevel.id, MBID, offset) tuples.
+            max_id: the highest lowlevel.id which will be in the map.
+        """
+        data = np.zeros(max_id + 1, dtype=ID_MAP_DTYPE)
+        data['offset'] = -1
+
+        def add_batch(batch):
+            if not batch:
+                return
+            ids, gids, offsets = zip(*batch)
+            ids = np.array(ids)
+            data['gid'][ids] = np.frombuffer(b''.join(uuid.UUID(str(gid)).bytes for gid in gids), dtype='V16')
+            data['offset'][ids] = offsets
+
+        batch = []
+        for row in recordings:
+            batch.append(tuple(row))
+            if len(batch) >= BUILD_BATCH_SIZE:
+                add_batch(batch)
+                batch = []
+        add_batch(batch)
+        return cls(data)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a saved id map.
+
+        Raises:
+            IOError: if there is no id map saved at this path.
+        """
+        return cls(np.load(path, mmap_mode='r'))
+
+    def save(self, path):
+        # Write to a temporary file and move it into place, so that
+        # processes which have the existing file mapped are not affected.
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, self.data)
+        os.rename(temp_path, path)
+
+    def get_recordings(self, ids):
+        """Get (MBID, offset) for a list of lowlevel.ids.
+
+        Returns:
+            a list of (MBID, offset) tuples in the same order as ``ids``.
+            If an id is not in the map, (None, None) is used.
+        """
+        recordings = []
+        for id in ids:
+            if not 0 <= id < len(self.data):
+                recordings.append((None, None))
+                continue
+            gid, offset = self.data[id]
+            if offset < 0:
+                recordings.append((None, None))
+            else:
+                recordings.append((str(uuid.UUID(bytes=gid.tobytes())), int(offset)))
+        return recordings
+
+    def __contains__(self, id):
+        return 0 <= id < len(self.data) and self.data['offset'][id] >= 0
+
+    def __len__(self):
+        return len(self.data)
@@ -1,17 +1,21 @@
 import os
+import threading
+import time
 
 from flask import current_app
 
 import similarity.exceptions
+from similarity.id_map import RecordingIdMap, get_id_map_path
+from similarity.delta import IndexDelta, merge_nns
 import db.similarity
 import db.data
-import db.exceptions
 
 from annoy import AnnoyIndex
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 class AnnoyModel(object):
-    def __init__(self, metric_name, n_trees=10, distance_type='angular', load_existing=False):
+    def __init__(self, metric_name, n_trees=10, distance_type='angular', load_existing=False, dimensionality=None):
         """
         Args:
             - metric_name: the name of the metric that vectors in the index will
@@ -22,11 +26,25 @@ class AnnoyModel(object):
               "angular", "euclidean", "manhattan", "hamming", or "dot".
             - load_existing: if load_existing is True, then load function will be
               called upon initialization.
+            - dimensionality: the number of dimensions of the metric vectors. If
+              None, it is looked up in the similarity.similarity table.
         """
         # Check params
         self.parse_initial_params(metric_name, n_trees, distance_type)
-        self.dimensionality = db.similarity.get_metric_dimensionality(self.metric_name)
+        if dimensionality is None:
+            dimensionality = db.similarity.get_metric_dimensionality(self.metric_name)
+        self.dimensionality = dimensionality
         self.index = AnnoyIndex(self.dimensionality, metric=self.distance_type)
+        # Maps lowlevel.ids in the index to (MBID, offset). If this is not
+        # available, ids are looked up in the database.
+        self.id_map = None
+        # Recordings added to the similarity table since the index was built,
+        # which are searched alongside the index. See `refresh_delta`.
+        self.delta = None
+        self.delta_loaded_at = None
+        self._delta_lock = threading.Lock()
+        # Held while the delta is being reloaded in the background, see `start_delta_refresh`
+        self._delta_refresh_lock = threading.Lock()
 
         # in_loaded_state set to True if the index is built, loaded, or saved.
         # At any of these points, items can no longer be added to the index.
@@ -51,10 +69,16 @@ class AnnoyModel(object):
         else:
             raise similarity.exceptions.IndexNotFoundException('Index for specified number of trees is not possible.')
 
-    def build(self):
+    def build(self, n_jobs=None):
         """Build and load the index using the specified number of trees. An index
-        must be built before it can be queried."""
-        n_jobs = current_app.config['SIMILARITY_BUILD_NUM_JOBS']
+        must be built before it can be queried.
+
+        Args:
+            n_jobs: the number of threads to build the index with. If None,
+            the value of SIMILARITY_BUILD_NUM_JOBS is used.
+        """
+        if n_jobs is None:
+            n_jobs = current_app.config['SIMILARITY_BUILD_NUM_JOBS']
         self.index.build(n_trees=self.n_trees, n_jobs=n_jobs)
         self.in_loaded_state = True
 
@@ -69,9 +93,16 @@ class AnnoyModel(object):
         except OSError:
             if not os.path.isdir(location):
                 raise
-        name = '_'.join([name or self.metric_name, self.distance_type, str(self.n_trees)]) + '.ann'
-        file_path = os.path.join(location, name)
-        self.index.save(file_path)
+        file_path = get_index_path(name or self.metric_name, self.distance_type, self.n_trees, location)
+        # The id map is replaced before the index, so that a process loading
+        # the new index will always find a matching id map.
+        if self.id_map is not None:
+            self.id_map.save(get_id_map_path(file_path))
+        # Save to a temporary file and move it into place, so that processes
+        # which have the existing index memory-mapped are not affected.
+        temp_path = file_path + '.tmp'
+        self.index.save(temp_path)
+        os.rename(temp_path, file_path)
 
     def load(self, name=None):
         """
@@ -82,14 +113,16 @@ class AnnoyModel(object):
             IndexNotFoundException: if there is no saved index with the given parameters.
         """
         # Load and build an existing annoy index.
-        file_path = current_app.config['SIMILARITY_INDEX_DIR']
-        name = '_'.join([name or self.metric_name, self.distance_type, str(self.n_trees)]) + '.ann'
-        full_path = os.path.join(file_path, name)
+        full_path = get_index_path(name or self.metric_name, self.distance_type, self.n_trees)
         try:
             self.index.load(full_path)
             self.in_loaded_state = True
         except IOError:
             raise similarity.exceptions.IndexNotFoundException
+        try:
+            self.id_map = RecordingIdMap.load(get_id_map_path(full_path))
+        except IOError:
+            self.id_map = None
 
     def add_recording_by_mbid(self, mbid, offset):
         """Add a single recording specified by (mbid, offset) to the index.
@@ -146,6 +179,92 @@ class AnnoyModel(object):
 
         self.index.add_item(id, vector)
 
+    def refresh_delta(self, interval, max_items):
+        """Load the recordings which have been added to the similarity table since
+        this index was built, so that they can be returned by queries before the
+        index is rebuilt. The delta is only reloaded if it is older than `interval`.
+
+        Args:
+            interval: the number of seconds after which the delta should be reloaded.
+            max_items: the maximum number of recordings to keep in the delta.
+        """
+        if not self.in_loaded_state:
+            raise similarity.exceptions.LoadStateException('Index must be loaded before adding a delta.')
+        with self._delta_lock:
+            if self.delta_loaded_at is not None and time.time() - self.delta_loaded_at < interval:
+                return
+            max_indexed_id = self.index.get_n_items() - 1
+            rows = db.similarity.get_similarity_delta(self.metric_name, max_indexed_id, max_items)
+            if len(rows) == max_items:
+                current_app.logger.warning("Similarity delta for index {} is full ({} items), "
+                                           "the index should be rebuilt".format(self.metric_name, max_items))
+            ids = [row[0] for row in rows]
+            vectors = [row[1] for row in rows]
+            recordings = [(row[2], row[3]) for row in rows]
+            self.delta = IndexDelta(self.distance_type, ids, vectors, recordings)
+            self.delta_loaded_at = time.time()
+
+    def start_delta_refresh(self, interval, max_items):
+        """Reload the delta with `refresh_delta` in a background thread if it is
+        older than `interval`, unless it is already being reloaded. Queries use
+        the previous delta (or only the index) until the new one is loaded.
+
+        Returns:
+            the thread which reloads the delta, or None if it isn't reloaded.
+        """
+        if self.delta_loaded_at is not None and time.time() - self.delta_loaded_at < interval:
+            return None
+        if not self._delta_refresh_lock.acquire(False):
+            return None
+        app = current_app._get_current_object()
+
+        def refresh():
+            try:
+                with app.app_context():
+                    self.refresh_delta(interval, max_items)
+            except Exception as e:
+                app.logger.error("Error loading the similarity delta for index {}: {}".format(self.metric_name, e),
+                                 exc_info=True)
+            finally:
+                self._delta_refresh_lock.release()
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _query_nns_by_id(self, id, num_neighbours):
+        """Query the index and its delta for the most similar items to a
+        recording with the specified id, without resolving them to (MBID, offset).
+
+        Returns:
+            A tuple (<lowlevel.ids>, <distances>).
+
+        Raises:
+            ItemNotFoundException: if the item is not indexed.
+        """
+        delta = self.delta
+        if self.id_map is not None and id not in self.id_map and not (delta and id in delta):
+            # Ids which are missing from the similarity table are left out of
+            # the index, but Annoy would treat them as zero vectors.
+            raise similarity.exceptions.ItemNotFoundException('The item you are requesting is not indexed.')
+        if not delta:
+            try:
+                return self.index.get_nns_by_item(id, num_neighbours, include_distances=True)
+            except IndexError:
+                raise similarity.exceptions.ItemNotFoundException('The item you are requesting is not indexed.')
+
+        if id in delta:
+            vector = delta.get_vector(id)
+            nns = self.index.get_nns_by_vector(vector, num_neighbours, include_distances=True)
+        else:
+            try:
+                nns = self.index.get_nns_by_item(id, num_neighbours, include_distances=True)
+                vector = self.index.get_item_vector(id)
+            except IndexError:
+                raise similarity.exceptions.ItemNotFoundException('The item you are requesting is not indexed.')
+        return merge_nns(nns, delta.get_nns_by_vector(vector, num_neighbours), num_neighbours)
+
     def get_nns_by_id(self, id, num_neighbours):
         """Get the most similar recordings for a recording with the
            specified id.
@@ -162,24 +281,103 @@ class AnnoyModel(object):
             <recordings> is a list of tuples (MBID, offset),
             and <distances> is a list of distances, corresponding to each similar recording.
         """
-        try:
-            items = self.index.get_nns_by_item(id, num_neighbours, include_distances=True)
-        except IndexError:
-            raise similarity.exceptions.ItemNotFoundException('The item you are requesting is not indexed.')
-
-        # Unpack to get ids and distances
-        ids = items[0]
-        distances = items[1]
-        recordings = db.data.get_mbids_by_ids(ids)
+        ids, distances = self._query_nns_by_id(id, num_neighbours)
+        recordings = self.get_recordings_by_ids(ids)
         return ids, recordings, distances
 
+    def get_recordings_by_ids(self, ids):
+        """Get (MBID, offset) for a list of lowlevel.ids in the index, using
+        the id map saved with the index if it is available. Ids in the delta
+        are resolved from the delta.
+
+        Returns:
+            a list of (MBID, offset) tuples in the same order as ``ids``.
+            If an id doesn't exist, (None, None) is used.
+        """
+        delta = self.delta
+        if delta:
+            index_ids = [id for id in ids if id not in delta]
+        else:
+            index_ids = ids
+
+        if not index_ids:
+            index_recordings = []
+        elif self.id_map is not None:
+            index_recordings = self.id_map.get_recordings(index_ids)
+        else:
+            index_recordings = db.data.get_mbids_by_ids(index_ids)
+        if not delta:
+            return index_recordings
+
+        delta_ids = [id for id in ids if id in delta]
+        id_to_recording = dict(zip(index_ids, index_recordings))
+        id_to_recording.update(zip(delta_ids, delta.get_recordings(delta_ids)))
+        return [id_to_recording[id] for id in ids]
+
+    def get_bulk_nns_by_ids(self, ids, num_neighbours, n_jobs=None):
+        """Get the most similar recordings for many recordings, specified by
+        their lowlevel.ids.
+
+        All queries are made to the index before the similar items are resolved
+        to (MBID, offset) with a single lookup in the id map, or a single database
+        query if the index has no id map. Annoy releases the GIL while
+        searching the index, so queries can be run in parallel across a number of threads.
+
+        Args:
+            ids: a list of non-negative integer lowlevel.ids.
+
+            num_neighbours: positive integer, number of similar recordings
+            to be returned for each id.
+
+            n_jobs: the number of threads to query the index with. If None,
+            the value of SIMILARITY_QUERY_NUM_JOBS is used.
+
+        Returns:
+            A list with one item for each id in ``ids``. Each item is a tuple
+            (<lowlevel.ids>, <recordings>, <distances>) as returned by
+            ``get_nns_by_id``, or None if the id is not indexed.
+        """
+        if n_jobs is None:
+            n_jobs = current_app.config.get('SIMILARITY_QUERY_NUM_JOBS', 1)
+
+        def query(id):
+            try:
+                return self._query_nns_by_id(id, num_neighbours)
+            except similarity.exceptions.ItemNotFoundException:
+                return None
+
+        if n_jobs > 1 and len(ids) > 1:
+            with ThreadPoolExecutor(max_workers=min(n_jobs, len(ids))) as executor:
+                results = list(executor.map(query, ids))
+        else:
+            results = [query(id) for id in ids]
+
+        similar_ids = set()
+        for result in results:
+            if result:
+                similar_ids.update(result[0])
+        similar_ids = list(similar_ids)
+        id_to_recording = {}
+        if similar_ids:
+            id_to_recording = dict(zip(similar_ids, self.get_recordings_by_ids(similar_ids)))
+
+        nns = []
+        for result in results:
+            if result is None:
+                nns.append(None)
+                continue
+            result_ids, distances = result
+            recordings = [id_to_recording[result_id] for result_id in result_ids]
+            nns.append((result_ids, recordings, distances))
+        return nns
+
     def get_nns_by_mbid(self, mbid, offset, num_neighbours):
         # Find corresponding lowlevel.id to (mbid, offset) combination,
         # then call get_nns_by_id
         lookup = self.get_bulk_nns_by_mbid([(mbid, offset)], num_neighbours)
         return lookup.get(mbid, {}).get(str(offset), [])
 
-    def get_bulk_nns_by_mbid(self, recordings, num_neighbours):
+    def get_bulk_nns_by_mbid(self, recordings, num_neighbours, n_jobs=None):
         """Get most similar recordings for each (MBID, offset) tuple provided.
         Similar recordings list returned is ordered with the most similar at
         index 0.
@@ -191,6 +389,9 @@ class AnnoyModel(object):
             num_neighbours (int): the number of similar recordings desired
             for each recording specified.
 
+            n_jobs (int): the number of threads to query the index with.
+            See ``get_bulk_nns_by_ids``.
+
         Returns:
             a dictionary of the mbids and offsets given in the recordings parameter.
             Each item is a list of dictionaries, containing the keys recording_mbid, offset, and distance:
@@ -209,17 +410,21 @@ class AnnoyModel(object):
         recordings_info = defaultdict(dict)
 
         ids = db.data.get_ids_by_mbids(recordings)
-        for recording_id, (mbid, offset) in zip(ids, recordings):
-            try:
-                ids, similar_recordings, distances = self.get_nns_by_id(recording_id, num_neighbours)
-                data = []
-                for recording, distance in zip(similar_recordings, distances):
-                    data.append({'recording_mbid': recording[0], 
-                                 'offset': recording[1], 
-                                 'distance': distance})
-                recordings_info[mbid][str(offset)] = data
-            except (similarity.exceptions.ItemNotFoundException, db.exceptions.NoDataFoundException):
+        # Recordings which aren't in the database are skipped
+        queries = [(recording_id, recording) for recording_id, recording in zip(ids, recordings)
+                   if recording_id is not None]
+        results = self.get_bulk_nns_by_ids([recording_id for recording_id, _ in queries], num_neighbours, n_jobs)
+        for (_, (mbid, offset)), result in zip(queries, results):
+            if result is None:
+                # Recording is not indexed
                 continue
+            _, similar_recordings, distances = result
+            data = []
+            for recording, distance in zip(similar_recordings, distances):
+                data.append({'recording_mbid': recording[0],
+                             'offset': recording[1],
+                             'distance': distance})
+            recordings_info[mbid][str(offset)] = data
 
         return recordings_info
 
@@ -238,12 +443,103 @@ class AnnoyModel(object):
         id_1, id_2 = db.data.get_ids_by_mbids([rec_one, rec_two])
         if id_1 is None or id_2 is None:
             return None
+        delta = self.delta
         try:
+            if delta and (id_1 in delta or id_2 in delta):
+                vectors = [delta.get_vector(id) if id in delta else self.index.get_item_vector(id)
+                           for id in (id_1, id_2)]
+                return delta.get_distance(vectors[0], vectors[1])
             return self.index.get_distance(id_1, id_2)
         except IndexError:
             return None
 
 
+def get_index_path(name, distance_type, n_trees, location=None):
+    """Get the path of the file that an index with the given parameters
+    is saved to. If location is None, the configured SIMILARITY_INDEX_DIR
+    is used."""
+    if not location:
+        location = current_app.config['SIMILARITY_INDEX_DIR']
+    file_name = '_'.join([name, distance_type, str(n_trees)]) + '.ann'
+    return os.path.join(location, file_name)
+
+
+# Indices loaded by this process, keyed by (metric_name, distance_type, n_trees).
+# Each value is a tuple (AnnoyModel, file signature at the time of loading).
+_loaded_indices = {}
+_loaded_indices_lock = threading.Lock()
+# Vector dimensionality of each metric, so that it is only queried once
+_metric_dimensionality = {}
+
+
+def _get_file_signature(path):
+    """Identify the version of a file on disk, so that we can tell
+    when an index has been rebuilt and replaced."""
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def get_index(metric_name, n_trees=10, distance_type='angular'):
+    """Get a loaded index from the process-wide index registry.
+
+    An index is loaded the first time that it is requested and is then
+    reused by all subsequent calls in this process. If the index file
+    on disk has been replaced since it was loaded (e.g. by rebuilding
+    it with `similarity.manage add-index`), the new file is loaded
+    in its place.
+
+    If SIMILARITY_DELTA_REFRESH_INTERVAL is set, recordings which have been
+    added to the similarity table since the index was built are also loaded
+    and searched alongside the index. They are reloaded at this interval in a
+    background thread, so that requests don't wait for them.
+
+    Raises:
+        IndexNotFoundException: if the index parameters are not valid
+        or there is no saved index with the given parameters.
+    """
+    key = (metric_name, distance_type, n_trees)
+    if metric_name not in BASE_INDICES:
+        raise similarity.exceptions.IndexNotFoundException('Index for specified metric is not possible.')
+    try:
+        signature = _get_file_signature(get_index_path(metric_name, distance_type, n_trees))
+    except OSError:
+        raise similarity.exceptions.IndexNotFoundException
+
+    loaded = _loaded_indices.get(key)
+    if loaded and loaded[1] == signature:
+        index = loaded[0]
+    else:
+        index = _load_index(key, signature)
+
+    delta_interval = current_app.config.get('SIMILARITY_DELTA_REFRESH_INTERVAL')
+    if delta_interval is not None:
+        index.start_delta_refresh(delta_interval, current_app.config.get('SIMILARITY_DELTA_MAX_ITEMS', 100000))
+    return index
+
+
+def _load_index(key, signature):
+    metric_name, distance_type, n_trees = key
+    with _loaded_indices_lock:
+        # Another thread may have loaded the index while we were waiting
+        loaded = _loaded_indices.get(key)
+        if loaded and loaded[1] == signature:
+            return loaded[0]
+
+        if metric_name not in _metric_dimensionality:
+            _metric_dimensionality[metric_name] = db.similarity.get_metric_dimensionality(metric_name)
+        index = AnnoyModel(metric_name, n_trees=n_trees, distance_type=distance_type,
+                           load_existing=True, dimensionality=_metric_dimensionality[metric_name])
+        _loaded_indices[key] = (index, signature)
+        return index
+
+
+def clear_index_registry():
+    """Remove all indices and cached dimensionalities from the index registry."""
+    with _loaded_indices_lock:
+        _loaded_indices.clear()
+        _metric_dimensionality.clear()
+
+
 """
 A dictionary to track the base indices that should be built.
 Naming convention for a saved index is "<metric_name>_<distance_type>_<n_trees>.ann"
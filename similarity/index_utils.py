@@ -1,9 +1,10 @@
 import os
 
-from flask import current_app
+import numpy as np
 
 import similarity.metrics
-from similarity.index_model import AnnoyModel
+from similarity.index_model import AnnoyModel, get_index_path
+from similarity.id_map import get_id_map_path
 
 from collections import defaultdict
 
@@ -44,28 +45,49 @@ def initialize_indices(n_trees="10", distance_type="angular", load_existing=Fals
 
 
 def remove_index(metric, n_trees=10, distance_type="angular"):
-    """Deletes the static index originally saved when an index is computed."""
-    file_path = current_app.config['SIMILARITY_INDEX_DIR']
-    name = '_'.join([metric, distance_type, str(n_trees)]) + '.ann'
-    full_path = os.path.join(file_path, name)
-    if os.path.exists(full_path):
-        os.remove(full_path)
+    """Deletes the static index originally saved when an index is computed,
+    and its id map."""
+    full_path = get_index_path(metric, distance_type, n_trees)
+    for path in [full_path, get_id_map_path(full_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_missing_ids(ids):
+    """Find the gaps in a sorted list of ids.
+
+    Args:
+        ids (list): A sorted list of ids.
+
+    Returns:
+        A numpy array of the ids between 0 and max(ids) which are not in ``ids``.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(ids):
+        return ids
+    max_id = ids[-1]
+    present = np.zeros(max_id, dtype=bool)
+    present[ids[ids < max_id]] = True
+    return np.flatnonzero(~present)
 
 
 def add_empty_rows(index, ids):
     """Annoy index will allocate space for max(id) + 1 items.
-    Since there are some gaps with empty rows in the db, we
-    need to insert placeholder vectors so that Annoy does
-    not initialize unpredictable vectors in their place.
+    Insert placeholder vectors of the form [0, ..., 0] for the gaps
+    with empty rows in the db.
+
+    Ids which are never added to an index are left out of it when
+    it is built, so placeholders are not needed to build an index.
+    Unlike ids which are not added, placeholders can be returned as
+    similar items.
 
     Args:
         index: An initialized Annoy index.
 
-        ids (list): A list of ids which should be added to the index.
+        ids (list): A sorted list of ids which should be added to the index.
         Will be used to find empty rows.
     """
-    missing_ids = set(range(ids[len(ids)-1])) - set(ids)
-    for id in missing_ids:
-        placeholder = [0] * index.dimensionality
-        index.add_recording_with_vector(id, placeholder)
+    placeholder = [0] * index.dimensionality
+    for id in get_missing_ids(ids):
+        index.add_recording_with_vector(int(id), placeholder)
     return index
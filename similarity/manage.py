@@ -1,17 +1,22 @@
 from __future__ import print_function
+import random
+import timeit
+
 from flask.cli import FlaskGroup
 import click
 
 import webserver
 import similarity.index_utils
-from similarity.index_model import AnnoyModel
+from similarity.index_model import AnnoyModel, get_index
 import db
+import db.data
 import db.similarity
 import db.similarity_stats
 
 NORMALIZATION_SAMPLE_SIZE = 10000
 ADD_METRICS_BATCH_SIZE = 10000
 ADD_INDEX_BATCH_SIZE = 100000
+ADD_INDICES_PROCESSES = 4
 
 cli = FlaskGroup(add_default_commands=False, create_app=webserver.create_app_flaskgroup)
 
@@ -47,13 +52,19 @@ def init(ctx, batch_size, sample_size, force, n_trees, distance_type):
 @click.option("--force", "-f", default=False, help="Remove existing stats before computing.")
 @click.option("--sample-size", "-s", type=int, default=NORMALIZATION_SAMPLE_SIZE,
               help="Override normalization lowlevel data sample size. Must be >= 1% of lowlevel_json entries.")
-def compute_stats(sample_size, force):
+@click.option("--full", is_flag=True, help="Compute stats over every submission instead of a sample.")
+@click.option("--processes", "-p", type=int, default=1, help="Number of processes to read submissions with \
+                                                             when using --full.")
+def compute_stats(sample_size, force, full, processes):
     """Computes the mean and standard deviation for
     lowlevel features that are associated with the
     normalized metrics.
 
     Stats are computed using a sample of items from the
-    lowlevel_json table, configured using `--sample-size`.
+    lowlevel_json table, configured using `--sample-size`,
+    or over every item with `--full`. Stats computed with
+    `--full` replace any existing stats, and can be updated
+    with new submissions using `update-stats`.
 
     Adds these statistics to the similarity.similarity_stats
     table with the corresponding metric.
@@ -65,13 +76,35 @@ def compute_stats(sample_size, force):
         - Weighted GFCCs
     """
     click.echo("Computing stats...")
-    db.similarity_stats.compute_stats(sample_size, force=force)
+    if full:
+        db.similarity_stats.compute_stats_streaming(processes=processes)
+    else:
+        db.similarity_stats.compute_stats(sample_size, force=force)
+    click.echo("Finished!")
+
+
+@cli.command(name="update-stats")
+@click.option("--processes", "-p", type=int, default=1, help="Number of processes to read submissions with.")
+def update_stats(processes):
+    """Updates stats computed with `compute-stats --full`
+    with the submissions that have been added since.
+
+    Metrics which are already in the similarity.similarity
+    table are not normalized again with the new stats.
+    """
+    click.echo("Updating stats...")
+    db.similarity_stats.update_stats(processes=processes)
     click.echo("Finished!")
 
 
 @cli.command(name="add-metrics")
 @click.option("--batch-size", "-b", type=int, default=ADD_METRICS_BATCH_SIZE, help="Override processing batch size.")
-def add_metrics(batch_size):
+@click.option("--copy", "use_copy", is_flag=True, help="Insert rows with COPY instead of INSERT.")
+@click.option("--unlogged", is_flag=True, help="Make the similarity table unlogged while adding rows. \
+                                                The table is emptied if the database crashes before it is finished.")
+@click.option("--processes", "-p", type=int, default=1, help="Number of processes to fetch and transform batches \
+                                                             with, while another process writes them.")
+def add_metrics(batch_size, use_copy, unlogged, processes):
     """Computes all 12 base metrics for each recording
     in the lowlevel table, inserting these values in
     the similarity.similarity table.
@@ -85,7 +118,7 @@ def add_metrics(batch_size):
         Suggested value between 10 000 and 20 000.
     """
     click.echo("Adding all metrics...")
-    db.similarity.add_metrics(batch_size)
+    db.similarity.add_metrics(batch_size, use_copy=use_copy, unlogged=unlogged, processes=processes)
     click.echo("Finished adding all metrics, exiting...")
 
 
@@ -120,7 +153,11 @@ def add_index(metric, batch_size, n_trees, distance_type):
                                                             Tradeoff: more trees gives more precision, \
                                                             but takes longer to build.")
 @click.option("--batch_size", "-b", type=int, default=ADD_INDEX_BATCH_SIZE, help="Size of batches")
-def add_indices(batch_size, n_trees, distance_type):
+@click.option("--single-pass", is_flag=True, help="Read the similarity table once for all indices and build them \
+                                                   in parallel. All indices must fit in memory at the same time.")
+@click.option("--processes", "-p", type=int, default=ADD_INDICES_PROCESSES, help="Number of indices to build at \
+                                                                                  the same time with --single-pass.")
+def add_indices(batch_size, n_trees, distance_type, single_pass, processes):
     """Creates an annoy index then adds all recordings to the index,
     for each of the base metrics.
 
@@ -132,9 +169,13 @@ def add_indices(batch_size, n_trees, distance_type):
     ids = db.similarity.get_similarity_ids()
     click.echo("Initializing indices...")
     indices = similarity.index_utils.initialize_indices(n_trees=n_trees, distance_type=distance_type)
-    for index in indices:
-        click.echo("Adding index: {}".format(index.metric_name))
-        db.similarity.add_index(index, num_ids, ids, batch_size=batch_size)
+    if single_pass:
+        click.echo("Adding indices: {}".format(", ".join(index.metric_name for index in indices)))
+        db.similarity.add_indices(indices, num_ids, ids, batch_size=batch_size, processes=processes)
+    else:
+        for index in indices:
+            click.echo("Adding index: {}".format(index.metric_name))
+            db.similarity.add_index(index, num_ids, ids, batch_size=batch_size)
     click.echo("Finished adding all indices. Exiting...")
 
 
@@ -180,3 +221,36 @@ def remove_indices(n_trees, distance_type):
         click.echo("Removing index: {}".format(metric))
         similarity.index_utils.remove_index(metric, n_trees=n_trees, distance_type=distance_type)
     click.echo("Finished.")
+
+
+@cli.command(name='benchmark-queries')
+@click.argument("metric")
+@click.option("--distance_type", "-d", default='angular', help="Method of measuring distance between metric vectors.")
+@click.option("--n_trees", "-n", type=int, default=10, help="Number of trees of the index to query.")
+@click.option("--num-recordings", "-r", type=int, default=25, help="Number of recordings to query in each bulk lookup.")
+@click.option("--n-neighbours", type=int, default=200, help="Number of similar recordings to get for each recording.")
+@click.option("--n-jobs", "-j", type=int, default=1, help="Number of threads to query the index with.")
+@click.option("--repeat", type=int, default=10, help="Number of times to repeat each lookup.")
+def benchmark_queries(metric, distance_type, n_trees, num_recordings, n_neighbours, n_jobs, repeat):
+    """Compares the time taken to look up similar recordings for a
+    random selection of recordings one at a time (one database query
+    per recording) and with a single bulk lookup.
+
+    The index with the specified parameters must already exist.
+    """
+    index = get_index(metric, n_trees=n_trees, distance_type=distance_type)
+    ids = db.similarity.get_similarity_ids()
+    ids = random.sample(ids, min(num_recordings, len(ids)))
+
+    def single_lookups():
+        for id in ids:
+            index.get_nns_by_id(id, n_neighbours)
+
+    def bulk_lookup():
+        index.get_bulk_nns_by_ids(ids, n_neighbours, n_jobs=n_jobs)
+
+    click.echo("Looking up {} similar recordings for {} recordings, {} times".format(n_neighbours, len(ids), repeat))
+    single_time = timeit.timeit(single_lookups, number=repeat) / repeat
+    click.echo("Single lookups: {:.4f}s per request".format(single_time))
+    bulk_time = timeit.timeit(bulk_lookup, number=repeat) / repeat
+    click.echo("Bulk lookup ({} threads): {:.4f}s per request".format(n_jobs, bulk_time))
@@ -9,6 +9,25 @@ class BaseMetric(object):
     description = ''
     category = ''
 
+    def transform_batch(self, batch):
+        """Transform the data of many recordings at once.
+
+        Args:
+            batch: a list with the data of each recording, in the form
+            accepted by ``transform``.
+
+        Returns:
+            A 2-D numpy array with one row for each recording. If the data
+            of a recording is invalid, its row is filled with zeros.
+        """
+        vectors = np.zeros((len(batch), self.length()))
+        for i, data in enumerate(batch):
+            try:
+                vectors[i] = list(self.transform(data))
+            except ValueError:
+                pass
+        return vectors
+
 
 class LowLevelMetric(BaseMetric):
     path = ''
@@ -31,18 +50,50 @@ class LowLevelMetric(BaseMetric):
 
 
 class NormalizedLowLevelMetric(LowLevelMetric):
-    means = None
-    stddevs = None
+    _means = None
+    _stddevs = None
+    _means_array = None
+    _stddevs_array = None
+
+    # Stats are converted to arrays when they are assigned, rather than
+    # every time that data is transformed.
+    @property
+    def means(self):
+        return self._means
+
+    @means.setter
+    def means(self, means):
+        self._means = means
+        self._means_array = np.array(means)
+
+    @property
+    def stddevs(self):
+        return self._stddevs
+
+    @stddevs.setter
+    def stddevs(self, stddevs):
+        self._stddevs = stddevs
+        self._stddevs_array = np.array(stddevs)
+
+    def _normalize(self, data):
+        if self._stddevs is not None and np.count_nonzero(self._stddevs_array):
+            return (data - self._means_array) / self._stddevs_array
+        return data
 
     def transform(self, data):
         if not data:
             raise ValueError('Invalid data value: {}'.format(data))
         # Normalize
         data = np.array(data)[self.indices]
-        if np.count_nonzero(np.array(self.stddevs)):
-            return list((data - np.array(self.means)) / np.array(self.stddevs))
-        else:
-            return list(data)
+        return list(self._normalize(data))
+
+    def transform_batch(self, batch):
+        vectors = np.zeros((len(batch), self.length()))
+        valid = [i for i, data in enumerate(batch) if data]
+        if valid:
+            data = np.array([batch[i] for i in valid])[:, self.indices]
+            vectors[valid] = self._normalize(data)
+        return vectors
 
 
 class WeightedNormalizedLowLevelMetric(NormalizedLowLevelMetric):
@@ -57,6 +108,9 @@ class WeightedNormalizedLowLevelMetric(NormalizedLowLevelMetric):
         data = super(WeightedNormalizedLowLevelMetric, self).transform(data)
         return list(data * self.weight_vector)
 
+    def transform_batch(self, batch):
+        return super(WeightedNormalizedLowLevelMetric, self).transform_batch(batch) * self.weight_vector
+
 
 class MfccsMetric(NormalizedLowLevelMetric):
     name = 'mfccs'
@@ -95,6 +149,11 @@ class CircularMetric(LowLevelMetric):
         value = data * 2 * np.pi
         return list(np.array([np.cos(value), np.sin(value)]))
 
+    def _transform_values(self, values):
+        """Wrap an array of values around the circle, one row for each value."""
+        values = np.asarray(values, dtype=float) * 2 * np.pi
+        return np.column_stack([np.cos(values), np.sin(values)])
+
 
 KEYS_CIRCLE = ['C', 'G', 'D', 'A', 'E', 'B', 'F#', 'C#', 'G#', 'D#', 'A#', 'F']
 KEYS_MAP = {KEYS_CIRCLE[i]: float(i) / 12 for i in range(12)}
@@ -116,6 +175,20 @@ class KeyMetric(CircularMetric):
         except KeyError:
             raise ValueError('Invalid data value: {}'.format(data))
 
+    def transform_batch(self, batch):
+        vectors = np.zeros((len(batch), self.length()))
+        valid = []
+        key_values = []
+        for i, data in enumerate(batch):
+            try:
+                key_values.append(KEYS_MAP[data['key_key']] + SCALES_MAP[data['key_scale']])
+                valid.append(i)
+            except (KeyError, TypeError):
+                pass
+        if valid:
+            vectors[valid] = self._transform_values(key_values)
+        return vectors
+
 
 class LogCircularMetric(CircularMetric):
     def transform(self, data):
@@ -123,6 +196,13 @@ class LogCircularMetric(CircularMetric):
             raise ValueError('Invalid data value: {}'.format(data))
         return super(LogCircularMetric, self).transform(np.log2(data))
 
+    def transform_batch(self, batch):
+        vectors = np.zeros((len(batch), self.length()))
+        valid = [i for i, data in enumerate(batch) if data]
+        if valid:
+            vectors[valid] = self._transform_values(np.log2([batch[i] for i in valid]))
+        return vectors
+
 
 class BpmMetric(LogCircularMetric):
     name = 'bpm'
@@ -0,0 +1,61 @@
+import numpy as np
+
+"""
+Mean and standard deviation of a stream of vectors, computed in constant
+memory. Batches of vectors are combined with the parallel algorithm of
+Chan et al., which is Welford's algorithm when a batch has a single item.
+Partial results for different sets of vectors (for example, ranges of ids
+processed in parallel) can be merged, and stats which have been saved can
+be updated as new vectors are added.
+"""
+
+
+class RunningStats(object):
+    def __init__(self, count=0, mean=None, m2=None):
+        """
+        Args:
+            count: the number of vectors which have been added.
+            mean: the mean of the vectors.
+            m2: the sum of squared differences from the mean
+            of each dimension of the vectors.
+        """
+        self.count = count
+        self.mean = None if mean is None else np.array(mean, dtype=np.float64)
+        self.m2 = None if m2 is None else np.array(m2, dtype=np.float64)
+
+    def update(self, vectors):
+        """Add a batch of vectors.
+
+        Args:
+            vectors: a 2-D array or list of vectors.
+        """
+        vectors = np.asarray(vectors, dtype=np.float64)
+        if not len(vectors):
+            return self
+        mean = vectors.mean(axis=0)
+        m2 = ((vectors - mean) ** 2).sum(axis=0)
+        return self.merge(RunningStats(len(vectors), mean, m2))
+
+    def merge(self, other):
+        """Add the vectors of another RunningStats to this one."""
+        if not other.count:
+            return self
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (float(other.count) / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (float(self.count) * other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def variance(self):
+        """The population variance, as computed by np.var."""
+        return self.m2 / self.count
+
+    @property
+    def stddev(self):
+        """The population standard deviation, as computed by np.std."""
+        return np.sqrt(self.variance)
@@ -0,0 +1,66 @@
+import unittest
+
+from annoy import AnnoyIndex
+
+import similarity.exceptions
+from similarity.delta import IndexDelta, merge_nns
+
+
+class IndexDeltaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ids = [10, 11, 12]
+        self.vectors = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [1.0, 1.0, 0.0]]
+        self.recordings = [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 0),
+                           ("e8afe383-1478-497e-90b1-7885c7f37f6e", 0),
+                           ("0dad432b-16cc-4bf0-8961-fd31d124b01b", 1)]
+
+    def test_invalid_distance_type(self):
+        with self.assertRaises(similarity.exceptions.SimilarityException):
+            IndexDelta("hamming", self.ids, self.vectors, self.recordings)
+
+    def test_empty(self):
+        delta = IndexDelta("angular", [], [], [])
+        self.assertEqual(0, len(delta))
+        self.assertFalse(10 in delta)
+        self.assertEqual(([], []), delta.get_nns_by_vector([1.0, 0.0, 0.0], 2))
+
+    def test_get_recordings(self):
+        delta = IndexDelta("angular", self.ids, self.vectors, self.recordings)
+        self.assertTrue(11 in delta)
+        self.assertEqual([self.recordings[2], (None, None), self.recordings[0]], delta.get_recordings([12, 1, 10]))
+
+    def test_get_nns_by_vector(self):
+        delta = IndexDelta("euclidean", self.ids, self.vectors, self.recordings)
+        ids, distances = delta.get_nns_by_vector([1.0, 0.0, 0.0], 2)
+        self.assertEqual([10, 12], ids)
+        self.assertAlmostEqual(0.0, distances[0])
+        self.assertAlmostEqual(1.0, distances[1], places=5)
+
+        delta = IndexDelta("manhattan", self.ids, self.vectors, self.recordings)
+        ids, distances = delta.get_nns_by_vector([0.0, 2.0, 0.0], 5)
+        self.assertEqual([11, 12, 10], ids)
+        self.assertEqual([1.0, 2.0, 3.0], distances)
+
+    def test_distances_match_annoy(self):
+        # Distances computed by the delta are the same as those computed by an annoy index
+        for distance_type in ["angular", "euclidean", "manhattan"]:
+            index = AnnoyIndex(3, distance_type)
+            for id, vector in zip(self.ids, self.vectors):
+                index.add_item(id, vector)
+            index.add_item(13, [0.5, -2.0, 3.0])
+            index.build(1)
+
+            delta = IndexDelta(distance_type, self.ids, self.vectors, self.recordings)
+            distances = delta.get_distances(index.get_item_vector(13))
+            for id, distance in zip(self.ids, distances):
+                self.assertAlmostEqual(index.get_distance(13, id), distance, places=4)
+            self.assertAlmostEqual(index.get_distance(10, 13),
+                                   delta.get_distance(self.vectors[0], index.get_item_vector(13)), places=4)
+
+    def test_merge_nns(self):
+        nns = ([1, 2, 3], [0.0, 0.2, 0.4])
+        delta_nns = ([10, 11], [0.1, 0.5])
+        self.assertEqual(([1, 10, 2], [0.0, 0.1, 0.2]), merge_nns(nns, delta_nns, 3))
+        self.assertEqual(([1, 10, 2, 3, 11], [0.0, 0.1, 0.2, 0.4, 0.5]), merge_nns(nns, delta_nns, 10))
+        self.assertEqual(nns, merge_nns(nns, ([], []), 3))
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from similarity.id_map import RecordingIdMap, get_id_map_path
+
+
+class RecordingIdMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.test_mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
+        self.test_mbid_two = "e8afe383-1478-497e-90b1-7885c7f37f6e"
+        self.recordings = [(1, self.test_mbid, 0),
+                           (2, self.test_mbid_two, 0),
+                           (4, self.test_mbid, 1)]
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_id_map_path(self):
+        self.assertEqual("/data/annoy_indices/mfccs_angular_10.ids.npy",
+                         get_id_map_path("/data/annoy_indices/mfccs_angular_10.ann"))
+
+    def test_get_recordings(self):
+        id_map = RecordingIdMap.from_recordings(self.recordings, 4)
+        self.assertEqual(5, len(id_map))
+
+        # Order of the ids is preserved
+        expected = [(self.test_mbid, 1), (self.test_mbid, 0), (self.test_mbid_two, 0)]
+        self.assertEqual(expected, id_map.get_recordings([4, 1, 2]))
+
+        # Gaps in ids and ids outside of the map are (None, None)
+        self.assertEqual([(None, None), (None, None), (None, None)], id_map.get_recordings([0, 3, 5]))
+
+    def test_contains(self):
+        id_map = RecordingIdMap.from_recordings(self.recordings, 4)
+        self.assertTrue(4 in id_map)
+        self.assertFalse(3 in id_map)
+        self.assertFalse(5 in id_map)
+        self.assertFalse(-1 in id_map)
+
+    @mock.patch("similarity.id_map.BUILD_BATCH_SIZE", 2)
+    def test_from_recordings_batches(self):
+        # Rows are added to the map in batches
+        id_map = RecordingIdMap.from_recordings(self.recordings, 4)
+        self.assertEqual([(self.test_mbid, 0), (self.test_mbid_two, 0), (self.test_mbid, 1)],
+                         id_map.get_recordings([1, 2, 4]))
+
+    def test_save_load(self):
+        path = os.path.join(self.temp_dir, "mfccs_angular_10.ids.npy")
+        RecordingIdMap.from_recordings(self.recordings, 4).save(path)
+        self.assertFalse(os.path.exists(path + ".tmp"))
+
+        id_map = RecordingIdMap.load(path)
+        self.assertEqual([(self.test_mbid, 0), (self.test_mbid_two, 0), (self.test_mbid, 1)],
+                         id_map.get_recordings([1, 2, 4]))
+
+        with self.assertRaises(IOError):
+            RecordingIdMap.load(os.path.join(self.temp_dir, "nothing.ids.npy"))
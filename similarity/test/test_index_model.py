@@ -1,12 +1,17 @@
 import os
 import json
 import mock
+import time
 import unittest
 
+import flask
+
 import db.exceptions
 from db.testing import DatabaseTestCase, TEST_DATA_PATH, gid_types
 import similarity.exceptions
+from similarity import index_model
 from similarity.index_model import AnnoyModel
+from similarity.id_map import RecordingIdMap
 
 
 class IndexModelTestCase(DatabaseTestCase):
@@ -43,22 +48,26 @@ class IndexModelTestCase(DatabaseTestCase):
         with self.assertRaises(OSError):
             self.model.save()
 
-    def test_save(self):
+    @mock.patch("similarity.index_model.os.rename")
+    def test_save(self, rename):
         # If location is correct, assert saved with proper file name
-        # and full path
+        # and full path. The index is written to a temporary file first.
         self.model.build()
         self.model.index = mock.Mock()
         self.model.save()
         expected_path = "/code/annoy_indices/mfccs_angular_10.ann"
-        self.model.index.save.assert_called_with(expected_path)
+        self.model.index.save.assert_called_with(expected_path + ".tmp")
+        rename.assert_called_with(expected_path + ".tmp", expected_path)
 
-    def test_save_location(self):
+    @mock.patch("similarity.index_model.os.rename")
+    def test_save_location(self, rename):
         # Saves to specified location with specified name, with params appended
         self.model.build()
         self.model.index = mock.Mock()
         self.model.save(location="/code/annoy_indices/test_indices", name="test_mfccs")
         expected_path = "/code/annoy_indices/test_indices/test_mfccs_angular_10.ann"
-        self.model.index.save.assert_called_with(expected_path)
+        self.model.index.save.assert_called_with(expected_path + ".tmp")
+        rename.assert_called_with(expected_path + ".tmp", expected_path)
 
     def test_load(self):
         # Raises error if no index with specified name exists
@@ -168,6 +177,14 @@ class IndexModelTestCase(DatabaseTestCase):
         with self.assertRaises(similarity.exceptions.ItemNotFoundException):
             self.model.get_nns_by_id(id, n_neighbours)
 
+    def test_get_nns_by_id_not_in_id_map(self):
+        # Ids which were left out of the index are not queried
+        self.model.index = mock.Mock()
+        self.model.id_map = RecordingIdMap.from_recordings([(2, self.test_mbid, 0)], 2)
+        with self.assertRaises(similarity.exceptions.ItemNotFoundException):
+            self.model.get_nns_by_id(1, 2)
+        self.model.index.get_nns_by_item.assert_not_called()
+
     def test_get_nns_by_id(self):
         """Assert values from Annoy call are properly unpacked and correct recordings
         are gathered"""
@@ -187,57 +204,52 @@ class IndexModelTestCase(DatabaseTestCase):
         #                    (2, ("e8afe383-1478-497e-90b1-7885c7f37f6e", 0), 0.5)]
         self.assertEqual(expected_result, self.model.get_nns_by_id(id, n_neighbours))
 
-    def test_get_bulk_nns_by_mbid_none(self):
+    @mock.patch("db.data.get_mbids_by_ids")
+    @mock.patch("db.data.get_ids_by_mbids")
+    def test_get_bulk_nns_by_mbid_none(self, get_ids_by_mbids, get_mbids_by_ids):
         """
-        If an item is not indexed, ItemNotFoundException caught and item
-        is skipped.
+        If an item is not indexed, it is skipped.
 
-        If a recording is not submitted, NoDataFoundException caught and item
-        is skipped.
+        If a recording is not submitted, it is skipped.
         """
         num_neighbours = 2
         recordings = [(self.test_mbid, 0), (self.test_mbid, 1), (self.test_mbid, 2)]
-        returns = [similarity.exceptions.ItemNotFoundException,
-                   db.exceptions.NoDataFoundException,
-                   ([1, 2],
-                    [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 0), ("e8afe383-1478-497e-90b1-7885c7f37f6e", 0)],
-                    [0.4, 0.5])]
-        self.model.get_nns_by_mbid = mock.Mock()
-        self.model.get_nns_by_mbid.side_effect = returns
-
-        expected = {self.test_mbid: {'2': [(self.test_mbid, 0), (self.test_mbid_two, 0)]}}
-        ret = self.model.get_bulk_nns_by_mbid(recordings, num_neighbours)
+        get_ids_by_mbids.return_value = [1, None, 3]
+        self.model.index = mock.Mock()
+        self.model.index.get_nns_by_item.side_effect = [IndexError, ([3, 4], [0.4, 0.5])]
+        get_mbids_by_ids.return_value = [(self.test_mbid, 2), (self.test_mbid_two, 0)]
+
+        expected = {self.test_mbid: {'2': [{'recording_mbid': self.test_mbid, 'offset': 2, 'distance': 0.4},
+                                           {'recording_mbid': self.test_mbid_two, 'offset': 0, 'distance': 0.5}]}}
+        ret = self.model.get_bulk_nns_by_mbid(recordings, num_neighbours, n_jobs=1)
         self.assertDictEqual(expected, ret)
 
-    def test_get_bulk_nns_by_mbid(self):
+    @mock.patch("db.data.get_mbids_by_ids")
+    @mock.patch("db.data.get_ids_by_mbids")
+    def test_get_bulk_nns_by_mbid(self, get_ids_by_mbids, get_mbids_by_ids):
         """
-        If extended_info is True, lowlevel.id and distance is included
-        in the tuple for each similar recording.
-
-        If extended_info is False, only tuples of (MBID, offset) are
-        included in the tuple for each similar recording.
+        All similar items are resolved to (MBID, offset) in a single query,
+        whether or not the index is queried in parallel.
         """
         num_neighbours = 2
         recordings = [(self.test_mbid, 1), (self.test_mbid_two, 2)]
-
-        returns = [([1, 2],
-                    [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 0), ("e8afe383-1478-497e-90b1-7885c7f37f6e", 0)],
-                    [0.4, 0.5]),
-                   ([3, 4],
-                    [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 1), ("0dad432b-16cc-4bf0-8961-fd31d124b01b", 3)],
-                    [0.1, 0.2])]
-
-        self.model.get_nns_by_mbid = mock.Mock()
-        self.model.get_nns_by_mbid.side_effect = returns
-
-        # extended_info is not specified, defaults as False
-        self.model.get_nns_by_mbid.side_effect = returns
-        expected = {self.test_mbid: {'1': [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 0),
-                                           ("e8afe383-1478-497e-90b1-7885c7f37f6e", 0)]},
-                    self.test_mbid_two: {'2': [("0dad432b-16cc-4bf0-8961-fd31d124b01b", 1),
-                                               ("0dad432b-16cc-4bf0-8961-fd31d124b01b", 3)]}}
-        ret = self.model.get_bulk_nns_by_mbid(recordings, num_neighbours)
-        self.assertEqual(expected, ret)
+        get_ids_by_mbids.return_value = [1, 2]
+        nns = {1: ([1, 3], [0.0, 0.5]), 2: ([2, 3], [0.0, 0.2])}
+        recordings_by_id = {1: (self.test_mbid, 1), 2: (self.test_mbid_two, 2), 3: (self.test_mbid, 0)}
+        get_mbids_by_ids.side_effect = lambda ids: [recordings_by_id[id] for id in ids]
+
+        expected = {self.test_mbid: {'1': [{'recording_mbid': self.test_mbid, 'offset': 1, 'distance': 0.0},
+                                           {'recording_mbid': self.test_mbid, 'offset': 0, 'distance': 0.5}]},
+                    self.test_mbid_two: {'2': [{'recording_mbid': self.test_mbid_two, 'offset': 2, 'distance': 0.0},
+                                               {'recording_mbid': self.test_mbid, 'offset': 0, 'distance': 0.2}]}}
+        for n_jobs in [1, 2]:
+            get_mbids_by_ids.reset_mock()
+            self.model.index = mock.Mock()
+            self.model.index.get_nns_by_item.side_effect = lambda id, n, include_distances: nns[id]
+            ret = self.model.get_bulk_nns_by_mbid(recordings, num_neighbours, n_jobs=n_jobs)
+            self.assertEqual(expected, ret)
+            get_mbids_by_ids.assert_called_once()
+            self.assertItemsEqual([1, 2, 3], get_mbids_by_ids.call_args[0][0])
 
     def test_get_similarity_between_none(self):
         # If one of the (MBID, offset) tuples is not submitted,
@@ -315,3 +327,98 @@ class IndexModelValidationTestCase(unittest.TestCase):
         distance = "angular"
         model = AnnoyModel(metric, n_trees=n_trees, distance_type=distance, load_existing=True)
         model.load.assert_called()
+
+
+class IndexRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        index_model.clear_index_registry()
+
+    def tearDown(self):
+        index_model.clear_index_registry()
+
+    @mock.patch("similarity.index_model.get_index_path")
+    @mock.patch("similarity.index_model._get_file_signature")
+    @mock.patch("similarity.index_model.AnnoyModel")
+    @mock.patch("db.similarity.get_metric_dimensionality")
+    def test_get_index_reuses_loaded_index(self, get_metric_dimensionality, annoy_model, get_file_signature, get_index_path):
+        get_metric_dimensionality.return_value = 3
+        get_file_signature.return_value = (1, 1.0, 100)
+
+        index = index_model.get_index("mfccs", n_trees=10, distance_type="angular")
+        self.assertEqual(annoy_model.return_value, index)
+        annoy_model.assert_called_once_with("mfccs", n_trees=10, distance_type="angular",
+                                            load_existing=True, dimensionality=3)
+
+        # A second request for the same index doesn't load it again
+        self.assertEqual(index, index_model.get_index("mfccs", n_trees=10, distance_type="angular"))
+        annoy_model.assert_called_once()
+
+        # Dimensionality is cached for other indices of the same metric
+        index_model.get_index("mfccs", n_trees=10, distance_type="manhattan")
+        get_metric_dimensionality.assert_called_once_with("mfccs")
+
+    @mock.patch("similarity.index_model.get_index_path")
+    @mock.patch("similarity.index_model._get_file_signature")
+    @mock.patch("similarity.index_model.AnnoyModel")
+    @mock.patch("db.similarity.get_metric_dimensionality")
+    def test_get_index_reloads_changed_file(self, get_metric_dimensionality, annoy_model, get_file_signature, get_index_path):
+        get_metric_dimensionality.return_value = 3
+        first_index = mock.Mock()
+        second_index = mock.Mock()
+        annoy_model.side_effect = [first_index, second_index]
+
+        get_file_signature.return_value = (1, 1.0, 100)
+        self.assertEqual(first_index, index_model.get_index("mfccs"))
+
+        # Index file has been replaced on disk
+        get_file_signature.return_value = (2, 2.0, 100)
+        self.assertEqual(second_index, index_model.get_index("mfccs"))
+        self.assertEqual(second_index, index_model.get_index("mfccs"))
+        self.assertEqual(2, annoy_model.call_count)
+
+    @mock.patch("similarity.index_model.get_index_path")
+    @mock.patch("similarity.index_model._get_file_signature")
+    @mock.patch("similarity.index_model.AnnoyModel")
+    def test_get_index_not_found(self, annoy_model, get_file_signature, get_index_path):
+        # Invalid metric
+        with self.assertRaises(similarity.exceptions.IndexNotFoundException):
+            index_model.get_index("nothing")
+
+        # No index file on disk
+        get_file_signature.side_effect = OSError
+        with self.assertRaises(similarity.exceptions.IndexNotFoundException):
+            index_model.get_index("mfccs")
+        annoy_model.assert_not_called()
+
+
+class DeltaRefreshTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.model = AnnoyModel("mfccs", dimensionality=3)
+        self.model.in_loaded_state = True
+
+    @mock.patch("similarity.index_model.AnnoyModel.refresh_delta")
+    def test_start_delta_refresh(self, refresh_delta):
+        with self.app.app_context():
+            self.model.start_delta_refresh(300, 10).join()
+            refresh_delta.assert_called_once_with(300, 10)
+
+            # The delta isn't reloaded while it is recent, or while it is already being reloaded
+            self.model.delta_loaded_at = time.time()
+            self.assertIsNone(self.model.start_delta_refresh(300, 10))
+            self.model.delta_loaded_at = time.time() - 301
+            with self.model._delta_refresh_lock:
+                self.assertIsNone(self.model.start_delta_refresh(300, 10))
+            self.model.start_delta_refresh(300, 10).join()
+            self.assertEqual(2, refresh_delta.call_count)
+
+    @mock.patch("similarity.index_model.AnnoyModel.refresh_delta")
+    def test_start_delta_refresh_error(self, refresh_delta):
+        # An error is logged, and the delta is loaded again by the next refresh
+        refresh_delta.side_effect = [Exception("database error"), None]
+        with self.app.app_context():
+            self.model.start_delta_refresh(300, 10).join()
+            self.model.start_delta_refresh(300, 10).join()
+        self.assertEqual(2, refresh_delta.call_count)
@@ -0,0 +1,35 @@
+import unittest
+
+import mock
+from annoy import AnnoyIndex
+
+from similarity import index_utils
+
+
+class IndexUtilsTestCase(unittest.TestCase):
+
+    def test_get_missing_ids(self):
+        self.assertEqual([0, 3, 5, 6], index_utils.get_missing_ids([1, 2, 4, 7]).tolist())
+        self.assertEqual([], index_utils.get_missing_ids([0, 1, 2]).tolist())
+        self.assertEqual([], index_utils.get_missing_ids([]).tolist())
+
+    def test_add_empty_rows(self):
+        index = mock.Mock(dimensionality=3)
+        index_utils.add_empty_rows(index, [1, 3])
+        index.add_recording_with_vector.assert_has_calls([mock.call(0, [0, 0, 0]), mock.call(2, [0, 0, 0])])
+        self.assertEqual(2, index.add_recording_with_vector.call_count)
+
+    def test_unfilled_rows_are_not_indexed(self):
+        # Annoy leaves ids which were never added out of the index,
+        # but returns placeholders as similar items
+        for fill in [False, True]:
+            index = mock.Mock(dimensionality=3)
+            index.index = AnnoyIndex(3, "euclidean")
+            index.add_recording_with_vector.side_effect = index.index.add_item
+            if fill:
+                index_utils.add_empty_rows(index, [0, 4])
+            index.index.add_item(0, [1.0, 0.0, 0.0])
+            index.index.add_item(4, [2.0, 0.0, 0.0])
+            index.index.build(1)
+            nns = index.index.get_nns_by_item(0, 5)
+            self.assertEqual([0, 1, 2, 3, 4] if fill else [0, 4], sorted(nns))
@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+
+import similarity.metrics
+from similarity.utils import init_metrics
+
+
+class MetricsTransformBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = init_metrics()
+        for metric in self.metrics:
+            if hasattr(metric, "means"):
+                metric.means = [float(i) for i in range(13)]
+                metric.stddevs = [float(i + 1) for i in range(13)]
+
+        mfcc = [float(i) * 1.5 for i in range(13)]
+        self.ll_data = [
+            {"mfcc": mfcc, "gfcc": mfcc, "bpm": 120.0, "onset_rate": 3.5,
+             "key": {"key_key": "A", "key_scale": "minor"}},
+            {"mfcc": None, "gfcc": [], "bpm": 0, "onset_rate": None,
+             "key": {"key_key": None, "key_scale": None}},
+        ]
+        self.hl_data = [
+            {"mood_happy": {"all": {"happy": 0.7, "not_happy": 0.3}},
+             "voice_instrumental": {"all": {"voice": 0.2, "instrumental": 0.8}},
+             "genre_rosamerica": {"all": {"cla": 0.1, "dan": 0.2, "hip": 0.1, "jaz": 0.1,
+                                          "pop": 0.2, "rhy": 0.1, "roc": 0.1, "spe": 0.1}}},
+            None,
+        ]
+
+    def _transform(self, metric, data):
+        try:
+            return list(metric.transform(data))
+        except ValueError:
+            return [0] * metric.length()
+
+    def test_transform_batch(self):
+        # Transforming a batch gives the same vectors as transforming each item
+        for metric in self.metrics:
+            if isinstance(metric, similarity.metrics.LowLevelMetric):
+                batch = [metric.get_feature_data(data) for data in self.ll_data]
+            else:
+                batch = self.hl_data
+            vectors = metric.transform_batch(batch)
+            self.assertEqual((len(batch), metric.length()), vectors.shape)
+            for data, vector in zip(batch, vectors):
+                np.testing.assert_allclose(self._transform(metric, data), vector)
+
+    def test_transform_batch_no_stats(self):
+        metric = similarity.metrics.MfccsMetric()
+        data = [float(i) for i in range(13)]
+        np.testing.assert_allclose([data], metric.transform_batch([data]))
@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+
+from similarity.running_stats import RunningStats
+
+
+class RunningStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vectors = np.random.RandomState(0).normal(5.0, 3.0, size=(100, 4))
+
+    def test_update(self):
+        stats = RunningStats()
+        for i in range(0, 100, 7):
+            stats.update(self.vectors[i:i + 7])
+        stats.update([])
+        self.assertEqual(100, stats.count)
+        np.testing.assert_allclose(np.mean(self.vectors, axis=0), stats.mean)
+        np.testing.assert_allclose(np.std(self.vectors, axis=0), stats.stddev)
+
+    def test_update_single_items(self):
+        stats = RunningStats()
+        for vector in self.vectors:
+            stats.update([vector])
+        np.testing.assert_allclose(np.mean(self.vectors, axis=0), stats.mean)
+        np.testing.assert_allclose(np.var(self.vectors, axis=0), stats.variance)
+
+    def test_merge(self):
+        parts = [RunningStats().update(self.vectors[:30]),
+                 RunningStats(),
+                 RunningStats().update(self.vectors[30:])]
+        stats = RunningStats()
+        for part in reversed(parts):
+            stats.merge(part)
+        np.testing.assert_allclose(np.mean(self.vectors, axis=0), stats.mean)
+        np.testing.assert_allclose(np.std(self.vectors, axis=0), stats.stddev)
+
+        # Stats which were saved can be restored and updated
+        restored = RunningStats(parts[0].count, parts[0].mean.tolist(), parts[0].m2.tolist())
+        restored.update(self.vectors[30:])
+        np.testing.assert_allclose(stats.mean, restored.mean)
+        np.testing.assert_allclose(stats.m2, restored.m2)
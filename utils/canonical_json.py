@@ -0,0 +1,59 @@
+"""Canonical JSON encoding of documents.
+
+Documents are stored in this encoding (sorted keys, no whitespace) and their
+data_sha256 is computed from it, so submissions of the same document can only
+be detected if the encoding of a document never changes.
+
+The C encoder of the json module in Python 2 doesn't sort keys, and the
+pure-Python encoder which json.dumps(sort_keys=True) falls back to is several
+times slower. Instead, every dictionary is copied into a dict which iterates
+over its keys in sorted order and the C encoder is used, which gives the same
+output.
+"""
+from json import JSONEncoder, dumps as json_dumps
+from json import encoder as json_encoder
+
+import six
+
+_SEPARATORS = (',', ':')
+_CONTAINER_TYPES = (dict, list, tuple)
+
+_encoder = JSONEncoder(separators=_SEPARATORS)
+
+
+class _SortedDict(dict):
+    """A dict which the C encoder reads in order of its keys."""
+
+    def __iter__(self):
+        return iter(sorted(dict.keys(self)))
+
+
+def _presort(obj):
+    """Copy obj with each dictionary replaced with a _SortedDict."""
+    if isinstance(obj, dict):
+        return _SortedDict((key, _presort(value) if isinstance(value, _CONTAINER_TYPES) else value)
+                           for key, value in six.iteritems(obj))
+    return [_presort(value) if isinstance(value, _CONTAINER_TYPES) else value for value in obj]
+
+
+def _dumps_presorted(data):
+    if isinstance(data, _CONTAINER_TYPES):
+        data = _presort(data)
+    return _encoder.encode(data)
+
+
+def _dumps_sorted(data):
+    return json_dumps(data, sort_keys=True, separators=_SEPARATORS)
+
+
+if six.PY2 and json_encoder.c_make_encoder is not None:
+    _dumps = _dumps_presorted
+else:
+    # The C encoder of Python 3 sorts keys itself
+    _dumps = _dumps_sorted
+
+
+def dumps(data):
+    """Encode data as canonical JSON, i.e. the same as
+    json.dumps(data, sort_keys=True, separators=(',', ':'))"""
+    return _dumps(data)
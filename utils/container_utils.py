@@ -1,3 +1,41 @@
+import threading
+from collections import OrderedDict
+
+
 def remove_duplicates(arr):
     seen = set()
     return [x for x in arr if not (x in seen or seen.add(x))]
+
+
+class LRUCache(object):
+    """A dictionary which holds at most `maxsize` items, discarding the
+    least recently used item when a new one is added to a full cache.
+    It is safe to use from several threads."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
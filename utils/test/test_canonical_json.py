@@ -0,0 +1,57 @@
+from __future__ import print_function
+
+import json
+import os
+import timeit
+import unittest
+from hashlib import sha256
+
+from utils import canonical_json
+
+DB_TEST_DATA_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'db', 'test_data')
+
+# sha256 of the canonical encoding of test documents, which submissions are deduplicated by
+TEST_DATA_SHA256 = {
+    "0dad432b-16cc-4bf0-8961-fd31d124b01b.json": "8a8a8795100536a93e42b564c93955e62c08f3d31d0ed49da0abdd0098ac1cbb",
+    "0dad432b-16cc-4bf0-8961-fd31d124b01b_highlevel.json": "9e719e135218a4b0c9e381ab28d33978264d059fbedfb3fa03959df2036d3734",
+    "0dad432b-16cc-4bf0-8961-fd31d124b01b_highlevel_models.json": "8d1c8ee73b270066b5842fbb83ae96036d30b88ebc55c90729c7c304ea82338e",
+    "e8afe383-1478-497e-90b1-7885c7f37f6e.json": "ed52056f43d8ed1c2f815959263472854f3251e89f8d3177e2e2df23f210071a",
+    "lowlevel_select_features_response.json": "6ca6790e022c8196d849c797db330411f475d2bef67b83d68de796f53f526e40",
+}
+
+
+def _load_test_data(filename):
+    with open(os.path.join(DB_TEST_DATA_PATH, filename)) as f:
+        return json.load(f)
+
+
+class CanonicalJsonTestCase(unittest.TestCase):
+
+    def _assert_canonical(self, data):
+        expected = json.dumps(data, sort_keys=True, separators=(',', ':'))
+        self.assertEqual(expected, canonical_json.dumps(data))
+        self.assertEqual(expected, canonical_json._dumps_sorted(data))
+
+    def test_test_data(self):
+        for filename, expected_sha256 in TEST_DATA_SHA256.items():
+            data_json = canonical_json.dumps(_load_test_data(filename))
+            self.assertEqual(expected_sha256, sha256(data_json.encode("utf-8")).hexdigest(), filename)
+
+    def test_dumps(self):
+        self._assert_canonical({"b": [1, 2.5, 1e-07, {"d": None, "c": True}], "a": {"z": "x", "y": [[{"f": 1, "e": 2}]]}})
+        self._assert_canonical({u"\u00e9": u"caf\u00e9", u"e": (1, {"b": 1, "a": 2}), "n": -0.0})
+        self._assert_canonical([{"b": 1, "a": 2}, "x"])
+        self._assert_canonical({})
+        self._assert_canonical("string")
+        self._assert_canonical(1.5)
+
+    @unittest.skipUnless(os.environ.get("AB_RUN_BENCHMARKS"), "AB_RUN_BENCHMARKS is not set")
+    def test_benchmark(self):
+        number = 100
+        print("\n{:<60}  {:>10}  {:>10}".format("document", "sorted ms", "canonical ms"))
+        for filename in sorted(TEST_DATA_SHA256):
+            data = _load_test_data(filename)
+            sorted_time = timeit.timeit(lambda: canonical_json._dumps_sorted(data), number=number)
+            canonical_time = timeit.timeit(lambda: canonical_json.dumps(data), number=number)
+            print("{:<60}  {:>10.3f}  {:>10.3f}".format(filename, sorted_time * 1000 / number,
+                                                        canonical_time * 1000 / number))
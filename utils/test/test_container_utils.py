@@ -0,0 +1,30 @@
+import unittest
+
+from utils.container_utils import LRUCache, remove_duplicates
+
+
+class ContainerUtilsTestCase(unittest.TestCase):
+
+    def test_remove_duplicates(self):
+        self.assertEqual([3, 1, 2], remove_duplicates([3, 1, 3, 2, 1]))
+
+    def test_lru_cache(self):
+        lru = LRUCache(2)
+        self.assertIsNone(lru.get("a"))
+        self.assertEqual(0, lru.get("a", 0))
+
+        lru.set("a", 1)
+        lru.set("b", 2)
+        self.assertEqual(1, lru.get("a"))
+        # "b" is now the least recently used item
+        lru.set("c", 3)
+        self.assertEqual(2, len(lru))
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(1, lru.get("a"))
+        self.assertEqual(3, lru.get("c"))
+
+        lru.set("c", 4)
+        self.assertEqual(4, lru.get("c"))
+
+        lru.clear()
+        self.assertEqual(0, len(lru))
@@ -1,3 +1,4 @@
+from brainzutils import cache
 from brainzutils.ratelimit import set_rate_limits
 
 import db
@@ -27,6 +28,9 @@ class AcousticbrainzTestCase(TestCase):
 
     def setUp(self):
         self.reset_db()
+        # Documents cached by a previous test are not in the database any more
+        cache.flush_all()
+        db.data.clear_id_caches()
 
         # TODO: https://tickets.metabrainz.org/browse/BU-27
         set_rate_limits(1000, 1000, 10000)
@@ -3,9 +3,10 @@ from __future__ import absolute_import
 import json
 import uuid
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app, stream_with_context
 
 import db.data
+import db.lowlevel_features
 from webserver.utils import validate_offset
 import webserver.views.api.exceptions
 from db.data import submit_low_level_data, count_lowlevel
@@ -13,6 +14,7 @@ from db.exceptions import NoDataFoundException, BadDataException
 from webserver.decorators import crossdomain
 from utils.container_utils import remove_duplicates
 from brainzutils.ratelimit import ratelimit
+from six import integer_types, string_types
 
 bp_core = Blueprint('api_v1_core', __name__)
 
@@ -26,29 +28,38 @@ bp_core = Blueprint('api_v1_core', __name__)
 #: The maximum number of items that you can pass as a recording_ids parameter to bulk lookup endpoints
 MAX_ITEMS_PER_BULK_REQUEST = 25
 
-# Individual features selectable in get_many_individual_features.
+#: The maximum number of items that you can pass in the body of a POST request to bulk lookup endpoints
+MAX_ITEMS_PER_BULK_POST_REQUEST = 5000
+
+#: The maximum number of documents that you can submit in one request to the bulk low-level submission endpoint
+MAX_ITEMS_PER_BULK_SUBMISSION = 100
+
+# Individual features selectable in get_many_individual_features, with the value that they default
+# to if they are not in a document. Features are read from the lowlevel_features table.
 # Note: metadata.version and metadata.audio_properties will be included in all responses.
-AVAILABLE_FEATURES = {
-    "lowlevel.average_loudness": ["llj.data->'lowlevel'->'average_loudness'", None],
-    "lowlevel.dynamic_complexity": ["llj.data->'lowlevel'->'dynamic_complexity'", None],
-    "metadata.audio_properties.replay_gain": ["llj.data->'metadata'->'audio_properties'->'replay_gain'", None],
-    "metadata.tags": ["llj.data->'metadata'->'tags'", {}],
-    "rhythm.beats_count": ["llj.data->'rhythm'->'beats_count'", None],
-    "rhythm.beats_loudness.mean": ["llj.data->'rhythm'->'beats_loudness'->'mean'", None],
-    "rhythm.bpm": ["llj.data->'rhythm'->'bpm'", None],
-    "rhythm.bpm_histogram_first_peak_bpm.mean": ["llj.data->'rhythm'->bpm_histogram_first_peak_bpm'->'mean'", None],
-    "rhythm.bpm_histogram_second_peak_bpm.mean": ["llj.data->'rhythm'->bpm_histogram_second_peak_bpm'->'mean'", None],
-    "rhythm.danceability": ["llj.data->'rhythm'->'danceability'", None],
-    "rhythm.onset_rate": ["llj.data->'rhythm'->'onset_rate'", None],
-    "tonal.chords_key": ["llj.data->'tonal'->'chords_key'", None],
-    "tonal.chords_scale": ["llj.data->'tonal'->'chords_scale'", None],
-    "tonal.chords_changes_rate": ["llj.data->'tonal'->'chords_changes_rate'", None],
-    "tonal.key_key": ["llj.data->'tonal'->'key_key'", None],
-    "tonal.key_scale": ["llj.data->'tonal'->'key_scale'", None],
-    "tonal.key_strength": ["llj.data->'tonal'->'key_strength'", None],
-    "tonal.tuning_frequency": ["llj.data->'tonal'->'tuning_frequency'", None],
-    "tonal.tuning_equal_tempered_deviation": ["llj.data->'tonal'->'tuning_equal_tempered_deviation'", None]
+_FEATURE_DEFAULTS = {
+    "lowlevel.average_loudness": None,
+    "lowlevel.dynamic_complexity": None,
+    "metadata.audio_properties.replay_gain": None,
+    "metadata.tags": {},
+    "rhythm.beats_count": None,
+    "rhythm.beats_loudness.mean": None,
+    "rhythm.bpm": None,
+    "rhythm.bpm_histogram_first_peak_bpm.mean": None,
+    "rhythm.bpm_histogram_second_peak_bpm.mean": None,
+    "rhythm.danceability": None,
+    "rhythm.onset_rate": None,
+    "tonal.chords_key": None,
+    "tonal.chords_scale": None,
+    "tonal.chords_changes_rate": None,
+    "tonal.key_key": None,
+    "tonal.key_scale": None,
+    "tonal.key_strength": None,
+    "tonal.tuning_frequency": None,
+    "tonal.tuning_equal_tempered_deviation": None
 }
+AVAILABLE_FEATURES = {alias: [db.lowlevel_features.get_feature_path(alias), default]
+                      for alias, default in _FEATURE_DEFAULTS.items()}
 
 #: Features that can be selected individually from the bulk low-level endpoint
 LOWLEVEL_INDIVIDUAL_FEATURES = sorted(list(AVAILABLE_FEATURES.keys()))
@@ -100,7 +111,7 @@ def get_low_level(mbid):
     offset = request.args.get("n")
     _, mbid, offset = _validate_arguments(str(mbid), offset)
     try:
-        return jsonify(db.data.load_low_level(mbid, offset))
+        return _json_response(db.data.load_low_level_json(mbid, offset))
     except NoDataFoundException:
         raise webserver.views.api.exceptions.APINotFound("Not found")
 
@@ -158,6 +169,77 @@ def submit_low_level(mbid):
     return jsonify({"message": "ok"})
 
 
+@bp_core.route("/low-level/submit", methods=["POST"])
+@ratelimit()
+def submit_many_low_level():
+    """Submit many low-level documents to AcousticBrainz in one request.
+
+    The body is newline-delimited JSON with one low-level document on each line.
+    The MBID of each document is read from its ``musicbrainz_recordingid`` (or
+    ``musicbrainz_trackid``) tag. At most :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_BULK_SUBMISSION`
+    documents can be submitted in a request. A document which can't be saved doesn't
+    stop the others from being saved; the status of each one is returned in the same
+    order as the documents:
+
+    .. sourcecode:: json
+
+        {"results": [
+            {"mbid": "0dad432b-16cc-4bf0-8961-fd31d124b01b", "status": "saved", "message": null},
+            {"mbid": "0dad432b-16cc-4bf0-8961-fd31d124b01b", "status": "duplicate", "message": null},
+            {"mbid": null, "status": "invalid", "message": "Cannot parse JSON document: ..."}
+        ]}
+
+    A status of ``duplicate`` means that the same document has already been submitted.
+
+    :reqheader Content-Type: *application/x-ndjson*
+
+    :resheader Content-Type: *application/json*
+    """
+    lines = [line for line in request.get_data().splitlines() if line.strip()]
+    if not lines:
+        raise webserver.views.api.exceptions.APIBadRequest("No documents were submitted")
+    if len(lines) > MAX_ITEMS_PER_BULK_SUBMISSION:
+        raise webserver.views.api.exceptions.APIBadRequest(
+            "More than %s documents not allowed per request" % MAX_ITEMS_PER_BULK_SUBMISSION)
+
+    results = [None] * len(lines)
+    submissions = []
+    positions = []
+    for i, line in enumerate(lines):
+        try:
+            data = json.loads(line.decode("utf-8"))
+        except ValueError as e:
+            results[i] = {"mbid": None, "status": db.data.SUBMISSION_STATUS_INVALID,
+                          "message": "Cannot parse JSON document: %s" % e}
+            continue
+        mbid = _get_document_mbid(data)
+        if mbid is None:
+            results[i] = {"mbid": None, "status": db.data.SUBMISSION_STATUS_INVALID,
+                          "message": "Document doesn't have a musicbrainz_recordingid tag with an MBID"}
+            continue
+        submissions.append((mbid, data))
+        positions.append(i)
+
+    statuses = db.data.submit_many_low_level_data(submissions, 'mbid')
+    for i, (mbid, _), (status, message) in zip(positions, submissions, statuses):
+        results[i] = {"mbid": mbid, "status": status, "message": message}
+    return jsonify({"results": results})
+
+
+def _get_document_mbid(data):
+    """Get the MBID of the recording of a low-level document from its tags.
+
+    Returns:
+        the MBID in lower case, or None if the document doesn't have one.
+    """
+    try:
+        tags = data["metadata"]["tags"]
+        mbids = tags.get("musicbrainz_recordingid") or tags.get("musicbrainz_trackid")
+        return str(uuid.UUID(mbids[0]))
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
 def _validate_map_classes(map_classes):
     """Validate the map_classes parameter
 
@@ -282,6 +364,42 @@ def _get_recording_ids_from_request():
     return recordings
 
 
+def _get_recording_ids_from_request_body():
+    """
+    Read the list of recordings from the JSON body of the flask request and validate it.
+    The body should be in the format
+        {"recording_ids": [mbid, [mbid, n], ...]}
+    where mbid is a recording MBID and n is an optional offset, an integer or a string.
+    If the offset is missing or a string which isn't an integer, it is replaced with 0
+
+    Returns:
+        a list of (mbid, parsed_mbid, offset) tuples, in the same form as
+        :py:func:`_parse_bulk_params`.
+
+    Raises:
+        APIBadRequest if the body isn't JSON in this format, there are more than
+        MAX_ITEMS_PER_BULK_POST_REQUEST recordings, or the format of the mbids or offsets are invalid
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("recording_ids"), list):
+        raise webserver.views.api.exceptions.APIBadRequest("Body must be a JSON object with a `recording_ids` list")
+    if len(data["recording_ids"]) > MAX_ITEMS_PER_BULK_POST_REQUEST:
+        raise webserver.views.api.exceptions.APIBadRequest(
+            "More than %s recordings not allowed per request" % MAX_ITEMS_PER_BULK_POST_REQUEST)
+
+    recordings = []
+    for recording in data["recording_ids"]:
+        if not isinstance(recording, list):
+            recording = [recording]
+        if not 1 <= len(recording) <= 2 or not isinstance(recording[0], string_types) \
+                or (len(recording) == 2 and not isinstance(recording[1], integer_types + string_types)):
+            raise webserver.views.api.exceptions.APIBadRequest("'%s' is not an mbid or [mbid, offset]" % (recording,))
+        offset = recording[1] if len(recording) == 2 else None
+        recordings.append(_validate_arguments(recording[0], offset))
+
+    return remove_duplicates(recordings)
+
+
 @bp_core.route("/low-level", methods=["GET"])
 @crossdomain()
 @ratelimit()
@@ -340,14 +458,47 @@ def get_many_lowlevel():
     parsed_features = _parse_individual_features()
     if parsed_features:
         recording_details = db.data.load_many_individual_features(recordings, parsed_features)
-    else:
-        recording_details = db.data.load_many_low_level(recordings)
-
-    recording_details['mbid_mapping'] = {}
-    if mbid_mapping:
         recording_details['mbid_mapping'] = mbid_mapping
+        return jsonify(recording_details)
 
-    return jsonify(recording_details)
+    # Documents are returned as they are stored, without parsing them, and are streamed
+    # to the client one at a time as they are read from the database
+    documents = db.data.iter_many_low_level_json(recordings)
+    return _json_response(stream_with_context(_stream_documents_json(documents, {'mbid_mapping': mbid_mapping})))
+
+
+@bp_core.route("/low-level", methods=["POST"])
+@crossdomain(headers="Content-Type")
+@ratelimit()
+def post_many_lowlevel():
+    """Get low-level data for many recordings at once, with the recordings in
+    the body of the request. This allows more recordings to be requested at
+    once than with the ``recording_ids`` query parameter.
+
+    **Example request**:
+
+    .. sourcecode:: json
+
+       {"recording_ids": ["mbid1", ["mbid2", 1]]}
+
+    Each recording is an MBID, or a list of an MBID and an offset. Offsets
+    should be >= 0.
+
+    The response has the same form as the ``GET`` version of this endpoint, and
+    is sent as each document is read from the database.
+
+    You can specify up to :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_BULK_POST_REQUEST` recordings in a request.
+
+    :reqheader Content-Type: *application/json*
+
+    :resheader Content-Type: *application/json*
+    """
+    recordings = _get_recording_ids_from_request_body()
+    mbid_mapping = _generate_normalised_mbid_mapping(recordings)
+    recordings = [(mbid, offset) for _, mbid, offset in recordings]
+
+    documents = db.data.iter_many_low_level_json(recordings)
+    return _json_response(stream_with_context(_stream_documents_json(documents, {'mbid_mapping': mbid_mapping})))
 
 
 @bp_core.route("/high-level", methods=["GET"])
@@ -403,6 +554,76 @@ def get_many_highlevel():
     return jsonify(recording_details)
 
 
+@bp_core.route("/high-level", methods=["POST"])
+@crossdomain(headers="Content-Type")
+@ratelimit()
+def post_many_highlevel():
+    """Get high-level data for many recordings at once, with the recordings in
+    the body of the request. This allows more recordings to be requested at
+    once than with the ``recording_ids`` query parameter.
+
+    The body of the request has the same form as for ``POST /api/v1/low-level``,
+    and the response has the same form as the ``GET`` version of this endpoint.
+
+    You can specify up to :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_BULK_POST_REQUEST` recordings in a request.
+
+    :query map_classes: *Optional.* If set to 'true', map class names to human-readable values
+
+    :reqheader Content-Type: *application/json*
+
+    :resheader Content-Type: *application/json*
+    """
+    map_classes = _validate_map_classes(request.args.get("map_classes"))
+    recordings = _get_recording_ids_from_request_body()
+    mbid_mapping = _generate_normalised_mbid_mapping(recordings)
+    recordings = [(mbid, offset) for _, mbid, offset in recordings]
+
+    documents = ((mbid, offset, json.dumps(document))
+                 for mbid, offset, document in db.data.iter_many_high_level(recordings, map_classes))
+    return _json_response(stream_with_context(_stream_documents_json(documents, {'mbid_mapping': mbid_mapping})))
+
+
+def _json_response(data):
+    """Make a response from serialized JSON."""
+    return current_app.response_class(data, mimetype=current_app.config["JSONIFY_MIMETYPE"])
+
+
+def _stream_documents_json(documents, extra):
+    """Serialize documents in the form generated by
+    :py:func:`db.data.iter_many_low_level_json`, where each document is already
+    serialized JSON, without parsing them. The result is a dictionary
+    {mbid: {offset: document}} which also contains the items in ``extra``.
+
+    Args:
+        documents: an iterable of (mbid, offset, serialized JSON) tuples,
+          where all offsets of an mbid are together.
+        extra: a dictionary of additional items to include in the result,
+          which are serialized normally.
+
+    Returns:
+        a generator of parts of the serialized JSON, which generates each
+        document as it is read from ``documents``.
+    """
+    yield u'{'
+    current_mbid = None
+    for mbid, offset, document in documents:
+        if mbid != current_mbid:
+            if current_mbid is not None:
+                yield u'},'
+            yield u'{}:{{'.format(json.dumps(mbid))
+            current_mbid = mbid
+        else:
+            yield u','
+        yield u'{}:'.format(json.dumps(str(offset)))
+        yield document
+    if current_mbid is not None:
+        yield u'}'
+    for i, (key, value) in enumerate(extra.items()):
+        separator = u',' if current_mbid is not None or i else u''
+        yield u'{}{}:{}'.format(separator, json.dumps(key), json.dumps(value))
+    yield u'}'
+
+
 def _parse_individual_features():
     """Check whether the features are found or not.
     Parse the query string of features to create a list of
@@ -416,8 +637,8 @@ def _parse_individual_features():
         parsed_features, a list of tuples of the form:
             (<feature_path>, <alias>, <default_type>)
 
-            <feature_path> is a string holding the path to a feature:
-            "llj.data->feature_name"
+            <feature_path> is an expression which selects a feature from
+            the lowlevel_features table: "to_jsonb(llf.lowlevel_feature_name)"
 
             <alias> is a string alias for a feature:
             "lowlevel.feature_name"
@@ -438,10 +659,10 @@ def _parse_individual_features():
             parsed_features.append((feature_path, alias, default_type))
 
     # Always include metadata.version and metadata.audio_properties
-    metadata_version = "llj.data->'metadata'->'version'"
     metadata_version_alias = "metadata.version"
-    metadata_audio_properties = "llj.data->'metadata'->'audio_properties'"
+    metadata_version = db.lowlevel_features.get_feature_path(metadata_version_alias)
     metadata_audio_properties_alias = "metadata.audio_properties"
+    metadata_audio_properties = db.lowlevel_features.get_feature_path(metadata_audio_properties_alias)
 
     parsed_features.append((metadata_version, metadata_version_alias, {}))
     parsed_features.append((metadata_audio_properties, metadata_audio_properties_alias, {}))
@@ -490,3 +711,30 @@ def get_many_count():
         recording_counts['mbid_mapping'] = mbid_mapping
 
     return jsonify(recording_counts)
+
+
+@bp_core.route("/count", methods=["POST"])
+@crossdomain(headers="Content-Type")
+@ratelimit()
+def post_many_count():
+    """Get low-level count for many recordings at once, with the recordings in
+    the body of the request. This allows more recordings to be requested at
+    once than with the ``recording_ids`` query parameter.
+
+    The body of the request has the same form as for ``POST /api/v1/low-level``
+    (offsets are ignored), and the response has the same form as the ``GET``
+    version of this endpoint.
+
+    You can specify up to :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_BULK_POST_REQUEST` MBIDs in a request.
+
+    :reqheader Content-Type: *application/json*
+
+    :resheader Content-Type: *application/json*
+    """
+    recordings = _get_recording_ids_from_request_body()
+    mbid_mapping = _generate_normalised_mbid_mapping(recordings)
+    mbids = remove_duplicates([mbid for (_, mbid, offset) in recordings])
+    recording_counts = db.data.count_many_lowlevel(mbids)
+    recording_counts['mbid_mapping'] = mbid_mapping
+
+    return jsonify(recording_counts)
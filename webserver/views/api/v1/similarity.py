@@ -1,20 +1,26 @@
 from __future__ import absolute_import
 
 import collections
+import json
 from operator import itemgetter
 
 from brainzutils.ratelimit import ratelimit
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, stream_with_context
 
 import webserver.views.api.exceptions
 from webserver.decorators import crossdomain
-from webserver.views.api.v1.core import _parse_bulk_params, _get_recording_ids_from_request
-from similarity.index_model import BASE_INDICES, AnnoyModel
+from webserver.views.api.v1.core import _parse_bulk_params, _get_recording_ids_from_request, \
+    _get_recording_ids_from_request_body, _json_response, _stream_documents_json
+from utils.list_utils import chunks
+from similarity.index_model import BASE_INDICES, get_index
 from similarity.exceptions import IndexNotFoundException, ItemNotFoundException
 from db.exceptions import NoDataFoundException
 
 bp_similarity = Blueprint('api_v1_similarity', __name__)
 
+# Number of recordings which are looked up in the index at a time by POST requests
+POST_LOOKUP_BATCH_SIZE = 100
+
 class RemoveDupsType:
     """'Enum' to determine which kind of deduplication to do when returning similar recordings"""
     # only remove a dup if the mbid is the same and the distance is the same
@@ -173,7 +179,7 @@ def get_many_similar_recordings(metric):
     recordings = [(mbid, offset) for _, mbid, offset in recordings]
     metric, distance_type, n_trees, n_neighbours, threshold, remove_dups = _check_index_params(metric)
     try:
-        index = AnnoyModel(metric, n_trees=n_trees, distance_type=distance_type, load_existing=True)
+        index = get_index(metric, n_trees=n_trees, distance_type=distance_type)
     except IndexNotFoundException:
         raise webserver.views.api.exceptions.APIBadRequest("Index does not exist with specified parameters.")
 
@@ -187,6 +193,58 @@ def get_many_similar_recordings(metric):
     return jsonify(result)
 
 
+@bp_similarity.route("/<metric>/", methods=["POST"])
+@crossdomain(headers="Content-Type")
+@ratelimit()
+def post_many_similar_recordings(metric):
+    """Get the most similar submissions to multiple (MBID, offset) combinations,
+    with the recordings in the body of the request. This allows more recordings
+    to be requested at once than with the ``recording_ids`` query parameter.
+
+    **Example request**:
+
+    .. sourcecode:: json
+
+       {"recording_ids": ["mbid1", ["mbid2", 1]]}
+
+    Each recording is an MBID, or a list of an MBID and an offset. Offsets
+    should be >= 0.
+
+    The response has the same form as the ``GET`` version of this endpoint, and
+    is sent as similar recordings are found. The same query parameters can be used
+    (except for ``recording_ids``).
+
+    You can specify up to :py:const:`~webserver.views.api.v1.core.MAX_ITEMS_PER_BULK_POST_REQUEST` recordings in a request.
+
+    :reqheader Content-Type: *application/json*
+
+    :resheader Content-Type: *application/json*
+    """
+    recordings = _get_recording_ids_from_request_body()
+    recordings = [(mbid, offset) for _, mbid, offset in recordings]
+    metric, distance_type, n_trees, n_neighbours, threshold, remove_dups = _check_index_params(metric)
+    try:
+        index = get_index(metric, n_trees=n_trees, distance_type=distance_type)
+    except IndexNotFoundException:
+        raise webserver.views.api.exceptions.APIBadRequest("Index does not exist with specified parameters.")
+
+    # Recordings are sorted so that all offsets of an mbid are generated together
+    batches = chunks(sorted(recordings), POST_LOOKUP_BATCH_SIZE)
+
+    def generate_similar_recordings():
+        for batch in batches:
+            similar_recordings = index.get_bulk_nns_by_mbid(batch, n_neighbours)
+            for mbid, offset in batch:
+                items = similar_recordings.get(mbid, {}).get(str(offset))
+                if items is None:
+                    continue
+                items = _limit_recordings_by_threshold(items, threshold)
+                items = _sort_and_remove_duplicate_submissions(items, remove_dups)
+                yield mbid, offset, json.dumps(items)
+
+    return _json_response(stream_with_context(_stream_documents_json(generate_similar_recordings(), {})))
+
+
 def check_bad_request_between_recordings():
     """
     Check if a request for similarity between recordings is valid. The ?recording_ids parameter
@@ -246,7 +304,7 @@ def get_similarity_between(metric):
     recordings = check_bad_request_between_recordings()
     metric, distance_type, n_trees, n_neighbours, threshold, remove_dups = _check_index_params(metric)
     try:
-        index = AnnoyModel(metric, n_trees=n_trees, distance_type=distance_type, load_existing=True)
+        index = get_index(metric, n_trees=n_trees, distance_type=distance_type)
     except IndexNotFoundException:
         raise webserver.views.api.exceptions.APIBadRequest("Index does not exist with specified parameters.")
 
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import collections
+import copy
 import json
 import os
 import unittest
@@ -8,7 +9,9 @@ import uuid
 
 import mock
 
+import db.data
 import db.exceptions
+import db.lowlevel_features
 import webserver.views.api.exceptions
 from webserver.testing import AcousticbrainzTestCase
 from webserver.testing import DB_TEST_DATA_PATH
@@ -60,6 +63,46 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         resp = self.client.get("/api/v1/%s/low-level" % mbid)
         self.assertEqual(resp.status_code, 200)
 
+    def test_submit_many_low_level(self):
+        mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
+        with open(os.path.join(DB_TEST_DATA_PATH, mbid + ".json")) as json_file:
+            data = json.load(json_file)
+        second_data = copy.deepcopy(data)
+        second_data["metadata"]["tags"]["album"] = ["Another album"]
+        missing_mbid = copy.deepcopy(data)
+        del missing_mbid["metadata"]["tags"]["musicbrainz_recordingid"]
+        missing_key = copy.deepcopy(data)
+        del missing_key["lowlevel"]
+
+        body = "\n".join([json.dumps(data), json.dumps(second_data), json.dumps(data), "{", "",
+                          json.dumps(missing_mbid), json.dumps(missing_key)]) + "\n"
+        resp = self.client.post("/api/v1/low-level/submit", data=body, content_type="application/x-ndjson")
+        self.assertEqual(200, resp.status_code)
+        results = resp.json["results"]
+        self.assertEqual(6, len(results))
+        self.assertEqual({"mbid": mbid, "status": "saved", "message": None}, results[0])
+        self.assertEqual({"mbid": mbid, "status": "saved", "message": None}, results[1])
+        self.assertEqual({"mbid": mbid, "status": "duplicate", "message": None}, results[2])
+        self.assertEqual("invalid", results[3]["status"])
+        self.assertTrue(results[3]["message"].startswith("Cannot parse JSON document"))
+        self.assertEqual({"mbid": None, "status": "invalid",
+                          "message": "Document doesn't have a musicbrainz_recordingid tag with an MBID"}, results[4])
+        self.assertEqual({"mbid": mbid, "status": "invalid",
+                          "message": "Key 'lowlevel' was not found in submitted data."}, results[5])
+
+        self.assertEqual(2, db.data.count_lowlevel(mbid))
+        self.assertEqual(second_data, db.data.load_low_level(mbid, offset=1))
+
+    def test_submit_many_low_level_bad_request(self):
+        resp = self.client.post("/api/v1/low-level/submit", data="\n", content_type="application/x-ndjson")
+        self.assert400(resp)
+        self.assertEqual("No documents were submitted", resp.json["message"])
+
+        with mock.patch("webserver.views.api.v1.core.MAX_ITEMS_PER_BULK_SUBMISSION", 1):
+            resp = self.client.post("/api/v1/low-level/submit", data="{}\n{}", content_type="application/x-ndjson")
+        self.assert400(resp)
+        self.assertEqual("More than 1 documents not allowed per request", resp.json["message"])
+
     def test_cors_headers(self):
         mbid = "0dad432b-16cc-4bf0-8961-fd31d124b01b"
         self.load_low_level_data(mbid)
@@ -70,7 +113,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
 
         # TODO: Test in get_high_level.
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_bad_uuid_404(self, load_low_level):
         """ URL Endpoint returns 404 because url-part doesn't match UUID.
             This error is raised by Flask, but we special-case to json.
@@ -82,7 +125,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         expected_result = {"message": "The requested URL was not found on the server. If you entered the URL manually please check your spelling and try again."}
         self.assertEqual(resp.json, expected_result)
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_internal_server_error(self, load_low_level):
 
         # Flask will propagate exceptions instead of calling an error handler
@@ -100,29 +143,29 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         self.assertDictEqual(resp.json, expected_result)
         self.app.config['PROPAGATE_EXCEPTIONS'] = old_propagate_exceptions
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_no_offset(self, ll):
-        ll.return_value = {}
+        ll.return_value = "{}"
         resp = self.client.get("/api/v1/%s/low-level" % self.uuid)
         self.assertEqual(200, resp.status_code)
         ll.assert_called_with(self.uuid, 0)
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_numerical_offset(self, ll):
-        ll.return_value = {}
+        ll.return_value = "{}"
         resp = self.client.get("/api/v1/%s/low-level?n=3" % self.uuid)
         self.assertEqual(200, resp.status_code)
         ll.assert_called_with(self.uuid, 3)
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_bad_offset(self, ll):
         # non-numerical offset is replaced by 0
-        ll.return_value = {}
+        ll.return_value = "{}"
         resp = self.client.get("/api/v1/%s/low-level?n=x" % self.uuid)
         self.assertEqual(200, resp.status_code)
         ll.assert_called_with(self.uuid, 0)
 
-    @mock.patch("db.data.load_low_level")
+    @mock.patch("db.data.load_low_level_json")
     def test_ll_no_item(self, ll):
         ll.side_effect = db.exceptions.NoDataFoundException
         resp = self.client.get("/api/v1/%s/low-level" % self.uuid)
@@ -148,7 +191,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         self.assertEqual(200, resp.status_code)
         hl.assert_called_with(self.uuid, 3, False)
 
-    @mock.patch('db.data.load_many_low_level')
+    @mock.patch('db.data.iter_many_low_level_json')
     def test_get_bulk_ll_no_param(self, load_many_low_level):
         # No parameter in bulk lookup results in an error
         resp = self.client.get('api/v1/low-level')
@@ -157,7 +200,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         expected_result = {"message": "Missing `recording_ids` parameter"}
         self.assertEqual(resp.json, expected_result)
 
-    @mock.patch('db.data.load_many_low_level')
+    @mock.patch('db.data.iter_many_low_level_json')
     def test_get_bulk_ll(self, load_many_low_level):
         # Check that many items are returned, including two offsets of the
         # same MBID
@@ -169,11 +212,12 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         rec_40_2 = {"recording": "405a5ff4-7ee2-436b-95c1-90ce8a83b359:2"}
         rec_40_3 = {"recording": "405a5ff4-7ee2-436b-95c1-90ce8a83b359:3"}
 
-        load_many_low_level.return_value = {
-            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5},
-            "7f27d7a9-27f0-4663-9d20-2c9c40200e6d": {"3": rec_7f},
-            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": rec_40_2, "3": rec_40_3}
-        }
+        load_many_low_level.return_value = iter([
+            ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2, json.dumps(rec_40_2)),
+            ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 3, json.dumps(rec_40_3)),
+            ("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3, json.dumps(rec_7f)),
+            ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0, json.dumps(rec_c5)),
+        ])
 
         resp = self.client.get('api/v1/low-level?recording_ids=' + params)
         self.assertEqual(resp.status_code, 200)
@@ -195,9 +239,12 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         # upper-case
         params = "c5f4909e-1d7b-4f15-a6f6-1AF376BC01C9"
         expected_result = {
-            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5}
+            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5},
+            "mbid_mapping": {params.upper(): "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9"}
         }
-        load_many_low_level.return_value = expected_result
+        load_many_low_level.return_value = iter([
+            ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0, json.dumps(rec_c5))
+        ])
         resp = self.client.get('api/v1/low-level?recording_ids=' + params.upper())
         self.assertEqual(resp.status_code, 200)
 
@@ -207,7 +254,7 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)]
         load_many_low_level.assert_called_with(recordings)
 
-    @mock.patch('db.data.load_many_low_level')
+    @mock.patch('db.data.iter_many_low_level_json')
     def test_get_bulk_ll_absent_mbid(self, load_many_low_level):
         # Check that within a set of mbid parameters, the ones absent
         # from the database are ignored.
@@ -217,10 +264,10 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         rec_c5 = {"recording": "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9"}
         rec_40_2 = {"recording": "405a5ff4-7ee2-436b-95c1-90ce8a83b359:2"}
 
-        load_many_low_level.return_value = {
-            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5},
-            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": rec_40_2}
-        }
+        load_many_low_level.return_value = iter([
+            ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2, json.dumps(rec_40_2)),
+            ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0, json.dumps(rec_c5)),
+        ])
 
         resp = self.client.get('api/v1/low-level?recording_ids=' + params)
         self.assertEqual(resp.status_code, 200)
@@ -245,6 +292,71 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         self.assertEqual(resp.status_code, 400)
         self.assertEqual('More than 25 recordings not allowed per request', resp.json['message'])
 
+    @mock.patch('db.data.iter_many_low_level_json')
+    def test_post_bulk_ll(self, iter_many_low_level_json):
+        # Recordings are read from the body of the request, as an mbid or [mbid, offset]
+        rec_c5 = {"recording": "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9"}
+        rec_40_2 = {"recording": "405a5ff4-7ee2-436b-95c1-90ce8a83b359:2"}
+        iter_many_low_level_json.return_value = iter([
+            ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2, json.dumps(rec_40_2)),
+            ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0, json.dumps(rec_c5)),
+        ])
+        body = {"recording_ids": ["C5F4909E-1D7B-4F15-A6F6-1AF376BC01C9",
+                                  ["405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2],
+                                  ["405a5ff4-7ee2-436b-95c1-90ce8a83b359", "2"]]}
+        resp = self.client.post('api/v1/low-level', data=json.dumps(body), content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        expected_result = {
+            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5},
+            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": rec_40_2},
+            "mbid_mapping": {"C5F4909E-1D7B-4F15-A6F6-1AF376BC01C9": "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9"}
+        }
+        self.assertEqual(resp.json, expected_result)
+        iter_many_low_level_json.assert_called_with([("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0),
+                                                     ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2)])
+
+    def test_post_bulk_ll_bad_body(self):
+        for body in ['not json', '[]', '{"recording_ids": "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9"}',
+                     '{"recording_ids": [["c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 1, 2]]}',
+                     '{"recording_ids": [1]}',
+                     '{"recording_ids": [["c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", [1]]]}',
+                     '{"recording_ids": [["c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", {"a": 1}]]}']:
+            resp = self.client.post('api/v1/low-level', data=body, content_type='application/json')
+            self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.post('api/v1/low-level', data='{"recording_ids": ["x"]}', content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual("'x' is not a valid UUID", resp.json['message'])
+
+        # More than 25 recordings can be requested, up to MAX_ITEMS_PER_BULK_POST_REQUEST
+        manyids = [str(uuid.uuid4()) for i in range(core.MAX_ITEMS_PER_BULK_POST_REQUEST + 1)]
+        resp = self.client.post('api/v1/low-level', data=json.dumps({"recording_ids": manyids}),
+                                content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual('More than %s recordings not allowed per request' % core.MAX_ITEMS_PER_BULK_POST_REQUEST,
+                         resp.json['message'])
+        # The number of recordings is checked before they are validated
+        resp = self.client.post('api/v1/low-level', data=json.dumps({"recording_ids": manyids[:-2] + ["x"]}),
+                                content_type='application/json')
+        self.assertEqual("'x' is not a valid UUID", resp.json['message'])
+        resp = self.client.post('api/v1/low-level', data=json.dumps({"recording_ids": manyids + ["x"]}),
+                                content_type='application/json')
+        self.assertEqual('More than %s recordings not allowed per request' % core.MAX_ITEMS_PER_BULK_POST_REQUEST,
+                         resp.json['message'])
+
+    @mock.patch('db.data.load_many_high_level')
+    def test_post_bulk_hl(self, load_many_high_level):
+        rec_c5 = {"recording": "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9"}
+        load_many_high_level.return_value = {"c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5}}
+        body = {"recording_ids": ["c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", "7f27d7a9-27f0-4663-9d20-2c9c40200e6d"]}
+        resp = self.client.post('api/v1/high-level?map_classes=true', data=json.dumps(body),
+                                content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {"c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": rec_c5}, "mbid_mapping": {}})
+        load_many_high_level.assert_called_with([("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 0),
+                                                 ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)], True)
+
     @mock.patch('db.data.load_high_level')
     def test_get_bulk_hl_no_param(self, load_high_level):
         # No parameter in bulk lookup results in an error
@@ -425,10 +537,11 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 3)]
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'rhythm'->'onset_rate'", "rhythm.onset_rate", None),
-                    ("llj.data->'metadata'->'version'", "metadata.version", {}),
-                    ("llj.data->'metadata'->'audio_properties'", "metadata.audio_properties", {})]
+        features = [(db.lowlevel_features.get_feature_path(alias), alias, default) for alias, default in
+                   [("lowlevel.average_loudness", None),
+                    ("rhythm.onset_rate", None),
+                    ("metadata.version", {}),
+                    ("metadata.audio_properties", {})]]
         load_many_individual_features.assert_called_with(recordings, features)
 
         # upper-case MBID
@@ -445,9 +558,10 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         # to load_many_high_level is always lower-case regardless of what we pass in
         self.assertEqual(resp.json, expected_result)
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)]
-        features = [("llj.data->'lowlevel'->'average_loudness'", "lowlevel.average_loudness", None),
-                    ("llj.data->'metadata'->'version'", "metadata.version", {}),
-                    ("llj.data->'metadata'->'audio_properties'", "metadata.audio_properties", {})]
+        features = [(db.lowlevel_features.get_feature_path(alias), alias, default) for alias, default in
+                   [("lowlevel.average_loudness", None),
+                    ("metadata.version", {}),
+                    ("metadata.audio_properties", {})]]
         load_many_individual_features.assert_called_with(recordings, features)
 
     @mock.patch('db.data.load_many_individual_features')
@@ -474,9 +588,10 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0),
                       ("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2)]
-        features = [("llj.data->'rhythm'->'onset_rate'", "rhythm.onset_rate", None),
-                    ("llj.data->'metadata'->'version'", "metadata.version", {}),
-                    ("llj.data->'metadata'->'audio_properties'", "metadata.audio_properties", {})]
+        features = [(db.lowlevel_features.get_feature_path(alias), alias, default) for alias, default in
+                   [("rhythm.onset_rate", None),
+                    ("metadata.version", {}),
+                    ("metadata.audio_properties", {})]]
         load_many_individual_features.assert_called_with(recordings, features)
 
     def test_get_bulk_individual_features_more_than_25(self):
@@ -555,6 +670,19 @@ class CoreViewsTestCase(AcousticbrainzTestCase):
         self.assertEqual('More than 25 recordings not allowed per request',
                          resp.json['message'])
 
+    def test_post_bulk_count(self):
+        mbids = self.submit_fake_data()
+        body = {"recording_ids": [[mbid, 1] for mbid in mbids] + [mbids[0].upper()]}
+        resp = self.client.post('api/v1/count', data=json.dumps(body), content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        expected_result = {
+            "7f27d7a9-27f0-4663-9d20-2c9c40200e6d": {"count": 1},
+            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"count": 2},
+            "mbid_mapping": {mbids[0].upper(): mbids[0]}
+        }
+        self.assertDictEqual(resp.json, expected_result)
+
 
 class GetBulkValidationTest(unittest.TestCase):
     # Validation/parse methods don't need to spin up test server
@@ -615,3 +743,16 @@ class GetBulkValidationTest(unittest.TestCase):
 
         expected = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)]
         self.assertEqual(expected, validated)
+
+    def test_stream_documents_json(self):
+        # Serialized documents are joined together with the other items
+        documents = [("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3, '{}'),
+                     ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0, '{"a": [1, 2]}'),
+                     ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 1, '{"b": "\\u00e9"}')]
+        streamed = u"".join(core._stream_documents_json(iter(documents), {"mbid_mapping": {"C5F4909E": "c5f4909e"}}))
+        expected = {"c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": {"a": [1, 2]}, "1": {"b": u"\u00e9"}},
+                    "7f27d7a9-27f0-4663-9d20-2c9c40200e6d": {"3": {}},
+                    "mbid_mapping": {"C5F4909E": "c5f4909e"}}
+        self.assertEqual(expected, json.loads(streamed))
+        self.assertEqual({"mbid_mapping": {}},
+                         json.loads(u"".join(core._stream_documents_json([], {"mbid_mapping": {}}))))
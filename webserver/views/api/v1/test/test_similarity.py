@@ -26,21 +26,21 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         self.test_recording2_data_json = open(os.path.join(DB_TEST_DATA_PATH, self.test_recording2_mbid + '.json')).read()
         self.test_recording2_data = json.loads(self.test_recording2_data_json)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similar_recordings_bad_uuid(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similar_recordings_bad_uuid(self, get_index):
         """ URL Endpoint returns 404 because url-part doesn't match UUID.
             This error is raised by Flask, but we special-case to json.
         """
         resp = self.client.get("/api/v1/similarity/mfccs/nothing")
         self.assertEqual(404, resp.status_code)
 
-        annoy_model.assert_not_called()
+        get_index.assert_not_called()
         expected_result = {"message": "The requested URL was not found on the server. "
                                       "If you entered the URL manually please check your spelling and try again."}
         self.assertEqual(resp.json, expected_result)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similar_recordings_invalid_params(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similar_recordings_invalid_params(self, get_index):
         # If index params are not in index_model.BASE_INDICES, they default.
         # If n_neighbours is larger than 1000, it defaults.
         annoy_mock = mock.Mock()
@@ -48,7 +48,7 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
             {"distance": 0.0001, "offset": 2, "recording_mbid": "f2cf852b-644c-4f2b-8c17-d059ead1f675"},
             {"distance": 0.0002, "offset": 0, "recording_mbid": "a48a4c29-082a-447b-97ea-c33d1e36b160"}
         ]}}
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
         resp = self.client.get("/api/v1/similarity/mfccs/?n_trees=-1&distance_type=7&n_neighbours=2000&recording_ids=%s:x" % self.uuid)
         self.assertEqual(200, resp.status_code)
 
@@ -57,23 +57,23 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         n_trees = 10
         n_neighbours = 1000
         metric = "mfccs"
-        annoy_model.assert_called_with(metric, n_trees=n_trees, distance_type=distance_type, load_existing=True)
+        get_index.assert_called_with(metric, n_trees=n_trees, distance_type=distance_type)
         annoy_mock.get_bulk_nns_by_mbid.assert_called_with([(self.uuid, offset)], n_neighbours)
 
         # If n_neighbours is not numerical, it defaults
         resp = self.client.get("/api/v1/similarity/mfccs/?n_trees=-1&distance_type=7&n_neighbours=x&recording_ids=%s" % self.uuid)
         self.assertEqual(200, resp.status_code)
 
-        annoy_model.assert_called_with(metric, n_trees=n_trees, distance_type=distance_type, load_existing=True)
+        get_index.assert_called_with(metric, n_trees=n_trees, distance_type=distance_type)
         n_neighbours = 200
         annoy_mock.get_bulk_nns_by_mbid.assert_called_with([(self.uuid, offset)], n_neighbours)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similar_recordings_invalid_metric(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similar_recordings_invalid_metric(self, get_index):
         # If metric does not exist, APIBadRequest is raised.
         resp = self.client.get("/api/v1/similarity/nothing/?recording_ids=c5f4909e-1d7b-4f15-a6f6-1af376bc01c9")
         self.assertEqual(400, resp.status_code)
-        annoy_model.assert_not_called()
+        get_index.assert_not_called()
         expected_result = {"message": "An index with the specified metric does not exist."}
         self.assertEqual(expected_result, resp.json)
 
@@ -84,8 +84,8 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         expected_result = {"message": "Missing `recording_ids` parameter"}
         self.assertEqual(resp.json, expected_result)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_many_similar_recordings(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_many_similar_recordings(self, get_index):
         # Check that similar recordings are returned for many recordings,
         # including two offsets of the same MBID.
         params = "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9;7f27d7a9-27f0-4663-9d20-2c9c40200e6d:3;" \
@@ -99,14 +99,14 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         }
         annoy_mock = mock.Mock()
         annoy_mock.get_bulk_nns_by_mbid.return_value = expected_result
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
 
         resp = self.client.get('api/v1/similarity/mfccs/?recording_ids=' + params)
         self.assertEqual(200, resp.status_code)
         self.assertEqual(expected_result, resp.json)
 
         # Index parameters should default if not specified by query string.
-        annoy_model.assert_called_with("mfccs", n_trees=10, distance_type="angular", load_existing=True)
+        get_index.assert_called_with("mfccs", n_trees=10, distance_type="angular")
 
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0),
                       ("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3),
@@ -131,8 +131,8 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)]
         annoy_mock.get_bulk_nns_by_mbid.assert_called_with(recordings, 200)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_many_similar_recordings_missing_mbid(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_many_similar_recordings_missing_mbid(self, get_index):
         # Check that within a set of mbid parameters, the ones absent
         # from the database are ignored.
         recordings = "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9;7f27d7a9-27f0-4663-9d20-2c9c40200e6d:3;" \
@@ -149,7 +149,7 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         }
         annoy_mock = mock.Mock()
         annoy_mock.get_bulk_nns_by_mbid.return_value = expected_result
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
 
         query_string = {"recording_ids": recordings,
                         "n_trees": "-1",
@@ -160,13 +160,43 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         self.assertEqual(expected_result, resp.json)
 
         # If index parameters are invalid, they are defaulted.
-        annoy_model.assert_called_with("mfccs", n_trees=10, distance_type="angular", load_existing=True)
+        get_index.assert_called_with("mfccs", n_trees=10, distance_type="angular")
 
         recordings = [("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0),
                       ("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3),
                       ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2)]
         annoy_mock.get_bulk_nns_by_mbid.assert_called_with(recordings, 1000)
 
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_post_many_similar_recordings(self, get_index):
+        # Recordings are read from the body of the request and looked up in batches
+        similars = [{'recording_mbid': "similar_rec1", 'offset': 0, 'distance': 0.1},
+                    {'recording_mbid': "similar_rec2", 'offset': 0, 'distance': 0.3}]
+        annoy_mock = mock.Mock()
+        annoy_mock.get_bulk_nns_by_mbid.side_effect = [
+            {"405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": similars, "3": similars}},
+            {"c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": similars}}
+        ]
+        get_index.return_value = annoy_mock
+
+        body = {"recording_ids": ["c5f4909e-1d7b-4f15-a6f6-1af376bc01c9",
+                                  ["7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3],
+                                  ["405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2],
+                                  ["405a5ff4-7ee2-436b-95c1-90ce8a83b359", 3]]}
+        with mock.patch("webserver.views.api.v1.similarity.POST_LOOKUP_BATCH_SIZE", 2):
+            resp = self.client.post("/api/v1/similarity/mfccs/?threshold=0.2", data=json.dumps(body),
+                                     content_type="application/json")
+        self.assertEqual(200, resp.status_code)
+        expected_result = {
+            "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9": {"0": similars[:1]},
+            "405a5ff4-7ee2-436b-95c1-90ce8a83b359": {"2": similars[:1], "3": similars[:1]}
+        }
+        self.assertEqual(expected_result, resp.json)
+        annoy_mock.get_bulk_nns_by_mbid.assert_has_calls([
+            mock.call([("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 2), ("405a5ff4-7ee2-436b-95c1-90ce8a83b359", 3)], 200),
+            mock.call([("7f27d7a9-27f0-4663-9d20-2c9c40200e6d", 3), ("c5f4909e-1d7b-4f15-a6f6-1af376bc01c9", 0)], 200)
+        ])
+
     def test_get_many_similar_recordings_more_than_200(self):
         # Check that a request for over 200 recordings raises an error.
         manyids = [str(uuid.uuid4()) for i in range(26)]
@@ -176,8 +206,8 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         expected_result = {"message": "More than 25 recordings not allowed per request"}
         self.assertEqual(expected_result, resp.json)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similarity_between_no_params(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similarity_between_no_params(self, get_index):
         # If no index params are provided, they default.
         # Submissions can be selected using offset.
         recordings = "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9;7f27d7a9-27f0-4663-9d20-2c9c40200e6d:2"
@@ -186,22 +216,22 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
 
         annoy_mock = mock.Mock()
         annoy_mock.get_similarity_between.return_value = 1
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
 
         resp = self.client.get("/api/v1/similarity/mfccs/between/?recording_ids=" + recordings)
         self.assertEqual(200, resp.status_code)
         self.assertEqual({"mfccs": 1}, resp.json)
 
-        annoy_model.assert_called_with("mfccs", n_trees=10, distance_type="angular", load_existing=True)
+        get_index.assert_called_with("mfccs", n_trees=10, distance_type="angular")
         annoy_mock.get_similarity_between.assert_called_with(rec_1, rec_2)
 
-    @mock.patch("webserver.views.api.v1.similarity.AnnoyModel")
-    def test_get_similarity_between_exceptions(self, annoy_model):
+    @mock.patch("webserver.views.api.v1.similarity.get_index")
+    def test_get_similarity_between_exceptions(self, get_index):
         # If there is no submission for an (MBID, offset) combination,
         # empty dictionary is returned.
         annoy_mock = mock.Mock()
         annoy_mock.get_similarity_between.side_effect = NoDataFoundException
-        annoy_model.return_value = annoy_mock
+        get_index.return_value = annoy_mock
 
         recordings = "c5f4909e-1d7b-4f15-a6f6-1af376bc01c9;7f27d7a9-27f0-4663-9d20-2c9c40200e6d:2"
         resp = self.client.get("/api/v1/similarity/mfccs/between/?recording_ids=" + recordings)
@@ -217,7 +247,7 @@ class APISimilarityViewsTestCase(AcousticbrainzTestCase):
         self.assertEqual(expected_result, resp.json)
 
         # If index is unable to load, APIBadRequest is raised.
-        annoy_model.side_effect = IndexNotFoundException
+        get_index.side_effect = IndexNotFoundException
         resp = self.client.get("/api/v1/similarity/mfccs/between/?recording_ids=" + recordings)
         self.assertEqual(400, resp.status_code)
 
@@ -6,7 +6,7 @@ from werkzeug.exceptions import NotFound, ServiceUnavailable
 from webserver.decorators import service_session_login_required
 from webserver.utils import validate_offset
 from webserver.views.data import _get_recording_info, _get_youtube_query
-from similarity.index_model import AnnoyModel
+from similarity.index_model import get_index
 import similarity.exceptions
 import db.similarity
 import db.data
@@ -70,7 +70,7 @@ def get_similar_service(mbid, metric):
             raise db.exceptions.NoDataFoundException()
         category, metric, description = db.similarity.get_metric_info(metric)
         # Annoy model currently uses default parameters
-        index = AnnoyModel(metric, load_existing=True)
+        index = get_index(metric)
         similar_recordings = index.get_nns_by_mbid(mbid, offset, n_similar)
     except (db.exceptions.NoDataFoundException, similarity.exceptions.ItemNotFoundException,
             similarity.exceptions.IndexNotFoundException) as e:
@@ -12,9 +12,15 @@ cli = FlaskGroup(add_default_commands=False, create_app=webserver.create_app_fla
 
 @cli.command('hl_extractor')
 @click.option('--threads', '-t', default=1, type=int)
-def command_hl_extractor(threads=1):
+@click.option('--server', '-s', is_flag=True, help="Keep extractor processes running between jobs "
+                                                   "(the extractor binary must support server mode).")
+@click.option('--working-dir', '-w', default=hl_extractor.hl_calc.DEFAULT_WORKING_DIR_ROOT,
+              type=click.Path(exists=True, file_okay=False, writable=True),
+              help="Directory to write documents in, e.g. /dev/shm to keep them in memory. It must have room "
+                   "for the documents of every set which is being processed (default: the temporary directory).")
+def command_hl_extractor(threads=1, server=False, working_dir=None):
     """Compute high-level features from low-level data files."""
-    hl_extractor.hl_calc.main(threads)
+    hl_extractor.hl_calc.main(threads, server, working_dir)
 
 
 @cli.command('dataset_evaluator')